@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""Throughput and latency of the provider against a local fake MercadoPago.
+
+    python benchmarks/run.py --requests 1000 --concurrency 16 --latency 0.02 \\
+        --output results.json
+    python benchmarks/run.py --compare previous.json
+    python benchmarks/run.py --cart-sizes 1,100,10000 --max-items 100
+
+Payments are kept in memory so the numbers reflect the provider and the
+HTTP path, not the database.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+settings.configure(
+    SECRET_KEY='benchmark',
+    PAYMENT_HOST='example.org',
+    INSTALLED_APPS=['payments', 'payments_mercadopago'],
+    ROOT_URLCONF='payments.urls',
+    CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+django.setup()
+
+from payments import PaymentStatus, PurchasedItem, RedirectNeeded  # noqa: E402
+
+from payments_mercadopago import MercadoPagoProvider  # noqa: E402
+from payments_mercadopago.testing import FakeMercadoPago  # noqa: E402
+
+
+TRANSPORTS = {
+    'sdk': 'payments_mercadopago.transports.SDKTransport',
+    'http': 'payments_mercadopago.transports.HTTPTransport',
+}
+
+
+class BenchmarkPayment:
+    id = 1
+    description = 'payment'
+    currency = 'MXN'
+    delivery = Decimal(10)
+    tax = Decimal(0)
+    total = Decimal(110)
+    captured_amount = Decimal(0)
+    variant = 'mercadopago'
+    transaction_id = None
+    message = ''
+    extra_data = ''
+    billing_first_name = 'John'
+    billing_last_name = 'Doe'
+    billing_email = 'john@example.com'
+    billing_address_1 = 'Street'
+    billing_address_2 = '1'
+    billing_postcode = '00000'
+
+    def __init__(self, items: int = 1, skus: int = None) -> None:
+        self.token = str(uuid.uuid4())
+        self.status = PaymentStatus.WAITING
+        self.items = items
+        self.skus = skus or items
+
+    def save(self, **kwargs) -> None:
+        pass
+
+    def change_status(self, status: str, message: str = '') -> None:
+        self.status = status
+        self.message = message
+
+    def get_purchased_items(self):
+        for number in range(self.items):
+            sku = number % self.skus
+            yield PurchasedItem(name='item %d' % sku, quantity=1,
+                                price=Decimal('99.99'), currency='MXN',
+                                sku='sku-%d' % sku)
+
+    def get_success_url(self) -> str:
+        return 'https://example.org/success'
+
+    def get_failure_url(self) -> str:
+        return 'https://example.org/failure'
+
+
+class Notification:
+
+    def __init__(self, collection_id: int) -> None:
+        self.GET = {'type': 'payment', 'data.id': str(collection_id)}
+
+
+def percentile(samples: list, fraction: float) -> float:
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+def measure(server: FakeMercadoPago, func, jobs: list,
+            concurrency: int) -> dict:
+    upstream_before = sum(server.requests.values())
+
+    def timed(job):
+        start = time.perf_counter()
+        try:
+            func(job)
+        except RedirectNeeded:
+            pass
+        except Exception:
+            return time.perf_counter() - start, False
+        return time.perf_counter() - start, True
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed, jobs))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for latency, ok in results)
+    return {
+        'requests': len(jobs),
+        'errors': sum(1 for latency, ok in results if not ok),
+        'seconds': elapsed,
+        'throughput': len(jobs) / elapsed,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'upstream_requests': sum(server.requests.values()) - upstream_before,
+    }
+
+
+def measure_builder(provider, payment: BenchmarkPayment, builds: int) -> dict:
+    """Time building and encoding preferences, no request is made."""
+    latencies = []
+    for number in range(builds):
+        start = time.perf_counter()
+        payload = json.dumps(provider.create_preference_data(payment))
+        latencies.append(time.perf_counter() - start)
+    elapsed = sum(latencies)
+    latencies.sort()
+    return {
+        'requests': builds,
+        'seconds': elapsed,
+        'throughput': builds / elapsed,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'items': len(json.loads(payload)['items']),
+        'payload_bytes': len(payload),
+    }
+
+
+def get_form(provider):
+    return lambda payment: provider.get_form(payment)
+
+
+def process_data(provider):
+    return lambda job: provider.process_data(*job)
+
+
+def webhook_storm_jobs(requests: int, duplicates: int) -> list:
+    jobs = []
+    for collection_id in range(max(1, requests // duplicates)):
+        payment = BenchmarkPayment()
+        jobs.extend([(payment, Notification(collection_id))] * duplicates)
+    random.Random(0).shuffle(jobs)
+    return jobs
+
+
+def run(options) -> dict:
+    results = {}
+    with FakeMercadoPago(latency=options.latency, jitter=options.jitter,
+                         error_rate=options.error_rate, seed=0) as server:
+        provider_options = {
+            'access_token': 'BENCHMARK', 'api_base_url': server.url,
+            'http_pool_size': options.concurrency,
+            'transport': TRANSPORTS[options.transport]}
+        provider = MercadoPagoProvider(**provider_options)
+        deduplicating = MercadoPagoProvider(
+            notification_cache_ttl=60, **provider_options)
+        results['get_form'] = measure(
+            server, get_form(provider),
+            [BenchmarkPayment(options.items)
+             for number in range(options.requests)],
+            options.concurrency)
+        results['process_data'] = measure(
+            server, process_data(provider),
+            [(BenchmarkPayment(), Notification(number))
+             for number in range(options.requests)],
+            options.concurrency)
+        results['webhook_storm'] = measure(
+            server, process_data(provider),
+            webhook_storm_jobs(options.requests, options.duplicates),
+            options.concurrency)
+        results['webhook_storm_deduplicated'] = measure(
+            server, process_data(deduplicating),
+            webhook_storm_jobs(options.requests, options.duplicates),
+            options.concurrency)
+    builders = {
+        'default': MercadoPagoProvider(access_token='BENCHMARK'),
+        'aggregated': MercadoPagoProvider(
+            access_token='BENCHMARK', aggregate_items=True,
+            max_items=options.max_items),
+    }
+    for size in options.cart_sizes:
+        # A quarter of the lines repeat a SKU already in the cart
+        payment = BenchmarkPayment(size, skus=max(1, size * 3 // 4))
+        for name, builder in builders.items():
+            results['preference_%s_%d' % (name, size)] = measure_builder(
+                builder, payment, options.builds)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'timestamp': time.time(),
+            'options': vars(options),
+        },
+        'scenarios': results,
+    }
+
+
+def compare(current: dict, previous: dict) -> None:
+    for name, result in current['scenarios'].items():
+        baseline = previous['scenarios'].get(name)
+        if not baseline:
+            continue
+        print('%-28s throughput %+7.1f%%  p99 %+7.1f%%' % (
+            name,
+            100 * (result['throughput'] / baseline['throughput'] - 1),
+            100 * (result['p99'] / baseline['p99'] - 1)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds the fake server waits per request.')
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--duplicates', type=int, default=5,
+                        help='Deliveries of each webhook in the storm.')
+    parser.add_argument('--items', type=int, default=5,
+                        help='Cart lines of each get_form payment.')
+    parser.add_argument('--cart-sizes', default='1,10,100,1000,10000',
+                        type=lambda value: [int(size)
+                                            for size in value.split(',')],
+                        help='Cart lines of the preference builder runs.')
+    parser.add_argument('--builds', type=int, default=20,
+                        help='Preferences built per cart size and builder.')
+    parser.add_argument('--max-items', type=int, default=100,
+                        help='max_items of the aggregated builder.')
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS),
+                        default='sdk')
+    parser.add_argument('--output', help='Write the results as JSON.')
+    parser.add_argument('--compare', help='Previous results to compare to.')
+    options = parser.parse_args()
+    previous = None
+    if options.compare:
+        with open(options.compare) as previous_file:
+            previous = json.load(previous_file)
+        del options.compare
+    results = run(options)
+    output = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    if previous:
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,70 +1,427 @@
-from typing import Any
+from typing import TYPE_CHECKING, Any, Optional
 from django.urls import reverse
 from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import redirect
 from django.utils.translation import gettext as _
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpRequest
+from django.utils import timezone
+from django.utils.module_loading import import_string
 
+from datetime import timedelta
 from decimal import Decimal, ROUND_HALF_UP
+import hashlib
+import hmac
 import json
 import logging
+import time
+import warnings
 try:
     from urllib.parse import urljoin
 except ImportError:
     from urlparse import urljoin
 
+from requests.exceptions import RequestException
+
 from payments import PaymentError, PaymentStatus, RedirectNeeded
 from payments.core import BasicProvider, get_base_url
-from payments.models import BasePayment
 
-import mercadopago
+if TYPE_CHECKING:
+    from payments.models import BasePayment
+
+from .cache import NotificationCache, PreferenceCache, StatusCache
+from .client import API_BASE_URL, request_headers, request_timeout
+from .items import aggregate_items
+from .metrics import get_metrics_backend, instrument
+from .oauth import get_token_manager
+from .queues import get_queue
+from .ratelimit import get_rate_limits
+from .resilience import Retry, get_circuit_breaker, is_retryable, is_server_error
+from .streams import get_status_broker
+from .transitions import PENDING_STATUSES, can_transition, touch, transition
+
 
+# Django < 3.2 does not discover the AppConfig of an app by itself
+default_app_config = 'payments_mercadopago.apps.PaymentsMercadoPagoConfig'
 
 CENTS = Decimal('0.01')
 
+# Fields of a MercadoPago response kept in extra_data by the compact mode
+COMPACT_RESPONSE_KEYS = (
+    'id', 'status', 'status_detail', 'external_reference', 'payment_id',
+    'transaction_amount', 'amount', 'currency_id', 'date_approved',
+    'init_point', 'sandbox_init_point', 'message', 'order_status',
+    'total_amount', 'paid_amount')
+
+# Notification topics of merchant orders, legacy IPN and webhooks
+MERCHANT_ORDER_TOPICS = ('merchant_order', 'topic_merchant_order_wh')
+
 logger = logging.getLogger(__name__)
 
 
 class MercadoPagoProvider(BasicProvider):
+    # Name of the account in a ShardedMercadoPagoProvider
+    shard = None
 
-    def __init__(self, access_token: str, sandbox_mode: bool = False, **kwargs) -> None:
+    def __init__(self, access_token: str = None, sandbox_mode: bool = False,
+                 async_webhooks: bool = False,
+                 webhook_queue: str = 'payments_mercadopago.queues.LocalQueue',
+                 webhook_queue_options: dict = None,
+                 notification_cache_ttl: int = None,
+                 notification_cache_alias: str = 'default',
+                 http_pool_size: int = 10, http_timeout: float = 30,
+                 api_base_url: str = API_BASE_URL,
+                 preference_cache_ttl: int = None,
+                 preference_cache_alias: str = 'default',
+                 extra_data_mode: str = 'full', archive_responses: bool = False,
+                 compress_archive: bool = True, metrics_backend: str = None,
+                 operation_timeouts: dict = None, retries: int = 0,
+                 retry_backoff: float = 0.2,
+                 circuit_breaker_threshold: int = None,
+                 circuit_breaker_timeout: float = 30,
+                 circuit_breaker_cache: str = None,
+                 dedicated_webhook: bool = False, webhook_secret: str = None,
+                 status_cache_ttl: int = None,
+                 status_cache_alias: str = 'default',
+                 confirm_on_return: bool = False,
+                 rate_limits: dict = None, rate_limit_cache: str = None,
+                 rate_limit_wait: float = 1, rate_limit_reserve: float = 0.2,
+                 transport: str = 'payments_mercadopago.transports.SDKTransport',
+                 client_id: str = None, client_secret: str = None,
+                 token_cache_alias: str = 'default',
+                 token_refresh_margin: float = 300,
+                 status_stream: bool = False, status_stream_cache: str = None,
+                 direct_payments: bool = False, public_key: str = None,
+                 preference_expiration: int = None,
+                 aggregate_items: bool = False, max_items: int = None,
+                 **kwargs) -> None:
         self.access_token = access_token
+        self.token_manager = None
+        if access_token is None:
+            if not (client_id and client_secret):
+                raise ImproperlyConfigured(
+                    'MercadoPagoProvider requires an access_token or a '
+                    'client_id and a client_secret.')
+            self.token_manager = get_token_manager(
+                client_id, client_secret, api_base_url,
+                cache_alias=token_cache_alias,
+                refresh_margin=token_refresh_margin,
+                pool_size=http_pool_size, timeout=http_timeout)
+        if direct_payments and not public_key:
+            raise ImproperlyConfigured(
+                'MercadoPagoProvider requires a public_key for direct '
+                'payments.')
+        if max_items is not None and not aggregate_items:
+            raise ImproperlyConfigured(
+                'max_items requires aggregate_items.')
+        if max_items is not None and max_items < 2:
+            raise ImproperlyConfigured(
+                'max_items must leave room for the shipping line and a '
+                'summary line.')
+        self.direct_payments = direct_payments
+        self.public_key = public_key
         self.sandbox_mode = sandbox_mode
         self.init_point = 'sandbox_init_point' if self.sandbox_mode else 'init_point'
-        self.mp = mercadopago.MP(self.access_token)
-        self.mp.sandbox_mode(self.sandbox_mode)
+        self.api_base_url = api_base_url
+        self.transport = import_string(transport)(
+            self.access_token or self.token_manager, self.sandbox_mode,
+            http_pool_size,
+            http_timeout, api_base_url)
+        self.async_webhooks = async_webhooks
+        self.webhook_queue = None
+        if self.async_webhooks:
+            self.webhook_queue = get_queue(
+                webhook_queue, **(webhook_queue_options or {}))
+        self.notification_cache = None
+        if notification_cache_ttl:
+            self.notification_cache = NotificationCache(
+                notification_cache_ttl, notification_cache_alias)
+        self.preference_expiration = preference_expiration
+        self.aggregate_items = aggregate_items
+        self.max_items = max_items
+        self.preference_cache = None
+        if preference_cache_ttl:
+            self.preference_cache = PreferenceCache(
+                preference_cache_ttl, preference_cache_alias)
+        self.status_cache = None
+        if status_cache_ttl:
+            self.status_cache = StatusCache(
+                status_cache_ttl, status_cache_alias, http_timeout)
+        self.extra_data_mode = extra_data_mode
+        self.archive_responses = archive_responses
+        self.compress_archive = compress_archive
+        self.metrics = None
+        if metrics_backend:
+            self.metrics = get_metrics_backend(metrics_backend)
+        self.dedicated_webhook = dedicated_webhook
+        self.confirm_on_return = confirm_on_return
+        self.webhook_secret = webhook_secret
+        self.operation_timeouts = operation_timeouts or {}
+        self.retry = Retry(retries, retry_backoff)
+        account = 'mercadopago-%s' % hashlib.sha256(
+            (access_token or client_id).encode('utf-8')).hexdigest()[:12]
+        self.circuit_breaker = None
+        if circuit_breaker_threshold:
+            self.circuit_breaker = get_circuit_breaker(
+                account, failure_threshold=circuit_breaker_threshold,
+                recovery_timeout=circuit_breaker_timeout,
+                cache_alias=circuit_breaker_cache)
+        self.status_broker = None
+        if status_stream:
+            self.status_broker = get_status_broker(status_stream_cache)
+        self.rate_limits = None
+        if rate_limits:
+            self.rate_limits = get_rate_limits(
+                account, rate_limits, cache_alias=rate_limit_cache,
+                max_wait=rate_limit_wait, reserve=rate_limit_reserve)
         super(MercadoPagoProvider, self).__init__(**kwargs)
 
-    def get_form(self, payment: BasePayment) -> None:
-        if not payment.id:
-            payment.save()
-        payment_data = self.create_payment(payment)
-        redirect_to = self.get_value_from_response(
-            payment_data, self.init_point)
-        payment.change_status(PaymentStatus.WAITING)
-        raise RedirectNeeded(redirect_to)
+    def get_form(self, payment: 'BasePayment', data=None):
+        with self.instrument('get_form', outbound=False):
+            if not payment.id:
+                payment.save()
+            if self.direct_payments:
+                return self.get_card_form(payment, data)
+            payment_data = self.create_payment(payment)
+            redirect_to = self.get_value_from_response(
+                payment_data, self.init_point)
+            payment.change_status(PaymentStatus.WAITING)
+            # Restart the expiry of the checkout the buyer is sent to
+            touch(payment)
+            raise RedirectNeeded(redirect_to)
+
+    def get_card_form(self, payment: 'BasePayment', data=None):
+        from .forms import CardTokenForm
+
+        form = CardTokenForm(data=data, payment=payment, provider=self)
+        if form.is_valid():
+            if payment.status == PaymentStatus.CONFIRMED:
+                raise RedirectNeeded(payment.get_success_url())
+            raise RedirectNeeded(payment.get_failure_url())
+        return form
+
+    def instrument(self, operation: str, outbound: bool = True):
+        return instrument(type(self), self.metrics, operation, outbound)
+
+    def check_circuit(self) -> None:
+        if self.circuit_breaker and not self.circuit_breaker.allow():
+            raise PaymentError(_('MercadoPago is unavailable, try again later'),
+                               code=503)
+
+    def release_circuit(self) -> None:
+        if self.circuit_breaker:
+            self.circuit_breaker.release()
+
+    def check_rate_limit(self, operation: str) -> None:
+        if self.rate_limits and not self.rate_limits.wait(operation):
+            raise PaymentError(
+                _('MercadoPago rate limit exceeded, try again later'),
+                code=429)
+
+    def record_rate_limited(self, operation: str, status_code: Optional[int]) -> None:
+        if self.rate_limits and status_code == 429:
+            # Make every process sharing the bucket back off
+            self.rate_limits.exhaust(operation)
+
+    def record_outcome(self, status_code: Optional[int]) -> None:
+        if not self.circuit_breaker:
+            return
+        if is_server_error(status_code):
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+    def for_payment(self, payment: 'BasePayment') -> 'MercadoPagoProvider':
+        """Return the provider of the account ``payment`` belongs to."""
+        return self
+
+    def get_access_token(self) -> str:
+        if self.token_manager:
+            return self.token_manager.get_token()
+        return self.access_token
+
+    @property
+    def mp(self):
+        """The SDK client, when the SDK transport is used."""
+        return self.transport.mp
 
-    def create_payment(self, payment: BasePayment) -> dict:
+    def call_api(self, operation: str, *args, **kwargs) -> dict:
+        attempts = self.retry.get_attempts(operation)
+        for attempt in range(attempts):
+            self.check_circuit()
+            try:
+                self.check_rate_limit(operation)
+                response = error = None
+                try:
+                    with request_timeout(
+                            self.operation_timeouts.get(operation)):
+                        with self.instrument(operation) as call:
+                            response = getattr(self.transport, operation)(
+                                *args, **kwargs)
+                            call['status_code'] = response.get('status')
+                except RequestException as exception:
+                    error = exception
+            except BaseException:
+                # No outcome to record, let another call be the trial
+                self.release_circuit()
+                raise
+            status_code = response['status'] if response is not None else None
+            self.record_outcome(status_code)
+            self.record_rate_limited(operation, status_code)
+            if status_code == 401 and self.token_manager:
+                # Revoked before it expired, the next call gets a new one
+                self.token_manager.invalidate(self.get_access_token())
+            if not is_retryable(status_code) or attempt + 1 == attempts:
+                break
+            time.sleep(self.retry.get_delay(attempt))
+        if error is not None:
+            logger.warning('MercadoPago %s failed: %s', operation, error)
+            raise PaymentError(str(error), code=502)
+        return response
+
+    def create_payment(self, payment: 'BasePayment') -> dict:
         preference = self.create_preference_data(payment)
-        preferenceResult = self.mp.create_preference(preference)
-        payment.extra_data = json.dumps(preferenceResult)
+        cachedResult = self.get_cached_preference(payment, preference)
+        if cachedResult:
+            return cachedResult
+        preferenceResult = self.call_api('create_preference', preference)
+        return self.handle_preference_result(
+            payment, preference, preferenceResult)
+
+    def get_cached_preference(self, payment: 'BasePayment', preference: dict) -> Optional[dict]:
+        if not self.preference_cache:
+            return None
+        return self.preference_cache.get(
+            payment.token, self.preference_cache.get_hash(preference))
+
+    def handle_preference_result(self, payment: 'BasePayment', preference: dict,
+                                 preferenceResult: dict) -> dict:
+        self.store_response(payment, 'preference', preferenceResult)
         if 200 <= preferenceResult['status'] <= 201:
+            if self.preference_cache:
+                ttl = None
+                if self.preference_expiration:
+                    # Leave the buyer at least half of the expiration to pay
+                    ttl = min(self.preference_cache.ttl,
+                              max(1, self.preference_expiration // 2))
+                self.preference_cache.set(
+                    payment.token, self.preference_cache.get_hash(preference),
+                    preferenceResult, ttl)
             return preferenceResult
-        message = self.get_value_from_response(preferenceResult, 'message')
-        logger.warning(message, extra={"response": preferenceResult})
-        raise PaymentError(message)
+        self.raise_payment_error(preferenceResult)
+
+    def create_direct_payment_data(self, payment: 'BasePayment', card: dict) -> dict:
+        payer = {'email': card.get('email') or payment.billing_email}
+        if card.get('identification_type') and card.get(
+                'identification_number'):
+            payer['identification'] = {
+                'type': card['identification_type'],
+                'number': card['identification_number']}
+        paymentData = {
+            'transaction_amount': float(payment.total.quantize(
+                CENTS, rounding=ROUND_HALF_UP)),
+            'token': card['token'],
+            'description': payment.description,
+            'installments': card['installments'],
+            'payment_method_id': card['payment_method_id'],
+            'payer': payer,
+            'external_reference': str(payment.token),
+            'notification_url': self.create_notification_url(payment),
+        }
+        if card.get('issuer_id'):
+            paymentData['issuer_id'] = card['issuer_id']
+        return paymentData
+
+    def create_direct_payment(self, payment: 'BasePayment', card: dict) -> dict:
+        """Pay with a card token and update the status from the answer.
+
+        The idempotency key is derived from the payment and the single use
+        card token, so a resubmitted form cannot charge the card twice.
+        """
+        idempotency_key = hashlib.sha256(('payment:%s:%s' % (
+            payment.token, card['token'])).encode('utf-8')).hexdigest()
+        with request_headers(self.get_idempotency_headers(idempotency_key)):
+            paymentResult = self.call_api(
+                'create_payment', self.create_direct_payment_data(
+                    payment, card))
+        if paymentResult['status'] not in (200, 201):
+            self.store_response(payment, 'payment', paymentResult)
+            self.raise_payment_error(paymentResult)
+        collection_id = self.get_value_from_response(paymentResult, 'id')
+        if self.status_cache:
+            self.status_cache.set(collection_id, paymentResult)
+        self.update_payment(payment, collection_id, paymentResult)
+        return paymentResult
+
+    def get_compact_response(self, response: dict) -> dict:
+        body = response.get('response') or {}
+        compact = {key: body[key] for key in COMPACT_RESPONSE_KEYS
+                   if key in body}
+        total_paid_amount = (body.get('transaction_details') or {}).get(
+            'total_paid_amount')
+        if total_paid_amount is not None:
+            compact['total_paid_amount'] = total_paid_amount
+        compact_response = {'status': response.get('status'),
+                            'response': compact}
+        if 'shard' in response:
+            compact_response['shard'] = response['shard']
+        return compact_response
+
+    def store_response(self, payment: 'BasePayment', event: str, response: dict) -> None:
+        if self.archive_responses:
+            from .models import MercadoPagoResponse
+
+            MercadoPagoResponse.build(
+                payment.token, event, response, self.compress_archive).save()
+        if self.extra_data_mode == 'compact':
+            response = self.get_compact_response(response)
+        if self.shard is not None:
+            response = dict(response, shard=self.shard)
+        payment.extra_data = json.dumps(response)
+
+    def raise_payment_error(self, response: dict) -> None:
+        message = self.get_value_from_response(response, 'message')
+        logger.warning(message, extra={"response": response})
+        status_code = response.get('status')
+        code = None
+        if status_code == 429 or (status_code or 0) >= 500:
+            code = status_code
+        raise PaymentError(message, code=code)
 
     def get_value_from_response(self, response, key) -> Any:
         return response.get('response', {}).get(key, {})
 
-    def create_notification_url(self, payment: BasePayment) -> str:
+    def create_notification_url(self, payment: 'BasePayment') -> str:
+        if self.dedicated_webhook:
+            return urljoin(get_base_url(), reverse(
+                'mercadopago_webhook',
+                kwargs={'variant': payment.variant, 'token': payment.token}))
         return urljoin(get_base_url(), reverse('process_payment',
                                                kwargs={"token": payment.token}))
 
-    def create_preference_data(self, payment: BasePayment) -> dict:
-        items = list(self.get_transactions_items(payment))
-        items.insert(
-            0, self.get_order_name_and_shipping_cost(payment))
+    def create_back_urls(self, payment: 'BasePayment') -> dict:
+        if self.confirm_on_return:
+            # MercadoPago appends the payment id and status to the redirect,
+            # the process url checks them before sending the customer on
+            return_url = urljoin(get_base_url(), reverse(
+                'process_payment', kwargs={'token': payment.token}))
+            return {'success': return_url, 'failure': return_url,
+                    'pending': return_url}
+        return {
+            # Localhost urls raise an error in payment in
+            # mercadopago website, even in sandbox mode
+            # When testing in localhost use Ngrok instead
+            "success": payment.get_success_url(),
+            "failure": payment.get_failure_url(),
+            "pending": payment.get_failure_url(),
+        }
+
+    def create_preference_data(self, payment: 'BasePayment') -> dict:
+        items = [self.get_order_name_and_shipping_cost(payment)]
+        if self.aggregate_items:
+            items.extend(self.get_aggregated_items(payment))
+        else:
+            items.extend(self.get_transactions_items(payment))
         delivery = payment.delivery.quantize(
             CENTS, rounding=ROUND_HALF_UP)
         full_name = payment.billing_first_name + " " \
@@ -84,32 +441,49 @@ class MercadoPagoProvider(BasicProvider):
                 },
             },
 
-            "back_urls": {
-                # Localhost urls raise an error in payment in
-                # mercadopago website, even in sandbox mode
-                # When testing in localhost use Ngrok instead
-                "success": payment.get_success_url(),
-                "failure": payment.get_failure_url(),
-                "pending": payment.get_failure_url(),
-            },
+            "back_urls": self.create_back_urls(payment),
             "auto_return": "approved",
             "notification_url": self.create_notification_url(payment),
             "external_reference": payment.token,
         }
+        preferenceData.update(self.get_preference_expiration())
         return preferenceData
 
-    def get_transactions_items(self, payment: BasePayment) -> dict:
+    def get_preference_expiration(self) -> dict:
+        if not self.preference_expiration:
+            return {}
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=self.preference_expiration)
+        return {
+            'expires': True,
+            'expiration_date_from': now.isoformat(timespec='milliseconds'),
+            'expiration_date_to': expires_at.isoformat(
+                timespec='milliseconds'),
+        }
+
+    def get_transactions_items(self, payment: 'BasePayment') -> dict:
         for purchased_item in payment.get_purchased_items():
             price = purchased_item.price.quantize(
                 CENTS, rounding=ROUND_HALF_UP)
+            quantity = purchased_item.quantity
+            if quantity != int(quantity):
+                # MercadoPago quantities are integers, send one unit of the line
+                price = (price * quantity).quantize(
+                    CENTS, rounding=ROUND_HALF_UP)
+                quantity = 1
             item = {'title': purchased_item.name[:127],
-                    'quantity': purchased_item.quantity,
+                    'quantity': int(quantity),
                     'unit_price': float(price),
                     'currency_id': purchased_item.currency,
                     'id': purchased_item.sku}
             yield item
 
-    def get_order_name_and_shipping_cost(self, payment: BasePayment) -> dict:
+    def get_aggregated_items(self, payment: 'BasePayment') -> list:
+        # The shipping line takes one of the max_items
+        max_items = self.max_items - 1 if self.max_items else None
+        return aggregate_items(payment.get_purchased_items(), max_items)
+
+    def get_order_name_and_shipping_cost(self, payment: 'BasePayment') -> dict:
         item = {'title': payment.description + _(' and shipping'),
                 'quantity': 1,
                 'unit_price': float(payment.delivery),
@@ -118,54 +492,355 @@ class MercadoPagoProvider(BasicProvider):
                 }
         return item
 
-    def process_payment_data_received(self, payment: BasePayment, collection_id: int) -> dict:
+    def process_payment_data_received(self, payment: 'BasePayment', collection_id: int) -> dict:
+        warnings.warn(
+            'process_payment_data_received() is deprecated, use '
+            'get_payment_information() and update_payment() instead.',
+            DeprecationWarning, stacklevel=2)
         payment_information = self.get_payment_information(collection_id)
-        payment.transaction_id = collection_id
-        payment.extra_data = json.dumps(payment_information)
+        self.store_payment_information(
+            payment, collection_id, payment_information)
         return payment_information
 
-    def set_payment_status(self, payment: BasePayment, payment_status:str) -> None:
+    def store_payment_information(self, payment: 'BasePayment', collection_id: int,
+                                  payment_information: dict) -> None:
+        payment.transaction_id = collection_id
+        self.store_response(payment, 'payment', payment_information)
+
+    def get_payment_status(self, payment_status: str) -> str:
         if payment_status == 'approved':
+            return PaymentStatus.CONFIRMED
+        return PaymentStatus.WAITING
+
+    def set_payment_status(self, payment: 'BasePayment', payment_status:str) -> None:
+        status = self.get_payment_status(payment_status)
+        if can_transition(payment):
+            fields = {'transaction_id': payment.transaction_id,
+                      'extra_data': payment.extra_data}
+            if status == PaymentStatus.CONFIRMED:
+                fields['captured_amount'] = payment.total
+            transition(payment, status, fields)
+            return
+        if status == PaymentStatus.CONFIRMED:
             payment.captured_amount = payment.total
-            payment.change_status(PaymentStatus.CONFIRMED)
-        else:
-            payment.change_status(PaymentStatus.WAITING)
+        if status != payment.status:
+            payment.change_status(status)
+
+    def update_payment(self, payment: 'BasePayment', collection_id: int,
+                       payment_information: dict) -> None:
+        order_id = self.get_split_order_id(payment, payment_information)
+        if order_id is not None:
+            # One part of a split purchase, settle from the whole order
+            self.settle_merchant_order(
+                payment, self.get_merchant_order_information(order_id))
+            return
+        self.store_payment_information(
+            payment, collection_id, payment_information)
+        self.set_payment_status(payment, self.get_value_from_response(
+            payment_information, "status"))
+
+    def handle_payment_notification(self, payment: 'BasePayment', collection_id: int,
+                                    notification_status: str = None,
+                                    payment_information: dict = None) -> None:
+        try:
+            if payment_information is None:
+                payment_information = self.get_payment_information(
+                    collection_id)
+            self.update_payment(payment, collection_id, payment_information)
+        except Exception:
+            if self.notification_cache:
+                self.notification_cache.release(
+                    collection_id, notification_status)
+            raise
+        self.finish_notification(payment, collection_id, notification_status)
+
+    def finish_notification(self, payment: 'BasePayment', notification_id: str,
+                            notification_status: str) -> None:
+        """Keep the claim of a notification only once it is settled."""
+        if not self.notification_cache:
+            return
+        if payment.status in PENDING_STATUSES:
+            # MercadoPago notifies the same id again when it is approved
+            self.notification_cache.release(
+                notification_id, notification_status)
+        elif payment.status != notification_status:
+            self.notification_cache.remember(notification_id, payment.status)
 
-    def process_data(self, payment: BasePayment, request: HttpRequest) -> HttpResponse:
+    def get_notification_id(self, request: HttpRequest) -> Optional[str]:
         if all(['data.id' in request.GET, 'type' in request.GET, request.GET.get('type') == 'payment']):
-            collection_id = request.GET.get('data.id')
-            payment_information = self.process_payment_data_received(
-                payment, collection_id)
-            payment_status = self.get_value_from_response(
-                payment_information, "status")
-            self.set_payment_status(payment, payment_status)
+            return request.GET.get('data.id')
+        return None
+
+    def get_merchant_order_id(self, request: HttpRequest) -> Optional[str]:
+        topic = request.GET.get('topic') or request.GET.get('type')
+        if topic in MERCHANT_ORDER_TOPICS:
+            return request.GET.get('id') or request.GET.get('data.id')
+        return None
+
+    def process_data(self, payment: 'BasePayment', request: HttpRequest) -> HttpResponse:
+        with self.instrument('process_data', outbound=False) as call:
+            response = self.handle_notification(payment, request)
+            call['status_code'] = response.status_code
+        return response
+
+    def handle_notification(self, payment: 'BasePayment', request: HttpRequest) -> HttpResponse:
+        if self.confirm_on_return and self.is_return(request):
+            return self.handle_return(payment, request)
+        collection_id = self.get_notification_id(request)
+        if collection_id:
+            self.process_notification(payment, collection_id)
+        order_id = self.get_merchant_order_id(request)
+        if order_id:
+            self.process_merchant_order(payment, order_id)
         return HttpResponse(status=200)
 
-    def get_payment_information(self, payment_id: int) -> dict:
-        paymentInfo = self.mp.get_payment(payment_id)
+    def is_return(self, request: HttpRequest) -> bool:
+        return ('external_reference' in request.GET
+                and self.get_notification_id(request) is None
+                and self.get_merchant_order_id(request) is None)
+
+    def handle_return(self, payment: 'BasePayment', request: HttpRequest) -> HttpResponse:
+        """Confirm ``payment`` with the data of the back_url redirect."""
+        collection_id = request.GET.get('payment_id') or request.GET.get(
+            'collection_id')
+        if (not collection_id or not collection_id.isdigit()
+                or request.GET['external_reference'] != str(payment.token)):
+            # The customer went back without paying
+            return redirect(payment.get_failure_url())
+        try:
+            payment_information = self.get_payment_information(
+                collection_id, cached=True)
+            returned_status = request.GET.get('status') or request.GET.get(
+                'collection_status')
+            if self.status_cache and returned_status != \
+                    self.get_value_from_response(payment_information, 'status'):
+                # The cached copy predates the redirect
+                payment_information = self.get_payment_information(
+                    collection_id)
+            reference = self.get_value_from_response(
+                payment_information, 'external_reference')
+            if str(reference) != str(payment.token):
+                logger.warning('MercadoPago payment %s belongs to %s',
+                               collection_id, reference,
+                               extra={'payment': payment.token})
+                return redirect(payment.get_failure_url())
+            self.update_payment(payment, collection_id, payment_information)
+        except PaymentError:
+            # The notification will update the payment later
+            return redirect(payment.get_failure_url())
+        if payment.status == PaymentStatus.CONFIRMED:
+            return redirect(payment.get_success_url())
+        return redirect(payment.get_failure_url())
+
+    def process_notification(self, payment: 'BasePayment', collection_id: int,
+                             payment_information: dict = None) -> None:
+        notification_status = payment.status
+        if self.notification_cache and not self.notification_cache.claim(
+                collection_id, notification_status):
+            return
+        if self.async_webhooks and self.webhook_queue.submit(
+                self.handle_payment_notification, payment, collection_id,
+                notification_status, payment_information):
+            # Acknowledge right away, MercadoPago retries slow responses
+            logger.info('Queued MercadoPago notification',
+                        extra={'payment': payment.token,
+                               'collection_id': collection_id})
+        else:
+            self.handle_payment_notification(
+                payment, collection_id, notification_status,
+                payment_information)
+
+    def process_merchant_order(self, payment: 'BasePayment', order_id: int,
+                               order_information: dict = None) -> None:
+        notification_status = payment.status
+        notification_id = 'merchant_order:%s' % order_id
+        if self.notification_cache and not self.notification_cache.claim(
+                notification_id, notification_status):
+            return
+        if self.async_webhooks and self.webhook_queue.submit(
+                self.handle_merchant_order_notification, payment, order_id,
+                notification_status, order_information):
+            logger.info('Queued MercadoPago notification',
+                        extra={'payment': payment.token,
+                               'merchant_order': order_id})
+        else:
+            self.handle_merchant_order_notification(
+                payment, order_id, notification_status, order_information)
+
+    def handle_merchant_order_notification(self, payment: 'BasePayment', order_id: int,
+                                           notification_status: str = None,
+                                           order_information: dict = None) -> None:
+        try:
+            if order_information is None:
+                order_information = self.get_merchant_order_information(
+                    order_id)
+            self.settle_merchant_order(payment, order_information)
+        except Exception:
+            if self.notification_cache:
+                self.notification_cache.release(
+                    'merchant_order:%s' % order_id, notification_status)
+            raise
+        self.finish_notification(
+            payment, 'merchant_order:%s' % order_id, notification_status)
+
+    def get_split_order_id(self, payment: 'BasePayment',
+                           payment_information: dict) -> Optional[str]:
+        """The merchant order of an approved payment paying part of ``payment``.
+
+        That is the case when the payment was already updated from its
+        merchant order, or when the approved amount is below the total.
+        """
+        info = payment_information.get('response') or {}
+        if info.get('status') != 'approved' or \
+                payment.status == PaymentStatus.CONFIRMED:
+            return None
+        order_id = (info.get('order') or {}).get('id')
+        try:
+            stored = json.loads(payment.extra_data or '{}').get('response')
+        except (AttributeError, ValueError):
+            stored = None
+        if isinstance(stored, dict) and 'total_amount' in stored:
+            return order_id or stored.get('id')
+        amount = info.get('transaction_amount')
+        if amount is not None and Decimal(str(amount)) < payment.total:
+            return order_id
+        return None
+
+    def get_merchant_order_information(self, order_id: int) -> dict:
+        orderInfo = self.call_api('get_merchant_order', order_id)
+        if orderInfo['status'] == 200:
+            return orderInfo
+        self.raise_payment_error(orderInfo)
+
+    def get_paid_amount(self, order: dict) -> Decimal:
+        return sum((Decimal(str(item.get('transaction_amount') or 0))
+                    for item in order.get('payments') or []
+                    if item.get('status') == 'approved'), Decimal(0))
+
+    def settle_merchant_order(self, payment: 'BasePayment', order_information: dict) -> None:
+        """Update ``payment`` from all the payments of its merchant order.
+
+        The payment is confirmed once the approved payments cover the order
+        total. Their statuses are stored in the status cache, so the payment
+        notifications that follow are answered without fetching them.
+        """
+        order = order_information.get('response') or {}
+        reference = order.get('external_reference')
+        if str(reference) != str(payment.token):
+            logger.warning('MercadoPago merchant order %s belongs to %s',
+                           order.get('id'), reference,
+                           extra={'payment': payment.token})
+            return
+        payments = order.get('payments') or []
+        approved = [item for item in payments
+                    if item.get('status') == 'approved']
+        total_amount = Decimal(str(order.get('total_amount') or payment.total))
+        settled = bool(approved) and \
+            self.get_paid_amount(order) >= total_amount
+        if self.status_cache:
+            for item in payments:
+                self.status_cache.set(
+                    item['id'],
+                    {'status': 200,
+                     'response': dict(item, external_reference=reference)},
+                    settled=settled and item in approved)
+        if payments:
+            payment.transaction_id = (approved or payments)[-1]['id']
+        self.store_response(payment, 'merchant_order', order_information)
+        self.set_payment_status(
+            payment, 'approved' if settled else 'pending')
+
+    def verify_signature(self, request: HttpRequest, resource_id: str) -> bool:
+        """Check the ``x-signature`` header MercadoPago signs webhooks with."""
+        if not self.webhook_secret:
+            return True
+        parts = dict(part.strip().split('=', 1)
+                     for part in request.headers.get('x-signature', '').split(',')
+                     if '=' in part)
+        if 'ts' not in parts or 'v1' not in parts:
+            return False
+        manifest = 'id:%s;request-id:%s;ts:%s;' % (
+            resource_id.lower() if resource_id.isalnum() else resource_id,
+            request.headers.get('x-request-id', ''), parts['ts'])
+        expected = hmac.new(self.webhook_secret.encode('utf-8'),
+                            manifest.encode('utf-8'),
+                            hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, parts['v1'])
+
+    def get_payment_information(self, payment_id: int, cached: bool = False) -> dict:
+        """Fetch a payment, through the status cache when it is enabled.
+
+        Notifications fetch a fresh status while confirmation and polling
+        paths pass ``cached=True`` to accept the one stored by them.
+        """
+        if not self.status_cache:
+            return self.fetch_payment_information(payment_id)
+        return self.status_cache.fetch(
+            payment_id, lambda: self.fetch_payment_information(payment_id),
+            since=None if cached else time.time())
+
+    def fetch_payment_information(self, payment_id: int) -> dict:
+        paymentInfo = self.call_api('get_payment', payment_id)
+        return self.handle_payment_information(paymentInfo)
+
+    def handle_payment_information(self, paymentInfo: dict) -> dict:
         if paymentInfo["status"] == 200:
             return paymentInfo
-        message = self.get_value_from_response(paymentInfo, 'message')
-        logger.warning(message, extra={"response": paymentInfo})
-        raise PaymentError(message)
-
-    def refund(self, payment: BasePayment, amount=None) -> Decimal:
-        amount = payment.captured_amount
-        # MercadoPago Official Python SDK doesn't support partial refunds
-        # Arg: amount is keeped for future releases
-        refundResult = self.mp.refund_payment(payment.transaction_id)
-        payment.extra_data = json.dumps(refundResult)
+        self.raise_payment_error(paymentInfo)
+
+    def search_payment_by_reference(self, external_reference: str) -> Optional[dict]:
+        searchResult = self.call_api('search_payment', {
+            'external_reference': external_reference,
+            'sort': 'date_created',
+            'criteria': 'desc'}, limit=10)
+        if searchResult['status'] != 200:
+            self.raise_payment_error(searchResult)
+        results = self.get_value_from_response(searchResult, 'results')
+        if not results:
+            return None
+        # A buyer may retry a rejected card, prefer the approved attempt
+        approved = [result for result in results
+                    if result.get('status') == 'approved']
+        return {'status': 200, 'response': (approved or results)[0]}
+
+    def get_refund_amount(self, payment: 'BasePayment', amount: Decimal = None) -> Decimal:
+        if amount is None or amount >= payment.captured_amount:
+            return payment.captured_amount
+        return amount.quantize(CENTS, rounding=ROUND_HALF_UP)
+
+    def get_idempotency_headers(self, idempotency_key: str = None) -> dict:
+        if not idempotency_key:
+            return {}
+        return {'X-Idempotency-Key': idempotency_key}
+
+    def refund(self, payment: 'BasePayment', amount=None,
+               idempotency_key: str = None) -> Decimal:
+        amount = self.get_refund_amount(payment, amount)
+        partial_amount = None
+        if amount != payment.captured_amount:
+            partial_amount = amount
+        with request_headers(self.get_idempotency_headers(idempotency_key)):
+            refundResult = self.call_api(
+                'refund_payment', payment.transaction_id, partial_amount)
+        return self.handle_refund_result(payment, refundResult, amount)
+
+    def handle_refund_result(self, payment: 'BasePayment', refundResult: dict,
+                             amount: Decimal) -> Decimal:
+        self.store_response(payment, 'refund', refundResult)
         if refundResult['status'] == 201:
-            payment.change_status(PaymentStatus.REFUNDED)
+            if amount >= payment.captured_amount:
+                payment.change_status(PaymentStatus.REFUNDED)
             return amount
-        message = self.get_value_from_response(refundResult, 'message')
-        raise PaymentError(message)
+        self.raise_payment_error(refundResult)
+
+    def cancel(self, payment: 'BasePayment') -> None:
+        cancelationResult = self.call_api(
+            'cancel_payment', payment.transaction_id)
+        self.handle_cancel_result(payment, cancelationResult)
 
-    def cancel(self, payment: BasePayment) -> None:
-        cancelationResult = self.mp.cancel_payment(payment.transaction_id)
-        payment.extra_data = json.dumps(cancelationResult)
+    def handle_cancel_result(self, payment: 'BasePayment', cancelationResult: dict) -> None:
+        self.store_response(payment, 'cancel', cancelationResult)
         if cancelationResult['status'] == 200:
             payment.change_status(PaymentStatus.REJECTED)
-        message = self.get_value_from_response(cancelationResult, 'message')
-        logger.warning(message, extra={"response": cancelationResult})
-        raise PaymentError(message)
+            return
+        self.raise_payment_error(cancelationResult)
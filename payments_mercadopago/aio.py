@@ -0,0 +1,286 @@
+"""Non-blocking MercadoPago provider for ASGI deployments.
+
+Requires ``httpx``, install it with ``pip install django-payments-mercadopago[async]``,
+and Django 3.1 or later for the async views.
+"""
+import asyncio
+import json
+import logging
+import time
+import weakref
+from decimal import Decimal
+from typing import Optional
+from urllib.parse import urljoin
+try:
+    from asyncio import get_running_loop
+except ImportError:
+    # Python 3.6, the loop running the calling coroutine
+    from asyncio import get_event_loop as get_running_loop
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpRequest, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.translation import gettext as _
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from payments import PaymentError, PaymentStatus, RedirectNeeded, get_payment_model
+from payments.core import get_base_url, provider_factory
+
+from . import MercadoPagoProvider
+from .client import API_BASE_URL
+from .ratelimit import is_low_priority
+from .resilience import is_retryable
+
+
+logger = logging.getLogger(__name__)
+
+# Pooled connections belong to the event loop that opened them
+_clients = weakref.WeakKeyDictionary()
+
+
+def encode_decimal(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def get_async_client(pool_size: int = 10, timeout: float = 30,
+                     api_base_url: str = API_BASE_URL) -> 'httpx.AsyncClient':
+    """Return the ``httpx.AsyncClient`` shared by the running event loop."""
+    loop_clients = _clients.setdefault(get_running_loop(), {})
+    client = loop_clients.get(api_base_url)
+    if client is None:
+        client = httpx.AsyncClient(
+            base_url=api_base_url, timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size,
+                                max_keepalive_connections=pool_size))
+        loop_clients[api_base_url] = client
+    return client
+
+
+class AsyncMercadoPagoProvider(MercadoPagoProvider):
+    """MercadoPago provider whose outbound calls do not block the event loop.
+
+    The ``a``-prefixed coroutines mirror the synchronous methods, which stay
+    available for the django-payments views.
+    """
+
+    def __init__(self, access_token: str = None, sandbox_mode: bool = False,
+                 http_pool_size: int = 10, http_timeout: float = 30,
+                 **kwargs) -> None:
+        if httpx is None:
+            raise ImproperlyConfigured(
+                'AsyncMercadoPagoProvider requires httpx, install '
+                'django-payments-mercadopago[async].')
+        self.http_pool_size = http_pool_size
+        self.http_timeout = http_timeout
+        super(AsyncMercadoPagoProvider, self).__init__(
+            access_token, sandbox_mode, http_pool_size=http_pool_size,
+            http_timeout=http_timeout, **kwargs)
+
+    def get_http_client(self) -> 'httpx.AsyncClient':
+        return get_async_client(self.http_pool_size, self.http_timeout,
+                                self.api_base_url)
+
+    def create_notification_url(self, payment) -> str:
+        if self.dedicated_webhook:
+            return super(AsyncMercadoPagoProvider,
+                         self).create_notification_url(payment)
+        return urljoin(get_base_url(), reverse(
+            'mercadopago_async_process_payment',
+            kwargs={'token': payment.token}))
+
+    # Circuits and rate limits may live in a network cache, their calls run
+    # in a thread instead of blocking the event loop
+
+    async def acheck_circuit(self) -> None:
+        if self.circuit_breaker:
+            await sync_to_async(self.check_circuit)()
+
+    async def arelease_circuit(self) -> None:
+        if self.circuit_breaker:
+            await sync_to_async(self.release_circuit)()
+
+    def record_response(self, operation: str, status_code: Optional[int]) -> None:
+        self.record_outcome(status_code)
+        self.record_rate_limited(operation, status_code)
+
+    async def arecord_response(self, operation: str, status_code: Optional[int]) -> None:
+        if self.circuit_breaker or self.rate_limits:
+            await sync_to_async(self.record_response)(operation, status_code)
+
+    async def acheck_rate_limit(self, operation: str) -> None:
+        if not self.rate_limits:
+            return
+        # The priority is read here, the worker thread does not share it
+        low_priority = is_low_priority()
+        deadline = time.monotonic() + self.rate_limits.get_max_wait()
+        while True:
+            delay = await sync_to_async(self.rate_limits.get_delay)(
+                operation, low_priority)
+            if not delay:
+                return
+            if time.monotonic() + delay > deadline:
+                raise PaymentError(
+                    _('MercadoPago rate limit exceeded, try again later'),
+                    code=429)
+            await asyncio.sleep(delay)
+
+    async def request(self, operation: str, method: str, uri: str,
+                      data: dict = None, headers: dict = None) -> dict:
+        content = None
+        if data is not None:
+            content = json.dumps(data, default=encode_decimal)
+        timeout = self.operation_timeouts.get(
+            operation, httpx.USE_CLIENT_DEFAULT)
+        attempts = self.retry.get_attempts(operation)
+        for attempt in range(attempts):
+            await self.acheck_circuit()
+            try:
+                await self.acheck_rate_limit(operation)
+                access_token = self.access_token
+                if self.token_manager:
+                    access_token = await sync_to_async(
+                        self.token_manager.get_token)()
+                response = error = None
+                try:
+                    with self.instrument(operation) as call:
+                        response = await self.get_http_client().request(
+                            method, uri, content=content, timeout=timeout,
+                            headers=dict(headers or {}, **{
+                                'Authorization': 'Bearer %s' % access_token,
+                                'Content-Type': 'application/json'}))
+                        call['status_code'] = response.status_code
+                except httpx.HTTPError as exception:
+                    error = exception
+            except BaseException:
+                # No outcome to record, let another call be the trial
+                await self.arelease_circuit()
+                raise
+            status_code = response.status_code if response is not None else None
+            await self.arecord_response(operation, status_code)
+            if status_code == 401 and self.token_manager:
+                await sync_to_async(self.token_manager.invalidate)(
+                    access_token)
+            if not is_retryable(status_code) or attempt + 1 == attempts:
+                break
+            await asyncio.sleep(self.retry.get_delay(attempt))
+        if error is not None:
+            logger.warning('MercadoPago %s failed: %s', operation, error)
+            raise PaymentError(str(error), code=502)
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        return {'status': response.status_code, 'response': body}
+
+    async def aget_form(self, payment) -> None:
+        with self.instrument('get_form', outbound=False):
+            if not payment.id:
+                await sync_to_async(payment.save)()
+            payment_data = await self.acreate_payment(payment)
+            redirect_to = self.get_value_from_response(
+                payment_data, self.init_point)
+            await sync_to_async(payment.change_status)(PaymentStatus.WAITING)
+            raise RedirectNeeded(redirect_to)
+
+    async def acreate_payment(self, payment) -> dict:
+        preference = await sync_to_async(self.create_preference_data)(payment)
+        cachedResult = await sync_to_async(self.get_cached_preference)(
+            payment, preference)
+        if cachedResult:
+            return cachedResult
+        preferenceResult = await self.request(
+            'create_preference', 'POST', '/checkout/preferences', preference)
+        return await sync_to_async(self.handle_preference_result)(
+            payment, preference, preferenceResult)
+
+    async def aget_payment_information(self, payment_id: int,
+                                       cached: bool = False) -> dict:
+        if self.status_cache and cached:
+            paymentInfo = await sync_to_async(self.status_cache.get)(
+                payment_id)
+            if paymentInfo is not None:
+                return paymentInfo
+        elif self.status_cache:
+            # Only entries settled by a merchant order are this fresh
+            paymentInfo = await sync_to_async(self.status_cache.get)(
+                payment_id, time.time())
+            if paymentInfo is not None:
+                return paymentInfo
+        paymentInfo = self.handle_payment_information(await self.request(
+            'get_payment', 'GET', '/v1/payments/%s' % payment_id))
+        if self.status_cache:
+            await sync_to_async(self.status_cache.set)(payment_id, paymentInfo)
+        return paymentInfo
+
+    async def aprocess_data(self, payment, request: HttpRequest) -> HttpResponse:
+        with self.instrument('process_data', outbound=False) as call:
+            response = await self.ahandle_notification(payment, request)
+            call['status_code'] = response.status_code
+        return response
+
+    async def ahandle_notification(self, payment, request: HttpRequest) -> HttpResponse:
+        collection_id = self.get_notification_id(request)
+        order_id = self.get_merchant_order_id(request)
+        if order_id:
+            await sync_to_async(self.process_merchant_order)(payment, order_id)
+        if not collection_id:
+            return HttpResponse(status=200)
+        notification_status = payment.status
+        if self.notification_cache and not await sync_to_async(
+                self.notification_cache.claim)(collection_id,
+                                               notification_status):
+            return HttpResponse(status=200)
+        try:
+            payment_information = await self.aget_payment_information(
+                collection_id)
+            await sync_to_async(self.update_payment)(
+                payment, collection_id, payment_information)
+        except Exception:
+            if self.notification_cache:
+                await sync_to_async(self.notification_cache.release)(
+                    collection_id, notification_status)
+            raise
+        await sync_to_async(self.finish_notification)(
+            payment, collection_id, notification_status)
+        return HttpResponse(status=200)
+
+    async def arefund(self, payment, amount=None,
+                      idempotency_key: str = None) -> Decimal:
+        amount = self.get_refund_amount(payment, amount)
+        data = {}
+        if amount != payment.captured_amount:
+            data['amount'] = amount
+        refundResult = await self.request(
+            'refund_payment', 'POST', '/v1/payments/%s/refunds' % payment.transaction_id,
+            data, self.get_idempotency_headers(idempotency_key))
+        return await sync_to_async(self.handle_refund_result)(
+            payment, refundResult, amount)
+
+    async def acancel(self, payment) -> None:
+        cancelationResult = await self.request(
+            'cancel_payment', 'PUT', '/v1/payments/%s' % payment.transaction_id,
+            {'status': 'cancelled'})
+        await sync_to_async(self.handle_cancel_result)(
+            payment, cancelationResult)
+
+
+async def process_data(request: HttpRequest, token: str) -> HttpResponse:
+    """Async counterpart of the django-payments ``process_payment`` view."""
+    Payment = get_payment_model()
+    payment = await sync_to_async(get_object_or_404)(Payment, token=token)
+    provider = await sync_to_async(provider_factory)(payment.variant)
+    if isinstance(provider, AsyncMercadoPagoProvider):
+        return await provider.aprocess_data(payment, request)
+    return await sync_to_async(provider.process_data)(payment, request)
+
+
+# csrf_exempt only keeps views asynchronous since Django 5.0
+process_data.csrf_exempt = True
@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+
+
+class PaymentsMercadoPagoConfig(AppConfig):
+    name = 'payments_mercadopago'
+    verbose_name = 'MercadoPago payments'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from payments.signals import status_changed
+
+        from .streams import publish_status
+
+        status_changed.connect(
+            publish_status, dispatch_uid='payments_mercadopago.streams')
@@ -0,0 +1,108 @@
+"""Helpers shared by the management commands that process many payments."""
+import json
+import os
+import threading
+from time import monotonic, sleep
+from typing import Iterator, List, Optional
+
+from django.conf import settings
+from django.db.models import QuerySet
+from django.utils.module_loading import import_string
+
+
+def get_mercadopago_variants() -> List[str]:
+    """Return the names of the variants served by a MercadoPago provider."""
+    from . import MercadoPagoProvider
+
+    variants = []
+    for variant, (handler, config) in getattr(
+            settings, 'PAYMENT_VARIANTS', {}).items():
+        try:
+            provider_class = import_string(handler)
+        except ImportError:
+            continue
+        if isinstance(provider_class, type) and issubclass(
+                provider_class, MercadoPagoProvider):
+            variants.append(variant)
+    return variants
+
+
+def iter_batches(queryset: QuerySet, batch_size: int,
+                 start_after=None) -> Iterator[list]:
+    """Yield ``queryset`` in primary key order, ``batch_size`` rows at a time.
+
+    Keyset pagination keeps every query on the primary key index and only a
+    single batch in memory.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = start_after
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        batch = list(page[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+class RateLimiter:
+    """Spaces calls so at most ``rate`` of them start per second."""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1.0 / rate if rate else 0
+        self._next = monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            sleep(start - now)
+
+
+class Checkpoint:
+    """Persist the progress of a command in a small JSON file.
+
+    A run that skips payments keeps the checkpoint before the first of them,
+    so the next run processes them again. A run that skips nothing removes
+    it and the next run starts from the beginning.
+    """
+
+    def __init__(self, path: Optional[str]) -> None:
+        self.path = path
+        self.held = False
+
+    def load(self) -> dict:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        with open(self.path) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def save(self, **state) -> None:
+        if not self.path:
+            return
+        temporary_path = '%s.tmp' % self.path
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(temporary_path, self.path)
+
+    def advance(self, batch: list, skipped=()) -> None:
+        """Save the last payment of ``batch`` before any skipped one."""
+        if self.held:
+            return
+        last_pk = None
+        for item in batch:
+            if item.pk in skipped:
+                self.held = True
+                break
+            last_pk = item.pk
+        if last_pk is not None:
+            self.save(last_pk=last_pk)
+
+    def finish(self) -> None:
+        if self.path and not self.held and os.path.exists(self.path):
+            os.remove(self.path)
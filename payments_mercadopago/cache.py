@@ -0,0 +1,219 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from django.core.cache import caches
+
+
+def incr(cache, key: str, delta: int = 1,
+         timeout: Optional[float] = None) -> int:
+    """Add ``delta`` to ``key``, creating it, and return the new value."""
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Evicted between add and incr
+        cache.set(key, delta, timeout)
+        return delta
+
+
+class NotificationCache:
+    """Remembers processed notifications to drop MercadoPago re-deliveries.
+
+    A notification is identified by its ``data.id`` and the status the
+    payment had when it arrived. The provider releases the claim when the
+    payment is still pending after the notification, since MercadoPago sends
+    the final status of the same id later, and remembers the new status when
+    the payment moved forward, so re-deliveries are skipped either way.
+    """
+    prefix = 'mercadopago:notification'
+
+    def __init__(self, ttl: int = 60, cache_alias: str = 'default') -> None:
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get_key(self, collection_id, status: str) -> str:
+        return '%s:%s:%s' % (self.prefix, collection_id, status)
+
+    def claim(self, collection_id, status: str) -> bool:
+        """Return ``True`` the first time a notification is seen."""
+        claimed = self.cache.add(
+            self.get_key(collection_id, status), 1, self.ttl)
+        self.increment('misses' if claimed else 'hits')
+        return claimed
+
+    def remember(self, collection_id, status: str) -> None:
+        """Mark a notification as seen without counting a miss."""
+        self.cache.add(self.get_key(collection_id, status), 1, self.ttl)
+
+    def release(self, collection_id, status: str) -> None:
+        """Forget a notification so its next delivery is processed."""
+        self.cache.delete(self.get_key(collection_id, status))
+
+    def increment(self, counter: str) -> None:
+        incr(self.cache, '%s:%s' % (self.prefix, counter))
+
+    def stats(self) -> dict:
+        hits = self.cache.get('%s:hits' % self.prefix, 0)
+        misses = self.cache.get('%s:misses' % self.prefix, 0)
+        return {'hits': hits, 'misses': misses}
+
+    def reset_stats(self) -> None:
+        self.cache.delete_many(['%s:hits' % self.prefix,
+                                '%s:misses' % self.prefix])
+
+
+class PreferenceCache:
+    """Reuses the checkout preference created for an unchanged payment.
+
+    Entries are keyed by payment token and store a hash of the preference
+    payload, so any change in items, amounts or billing data creates a new
+    preference on the next ``get_form``. The expiration dates, which change
+    on every call, are left out of the hash.
+    """
+    prefix = 'mercadopago:preference'
+    response_keys = ('id', 'init_point', 'sandbox_init_point')
+    volatile_keys = frozenset(['expiration_date_from', 'expiration_date_to'])
+
+    def __init__(self, ttl: int = 3600, cache_alias: str = 'default') -> None:
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get_key(self, token: str) -> str:
+        return '%s:%s' % (self.prefix, token)
+
+    def get_hash(self, preference: dict) -> str:
+        payload = json.dumps(
+            {key: value for key, value in preference.items()
+             if key not in self.volatile_keys},
+            sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, token: str, preference_hash: str) -> Optional[dict]:
+        entry = self.cache.get(self.get_key(token))
+        if entry and entry['hash'] == preference_hash:
+            return entry['result']
+        return None
+
+    def set(self, token: str, preference_hash: str, result: dict,
+            ttl: int = None) -> None:
+        response = result.get('response', {})
+        entry = {
+            'hash': preference_hash,
+            'result': {
+                'status': result['status'],
+                'response': {key: response[key]
+                             for key in self.response_keys
+                             if key in response},
+            },
+        }
+        self.cache.set(self.get_key(token), entry, ttl or self.ttl)
+
+    def delete(self, token: str) -> None:
+        self.cache.delete(self.get_key(token))
+
+
+class StatusCache:
+    """Short lived copy of the payment information fetched from MercadoPago.
+
+    Concurrent fetches of the same collection id are collapsed into one
+    request: inside a process the callers share a future, across processes
+    the first caller takes a lock in the cache and the others wait for the
+    response it stores. ``since`` rejects entries fetched before a given
+    time, webhooks use it to get a fresh status while still sharing the
+    request of simultaneous deliveries. Entries stored with ``settled``
+    come from a paid merchant order and are returned whatever ``since`` is.
+    """
+    prefix = 'mercadopago:status'
+    poll_interval = 0.05
+
+    def __init__(self, ttl: int = 10, cache_alias: str = 'default',
+                 lock_timeout: float = 10) -> None:
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+        self.lock_timeout = lock_timeout
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get_key(self, collection_id) -> str:
+        return '%s:%s' % (self.prefix, collection_id)
+
+    def get(self, collection_id, since: float = None) -> Optional[dict]:
+        entry = self.cache.get(self.get_key(collection_id))
+        if entry and (since is None or entry['fetched'] >= since
+                      or entry.get('settled')):
+            return entry['response']
+        return None
+
+    def set(self, collection_id, response: dict,
+            settled: bool = False) -> None:
+        self.cache.set(self.get_key(collection_id),
+                       {'fetched': time.time(), 'response': response,
+                        'settled': settled},
+                       self.ttl)
+
+    def delete(self, collection_id) -> None:
+        self.cache.delete(self.get_key(collection_id))
+
+    def fetch(self, collection_id, loader: Callable[[], dict],
+              since: float = None) -> dict:
+        """Return the cached response or the one ``loader`` returns."""
+        response = self.get(collection_id, since)
+        if response is not None:
+            return response
+        key = str(collection_id)
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            response = self.fetch_shared(collection_id, loader, since)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def fetch_shared(self, collection_id, loader: Callable[[], dict],
+                     since: float = None) -> dict:
+        lock_key = '%s:lock' % self.get_key(collection_id)
+        deadline = time.monotonic() + self.lock_timeout
+        while not self.cache.add(lock_key, 1, self.lock_timeout):
+            time.sleep(self.poll_interval)
+            response = self.get(collection_id, since)
+            if response is not None:
+                return response
+            if time.monotonic() > deadline:
+                # The holder died or is too slow, fetch without the lock
+                return self.load(collection_id, loader)
+        try:
+            return self.load(collection_id, loader)
+        finally:
+            self.cache.delete(lock_key)
+
+    def load(self, collection_id, loader: Callable[[], dict]) -> dict:
+        response = loader()
+        self.set(collection_id, response)
+        return response
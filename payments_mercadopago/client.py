@@ -0,0 +1,138 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Tuple, Union
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+if TYPE_CHECKING:
+    import mercadopago
+
+
+API_BASE_URL = 'https://api.mercadopago.com'
+
+Timeout = Union[float, Tuple[float, float]]
+
+_local = threading.local()
+
+
+@contextmanager
+def request_timeout(timeout: Timeout):
+    """Override the timeout of the requests made by this thread."""
+    previous = getattr(_local, 'timeout', None)
+    _local.timeout = timeout
+    try:
+        yield
+    finally:
+        _local.timeout = previous
+
+
+@contextmanager
+def request_headers(headers: dict):
+    """Add ``headers`` to the requests made by this thread."""
+    previous = getattr(_local, 'headers', None)
+    _local.headers = dict(previous or {}, **headers)
+    try:
+        yield
+    finally:
+        _local.headers = previous
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """Keep-alive adapter that applies a default timeout to every request.
+
+    It also adds the headers set with ``request_headers``, the SDK does not
+    let callers pass their own.
+    """
+
+    def __init__(self, timeout: Timeout = None, **kwargs) -> None:
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = getattr(_local, 'timeout', None) or self.timeout
+        headers = getattr(_local, 'headers', None)
+        if headers:
+            request.headers.update(headers)
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def create_session(pool_size: int = 10, timeout: Timeout = None) -> Session:
+    session = Session()
+    adapter = TimeoutHTTPAdapter(
+        timeout=timeout, pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_clients = {}
+_sessions = {}
+_clients_lock = threading.Lock()
+
+
+def get_session(pool_size: int = 10, timeout: Timeout = None) -> Session:
+    """Return the process-wide keep-alive session for direct API calls."""
+    key = (pool_size, timeout)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+    with _clients_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = create_session(pool_size, timeout)
+        return session
+
+
+def get_client(access_token: str, sandbox_mode: bool = False,
+               pool_size: int = 10, timeout: Timeout = None,
+               api_base_url: str = API_BASE_URL,
+               account: str = None) -> 'mercadopago.MP':
+    """Return the process-wide MercadoPago client for a set of credentials.
+
+    Clients are keyed by ``(account, sandbox_mode, api_base_url)``, where
+    ``account`` defaults to the access token. A new token for the same
+    account replaces the client, which keeps the pooled connections;
+    ``pool_size`` and ``timeout`` are applied when the account is first
+    seen.
+    """
+    key = (account or access_token, sandbox_mode, api_base_url)
+    entry = _clients.get(key)
+    if entry is not None and entry[0] == access_token:
+        return entry[1]
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None or entry[0] != access_token:
+            # Imported here, processes using another transport never load it
+            import mercadopago
+
+            client = mercadopago.MP(access_token)
+            client.sandbox_mode(sandbox_mode)
+            session = entry[2] if entry else create_session(pool_size, timeout)
+            # The SDK opens a new session, and connection, for each request
+            rest_client = client._MP__rest_client
+            rest_client.get_session = lambda: session
+            if api_base_url != API_BASE_URL:
+                rest_client._RestClient__API_BASE_URL = api_base_url.rstrip('/')
+            entry = _clients[key] = (access_token, client, session)
+        return entry[1]
+
+
+def clear_clients() -> None:
+    with _clients_lock:
+        _clients.clear()
+        _sessions.clear()
+
+
+def _reset_after_fork() -> None:
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    _clients.clear()
+    _sessions.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    # Pooled sockets must not be shared with forked workers
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,75 @@
+"""Close the waiting payments whose checkout preference expired."""
+from collections import Counter
+from datetime import datetime
+
+from django.db import connections, router, transaction
+from django.db.models import Q, QuerySet
+from django.utils import timezone
+
+from payments import PaymentStatus
+from payments.signals import status_changed
+
+from .bulk import iter_batches
+from .transitions import EXPIRED_MESSAGE
+
+
+class PaymentSweeper:
+    """Move abandoned waiting payments to ``status`` in small batches.
+
+    Only payments without a MercadoPago payment are swept, pending cash or
+    bank transfer payments are left to the notifications and reconciliation.
+    Each batch re-checks its rows under ``SELECT ... FOR UPDATE SKIP
+    LOCKED``, so rows a webhook is updating right then are skipped, and the
+    update of a batch is a single statement in a short transaction. The
+    payments keep ``EXPIRED_MESSAGE``, which lets a late approval confirm
+    them anyway.
+    """
+    message = EXPIRED_MESSAGE
+
+    def __init__(self, status: str = PaymentStatus.CANCELLED,
+                 dry_run: bool = False) -> None:
+        self.status = status
+        self.dry_run = dry_run
+        self.stats = Counter()
+
+    def get_queryset(self, queryset: QuerySet, cutoff: datetime) -> QuerySet:
+        return queryset.filter(
+            Q(transaction_id='') | Q(transaction_id__isnull=True),
+            status=PaymentStatus.WAITING, modified__lt=cutoff)
+
+    def sweep(self, queryset: QuerySet, cutoff: datetime,
+              batch_size: int = 500):
+        """Expire the payments of ``queryset`` untouched since ``cutoff``.
+
+        Yields the expired payments batch after batch.
+        """
+        queryset = self.get_queryset(queryset, cutoff)
+        for batch in iter_batches(queryset, batch_size):
+            self.stats['scanned'] += len(batch)
+            if self.dry_run:
+                self.stats['expired'] += len(batch)
+                yield from batch
+                continue
+            expired = self.expire(queryset, batch)
+            self.stats['expired'] += len(expired)
+            self.stats['skipped'] += len(batch) - len(expired)
+            yield from expired
+
+    def expire(self, queryset: QuerySet, batch: list) -> list:
+        database = router.db_for_write(queryset.model)
+        skip_locked = connections[
+            database].features.has_select_for_update_skip_locked
+        with transaction.atomic(using=database):
+            locked = set(queryset.filter(
+                pk__in=[payment.pk for payment in batch]).select_for_update(
+                    skip_locked=skip_locked).values_list('pk', flat=True))
+            if locked:
+                queryset.model._default_manager.filter(pk__in=locked).update(
+                    status=self.status, message=self.message,
+                    modified=timezone.now())
+        expired = [payment for payment in batch if payment.pk in locked]
+        for payment in expired:
+            payment.status = self.status
+            payment.message = self.message
+            status_changed.send(sender=type(payment), instance=payment)
+        return expired
@@ -0,0 +1,56 @@
+from django import forms
+from django.utils.translation import gettext_lazy as _
+
+from payments import PaymentError
+from payments.forms import PaymentForm
+
+
+MERCADOPAGO_JS_URL = 'https://sdk.mercadopago.com/js/v2'
+
+
+class CardTokenForm(PaymentForm):
+    """Pays with a card token created in the browser by MercadoPago.js.
+
+    Card data never reaches the server: the MercadoPago.js card form,
+    initialised with ``form.public_key``, fills the hidden fields below
+    and the payment is created when the form is validated.
+    """
+    token = forms.CharField(widget=forms.HiddenInput, max_length=64)
+    payment_method_id = forms.CharField(widget=forms.HiddenInput,
+                                        max_length=32)
+    installments = forms.IntegerField(widget=forms.HiddenInput, min_value=1,
+                                      initial=1)
+    issuer_id = forms.CharField(widget=forms.HiddenInput, required=False,
+                                max_length=32)
+    email = forms.EmailField(widget=forms.HiddenInput, required=False)
+    identification_type = forms.CharField(
+        widget=forms.HiddenInput, required=False, max_length=16)
+    identification_number = forms.CharField(
+        widget=forms.HiddenInput, required=False, max_length=32)
+
+    class Media:
+        js = (MERCADOPAGO_JS_URL,)
+
+    def __init__(self, data=None, action='', method='post', provider=None,
+                 payment=None, hidden_inputs=False, autosubmit=False) -> None:
+        super(CardTokenForm, self).__init__(
+            data=data, action=action, method=method, provider=provider,
+            payment=payment, hidden_inputs=False, autosubmit=autosubmit)
+        self.public_key = provider.public_key
+        self.payment_result = None
+
+    def clean(self):
+        data = super(CardTokenForm, self).clean()
+        if self.errors:
+            return data
+        try:
+            self.payment_result = self.provider.create_direct_payment(
+                self.payment, data)
+        except PaymentError as error:
+            raise forms.ValidationError(str(error))
+        response = self.payment_result.get('response', {})
+        if response.get('status') == 'rejected':
+            raise forms.ValidationError(
+                _('The payment was rejected (%(reason)s), try another card.'),
+                params={'reason': response.get('status_detail', '')})
+        return data
@@ -0,0 +1,86 @@
+"""Build compact item lists for the checkout preferences of large carts."""
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Iterable, List, Optional
+
+from django.utils.translation import gettext as _
+
+from payments import PurchasedItem
+
+
+CENTS = Decimal('0.01')
+
+
+class ItemAggregator:
+    """Fold purchased items into at most ``max_items`` preference lines.
+
+    Lines with the same SKU, unit price and currency become a single line
+    with the sum of their quantities. When a new line does not fit, the last
+    line and every line after it are folded into a summary line priced at
+    their exact total. Amounts are added as ``Decimal`` and converted to
+    ``float`` once per resulting line, so the preference total is the same
+    as sending every line.
+    """
+
+    def __init__(self, max_items: int = None) -> None:
+        self.max_items = max_items
+        self.groups = {}
+        self.summary_total = None
+        self.summary_quantity = 0
+        self.summary_currency = None
+
+    def add(self, purchased_item: PurchasedItem) -> None:
+        price = purchased_item.price.quantize(CENTS, rounding=ROUND_HALF_UP)
+        quantity = purchased_item.quantity
+        if quantity != int(quantity):
+            # MercadoPago quantities are integers, send one unit of the line
+            price = (price * quantity).quantize(CENTS, rounding=ROUND_HALF_UP)
+            quantity = 1
+        quantity = int(quantity)
+        key = (purchased_item.sku, price, purchased_item.currency)
+        group = self.groups.get(key)
+        if group is not None:
+            group[1] += quantity
+            return
+        if self.summary_total is None:
+            if self.max_items is None or len(self.groups) < self.max_items:
+                self.groups[key] = [purchased_item.name[:127], quantity]
+                return
+            self.summary_total = Decimal(0)
+            (_sku, last_price, currency), (_title, last_quantity) = (
+                self.groups.popitem())
+            self.add_to_summary(last_price, last_quantity, currency)
+        self.add_to_summary(price, quantity, purchased_item.currency)
+
+    def add_to_summary(self, price: Decimal, quantity: int,
+                       currency: str) -> None:
+        self.summary_total += price * quantity
+        self.summary_quantity += quantity
+        if self.summary_currency is None:
+            self.summary_currency = currency
+
+    def get_items(self) -> List[dict]:
+        items = [{'title': title,
+                  'quantity': quantity,
+                  'unit_price': float(price),
+                  'currency_id': currency,
+                  'id': sku}
+                 for (sku, price, currency), (title, quantity)
+                 in self.groups.items()]
+        if self.summary_total is not None:
+            items.append({
+                'title': _('%(count)d more items') % {
+                    'count': self.summary_quantity},
+                'quantity': 1,
+                'unit_price': float(self.summary_total),
+                'currency_id': self.summary_currency,
+                'id': 'summary'})
+        return items
+
+
+def aggregate_items(purchased_items: Iterable[PurchasedItem],
+                    max_items: Optional[int] = None) -> List[dict]:
+    """Return the preference lines of ``purchased_items``, read once."""
+    aggregator = ItemAggregator(max_items)
+    for purchased_item in purchased_items:
+        aggregator.add(purchased_item)
+    return aggregator.get_items()
@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from payments import PaymentStatus, get_payment_model
+from payments.core import provider_factory
+
+from ...bulk import get_mercadopago_variants
+from ...expiry import PaymentSweeper
+
+
+class Command(BaseCommand):
+    help = ('Cancel waiting MercadoPago payments whose checkout preference '
+            'expired without a payment.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--variant', action='append', dest='variants',
+            help='Variant to sweep, defaults to every MercadoPago one.')
+        parser.add_argument(
+            '--older-than', type=int,
+            help='Seconds without changes after which a waiting payment is '
+                 'abandoned, defaults to the preference_expiration of the '
+                 'variant plus the grace period.')
+        parser.add_argument(
+            '--grace', type=int, default=3600,
+            help='Seconds added to preference_expiration.')
+        parser.add_argument(
+            '--status', default=PaymentStatus.CANCELLED,
+            choices=[PaymentStatus.CANCELLED, PaymentStatus.REJECTED,
+                     PaymentStatus.ERROR])
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        variants = options['variants'] or get_mercadopago_variants()
+        if not variants:
+            raise CommandError('No MercadoPago payment variants configured.')
+        sweeper = PaymentSweeper(status=options['status'],
+                                 dry_run=options['dry_run'])
+        manager = get_payment_model()._default_manager
+        for variant in variants:
+            older_than = options['older_than']
+            if older_than is None:
+                expiration = getattr(provider_factory(variant),
+                                     'preference_expiration', None)
+                if not expiration:
+                    self.stderr.write(
+                        'Skipping %s: it has no preference_expiration, '
+                        'pass --older-than.' % variant)
+                    continue
+                older_than = expiration + options['grace']
+            cutoff = timezone.now() - timedelta(seconds=older_than)
+            for payment in sweeper.sweep(manager.filter(variant=variant),
+                                         cutoff, options['batch_size']):
+                self.stdout.write('%s %s -> %s' % (
+                    payment.pk, payment.token, options['status']))
+        self.stdout.write(', '.join(
+            '%s: %d' % item for item in sorted(sweeper.stats.items()))
+            or 'nothing to expire')
@@ -0,0 +1,54 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bulk import get_mercadopago_variants
+from ...settlements import (
+    MismatchReport, SettlementImporter, read_settlement_rows)
+
+
+class Command(BaseCommand):
+    help = ('Check payments against MercadoPago settlement or release '
+            'report CSV files, fixing the ones behind the report.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', metavar='report')
+        parser.add_argument(
+            '--variant', action='append', dest='variants',
+            help='Variant to match, defaults to every MercadoPago one.')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument(
+            '--report', dest='report_path',
+            help='CSV file listing the rows that do not match, "-" writes '
+                 'it to the standard output.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        variants = options['variants'] or get_mercadopago_variants()
+        if not variants:
+            raise CommandError('No MercadoPago payment variants configured.')
+        importer = SettlementImporter(variants, workers=options['workers'],
+                                      dry_run=options['dry_run'])
+        if options['report_path'] in (None, '-'):
+            self.import_reports(importer, options, MismatchReport(
+                sys.stdout if options['report_path'] else None))
+        else:
+            with open(options['report_path'], 'w', newline='') as report_file:
+                self.import_reports(importer, options,
+                                    MismatchReport(report_file))
+        self.stderr.write('%s; %.1fs' % (', '.join(
+            '%s: %d' % item for item in sorted(importer.stats.items()))
+            or 'no rows', importer.seconds))
+
+    def import_reports(self, importer, options, report):
+        for path in options['paths']:
+            with open(path, newline='') as csv_file:
+                try:
+                    for payment in importer.run(
+                            read_settlement_rows(csv_file),
+                            options['chunk_size'], report):
+                        self.stderr.write('%s %s -> %s' % (
+                            payment.pk, payment.token, payment.status))
+                except ValueError as error:
+                    raise CommandError('%s: %s' % (path, error))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from payments import PaymentStatus, get_payment_model
+
+from ...bulk import Checkpoint, get_mercadopago_variants, iter_batches
+from ...reconcile import Reconciler
+
+
+class Command(BaseCommand):
+    help = ('Refresh waiting MercadoPago payments whose notification was '
+            'lost.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--variant', action='append', dest='variants',
+            help='Variant to reconcile, defaults to every MercadoPago one.')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument(
+            '--rate', type=float, default=10,
+            help='Maximum MercadoPago requests per second, 0 disables it.')
+        parser.add_argument(
+            '--checkpoint',
+            help='File storing the last reconciled payment to resume from.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        variants = options['variants'] or get_mercadopago_variants()
+        if not variants:
+            raise CommandError('No MercadoPago payment variants configured.')
+        queryset = get_payment_model()._default_manager.filter(
+            variant__in=variants,
+            status__in=[PaymentStatus.WAITING, PaymentStatus.INPUT])
+        checkpoint = Checkpoint(options['checkpoint'])
+        reconciler = Reconciler(workers=options['workers'],
+                                rate=options['rate'],
+                                dry_run=options['dry_run'])
+        for batch in iter_batches(queryset, options['batch_size'],
+                                  checkpoint.load().get('last_pk')):
+            for payment in reconciler.reconcile(batch):
+                self.stdout.write('%s %s -> %s' % (
+                    payment.pk, payment.token, payment.status))
+            if not options['dry_run']:
+                # Payments whose lookup failed are retried by the next run
+                checkpoint.advance(batch, reconciler.failed)
+        if not options['dry_run']:
+            checkpoint.finish()
+        self.stdout.write(', '.join(
+            '%s: %d' % item for item in sorted(reconciler.stats.items())))
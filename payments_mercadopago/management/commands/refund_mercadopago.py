@@ -0,0 +1,74 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments import PaymentStatus, get_payment_model
+
+from ...bulk import get_mercadopago_variants
+from ...refunds import BulkRefunder, RefundLog, read_refund_requests
+
+
+class Command(BaseCommand):
+    help = ('Refund MercadoPago payments listed in a CSV file, or every '
+            'confirmed payment of the given variants.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--csv', dest='csv_path',
+            help='CSV file with a token and an optional amount column, '
+                 '"-" reads it from the standard input.')
+        parser.add_argument(
+            '--variant', action='append', dest='variants',
+            help='Refund every confirmed payment of this variant.')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument(
+            '--rate', type=float, default=5,
+            help='Maximum refunds per second, 0 disables it.')
+        parser.add_argument(
+            '--log', dest='log_path',
+            help='JSON lines file recording every outcome, reuse it to '
+                 'resume an interrupted run.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        if bool(options['csv_path']) == bool(options['variants']):
+            raise CommandError('Pass either --csv or --variant.')
+        refunder = BulkRefunder(workers=options['workers'],
+                                rate=options['rate'],
+                                log=RefundLog(options['log_path']),
+                                dry_run=options['dry_run'])
+        if options['csv_path']:
+            outcomes = self.refund_csv(refunder, options)
+        else:
+            unknown = set(options['variants']) - set(
+                get_mercadopago_variants())
+            if unknown:
+                raise CommandError('Not MercadoPago variants: %s' % ', '.join(
+                    sorted(unknown)))
+            queryset = get_payment_model()._default_manager.filter(
+                variant__in=options['variants'],
+                status=PaymentStatus.CONFIRMED)
+            outcomes = refunder.refund_queryset(
+                queryset, options['batch_size'])
+        for outcome in outcomes:
+            self.stdout.write('%s %s %s %s' % (
+                outcome.token, outcome.outcome,
+                '' if outcome.amount is None else outcome.amount,
+                outcome.error))
+        summary = refunder.summary()
+        self.stdout.write('%s; refunded %s in %.1fs, %.1f payments/s' % (
+            ', '.join('%s: %d' % item
+                      for item in sorted(summary['outcomes'].items()))
+            or 'nothing to refund',
+            summary['refunded_amount'], summary['seconds'],
+            summary['throughput']))
+
+    def refund_csv(self, refunder, options):
+        if options['csv_path'] == '-':
+            yield from refunder.refund_requests(
+                read_refund_requests(sys.stdin), options['batch_size'])
+            return
+        with open(options['csv_path'], newline='') as csv_file:
+            yield from refunder.refund_requests(
+                read_refund_requests(csv_file), options['batch_size'])
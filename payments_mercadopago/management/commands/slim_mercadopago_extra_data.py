@@ -0,0 +1,101 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from payments import get_payment_model
+from payments.core import provider_factory
+
+from ...bulk import Checkpoint, get_mercadopago_variants, iter_batches
+from ...models import MercadoPagoResponse
+
+
+class Command(BaseCommand):
+    help = ('Replace the full MercadoPago responses stored in extra_data by '
+            'their compact projection, archiving the originals.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--variant', action='append', dest='variants',
+            help='Variant to slim, defaults to every MercadoPago one.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--no-archive', action='store_false', dest='archive',
+            help='Discard the original responses instead of archiving them.')
+        parser.add_argument(
+            '--no-compress', action='store_false', dest='compress',
+            help='Archive the original responses uncompressed.')
+        parser.add_argument(
+            '--checkpoint',
+            help='File storing the last slimmed payment to resume from.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        variants = options['variants'] or get_mercadopago_variants()
+        if not variants:
+            raise CommandError('No MercadoPago payment variants configured.')
+        Payment = get_payment_model()
+        queryset = Payment._default_manager.filter(
+            variant__in=variants).exclude(extra_data='').only(
+                'pk', 'variant', 'token', 'extra_data')
+        checkpoint = Checkpoint(options['checkpoint'])
+        slimmed = saved_bytes = 0
+        skipped = set()
+        for batch in iter_batches(queryset, options['batch_size'],
+                                  checkpoint.load().get('last_pk')):
+            payments = []
+            archive = {}
+            originals = {}
+            for payment in batch:
+                try:
+                    response = json.loads(payment.extra_data)
+                except ValueError:
+                    continue
+                if not isinstance(response, dict) or not isinstance(
+                        response.get('response'), dict):
+                    continue
+                provider = provider_factory(payment.variant)
+                extra_data = json.dumps(
+                    provider.get_compact_response(response))
+                if len(extra_data) >= len(payment.extra_data):
+                    continue
+                if options['archive']:
+                    archive[payment.pk] = MercadoPagoResponse.build(
+                        payment.token, 'legacy', response,
+                        options['compress'])
+                originals[payment.pk] = payment.extra_data
+                payment.extra_data = extra_data
+                payments.append(payment)
+            if options['dry_run']:
+                slimmed += len(payments)
+                saved_bytes += sum(
+                    len(originals[payment.pk]) - len(payment.extra_data)
+                    for payment in payments)
+                continue
+            with transaction.atomic():
+                # Leave the payments a notification updated meanwhile to
+                # the next run
+                current = dict(Payment._default_manager.filter(
+                    pk__in=list(originals)).select_for_update().values_list(
+                        'pk', 'extra_data'))
+                unchanged = [payment for payment in payments
+                             if current.get(payment.pk) == originals[payment.pk]]
+                MercadoPagoResponse.objects.bulk_create(
+                    [archive[payment.pk] for payment in unchanged
+                     if payment.pk in archive])
+                Payment._default_manager.bulk_update(unchanged, ['extra_data'])
+            slimmed += len(unchanged)
+            skipped.update(payment.pk for payment in payments
+                           if current.get(payment.pk) != originals[payment.pk])
+            saved_bytes += sum(
+                len(originals[payment.pk]) - len(payment.extra_data)
+                for payment in unchanged)
+            # The next run resumes before the payments skipped above
+            checkpoint.advance(batch, skipped)
+        if not options['dry_run']:
+            checkpoint.finish()
+        self.stdout.write('Slimmed %d payments, %d bytes saved' % (
+            slimmed, saved_bytes))
+        if skipped:
+            self.stdout.write('Skipped %d payments changed while slimming, '
+                              'run the command again for them' % len(skipped))
@@ -0,0 +1,137 @@
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Optional
+
+from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.utils.module_loading import import_string
+
+from payments import RedirectNeeded
+
+from .signals import call_finished, call_started
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class BaseMetricsBackend:
+    """Receives the timing and outcome of every instrumented operation."""
+
+    def started(self, operation: str) -> None:
+        pass
+
+    def finished(self, operation: str, duration: float,
+                 status_code: Optional[int] = None,
+                 error: Optional[str] = None) -> None:
+        pass
+
+
+class InMemoryMetrics(BaseMetricsBackend):
+    """Process-local aggregator of latency histograms, counters and gauges."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.in_flight = defaultdict(int)
+            self.histograms = {}
+            self.outcomes = defaultdict(int)
+
+    def started(self, operation: str) -> None:
+        with self._lock:
+            self.in_flight[operation] += 1
+
+    def finished(self, operation: str, duration: float,
+                 status_code: Optional[int] = None,
+                 error: Optional[str] = None) -> None:
+        outcome = error or (str(status_code) if status_code else 'ok')
+        with self._lock:
+            self.in_flight[operation] -= 1
+            self.outcomes[(operation, outcome)] += 1
+            histogram = self.histograms.get(operation)
+            if histogram is None:
+                histogram = self.histograms[operation] = {
+                    'buckets': [0] * (len(self.buckets) + 1),
+                    'count': 0, 'sum': 0.0}
+            histogram['buckets'][bisect_left(self.buckets, duration)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += duration
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            operations = set(self.histograms) | set(self.in_flight)
+            snapshot = {}
+            for operation in sorted(operations):
+                histogram = self.histograms.get(
+                    operation, {'buckets': [0] * (len(self.buckets) + 1),
+                                'count': 0, 'sum': 0.0})
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(self.buckets + ('+Inf',),
+                                        histogram['buckets']):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                snapshot[operation] = {
+                    'in_flight': self.in_flight.get(operation, 0),
+                    'count': histogram['count'],
+                    'sum': histogram['sum'],
+                    'buckets': buckets,
+                    'outcomes': {outcome: count for (name, outcome), count
+                                 in self.outcomes.items()
+                                 if name == operation},
+                }
+            return snapshot
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_metrics_backend(backend: str) -> BaseMetricsBackend:
+    """Return the process-wide metrics backend for a dotted path."""
+    with _backends_lock:
+        if backend not in _backends:
+            _backends[backend] = import_string(backend)()
+        return _backends[backend]
+
+
+@contextmanager
+def instrument(sender, metrics: Optional[BaseMetricsBackend], operation: str,
+               outbound: bool = True):
+    """Time the enclosed block, report it to ``metrics`` and the signals.
+
+    The block may store the HTTP status in the yielded dict's
+    ``status_code`` key. ``RedirectNeeded`` is a successful outcome.
+    """
+    call = {'status_code': None}
+    error = None
+    call_started.send(sender=sender, operation=operation, outbound=outbound)
+    if metrics:
+        metrics.started(operation)
+    start = perf_counter()
+    try:
+        yield call
+    except RedirectNeeded:
+        raise
+    except Exception as exception:
+        error = type(exception).__name__
+        raise
+    finally:
+        duration = perf_counter() - start
+        if metrics:
+            metrics.finished(operation, duration, call['status_code'], error)
+        call_finished.send(sender=sender, operation=operation,
+                           outbound=outbound, duration=duration,
+                           status_code=call['status_code'], error=error)
+
+
+def metrics_view(request: HttpRequest,
+                 backend: str = 'payments_mercadopago.metrics.InMemoryMetrics'
+                 ) -> HttpResponse:
+    """JSON snapshot of the in-memory metrics, protect it before routing it."""
+    return JsonResponse(get_metrics_backend(backend).snapshot())
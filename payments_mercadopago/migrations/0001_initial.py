@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MercadoPagoResponse',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payment_token', models.CharField(max_length=36)),
+                ('event', models.CharField(max_length=32)),
+                ('compressed', models.BooleanField(default=False)),
+                ('data', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['pk'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='mercadopagoresponse',
+            index=models.Index(fields=['payment_token', 'event'], name='payments_me_payment_91b555_idx'),
+        ),
+    ]
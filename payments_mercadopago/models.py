@@ -0,0 +1,35 @@
+import json
+import zlib
+
+from django.db import models
+
+
+class MercadoPagoResponse(models.Model):
+    """Append-only archive of the raw responses received from MercadoPago."""
+    payment_token = models.CharField(max_length=36)
+    event = models.CharField(max_length=32)
+    compressed = models.BooleanField(default=False)
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['pk']
+        indexes = [models.Index(fields=['payment_token', 'event'])]
+
+    def __str__(self) -> str:
+        return '%s %s' % (self.payment_token, self.event)
+
+    @classmethod
+    def build(cls, payment_token: str, event: str, response: dict,
+              compress: bool = True) -> 'MercadoPagoResponse':
+        data = json.dumps(response).encode('utf-8')
+        if compress:
+            data = zlib.compress(data)
+        return cls(payment_token=payment_token, event=event,
+                   compressed=compress, data=data)
+
+    def get_response(self) -> dict:
+        data = bytes(self.data)
+        if self.compressed:
+            data = zlib.decompress(data)
+        return json.loads(data.decode('utf-8'))
@@ -0,0 +1,150 @@
+"""Access tokens obtained with the client credentials of an application."""
+import hashlib
+import logging
+import threading
+import time
+from typing import Optional
+
+from django.core.cache import caches
+from django.utils.translation import gettext as _
+
+from payments import PaymentError
+
+from .client import API_BASE_URL, Timeout, get_session
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenManager:
+    """Fetches an OAuth token once and refreshes it before it expires.
+
+    The token is kept in the process and in the ``cache_alias`` Django cache,
+    so every process of a deployment uses the same one. ``refresh_margin``
+    seconds before the expiry a single caller refreshes it, holding a lock
+    in the cache; the others keep using the current token meanwhile.
+    """
+    prefix = 'mercadopago:oauth'
+    poll_interval = 0.05
+
+    def __init__(self, client_id: str, client_secret: str,
+                 api_base_url: str = API_BASE_URL,
+                 cache_alias: str = 'default', refresh_margin: float = 300,
+                 pool_size: int = 10, timeout: Timeout = None) -> None:
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.api_base_url = api_base_url
+        self.cache_alias = cache_alias
+        self.refresh_margin = refresh_margin
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.key = '%s:%s' % (self.prefix, hashlib.sha256(
+            ('%s:%s' % (api_base_url, client_id)).encode('utf-8')
+        ).hexdigest()[:16])
+        self._lock = threading.Lock()
+        self._token = None
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def is_fresh(self, token: Optional[dict]) -> bool:
+        return bool(token) and time.time() < (
+            token['expires_at'] - self.refresh_margin)
+
+    def is_valid(self, token: Optional[dict]) -> bool:
+        return bool(token) and time.time() < token['expires_at']
+
+    def get_token(self) -> str:
+        token = self._token
+        if self.is_fresh(token):
+            return token['access_token']
+        token = self.cache.get(self.key)
+        if self.is_fresh(token):
+            self._token = token
+            return token['access_token']
+        return self.refresh()['access_token']
+
+    __call__ = get_token
+
+    def refresh(self) -> dict:
+        # Threads of this process queue here, the first one refreshes
+        with self._lock:
+            token = self._token
+            if self.is_fresh(token):
+                return token
+            lock_key = '%s:lock' % self.key
+            lock_timeout = self.get_lock_timeout()
+            deadline = time.monotonic() + lock_timeout
+            while not self.cache.add(lock_key, 1, lock_timeout):
+                token = self.cache.get(self.key)
+                if self.is_fresh(token):
+                    self._token = token
+                    return token
+                current = self._token or token
+                if self.is_valid(current):
+                    # Another process is refreshing, the old token still works
+                    return current
+                if time.monotonic() > deadline:
+                    # The holder died, refresh without the lock
+                    self._token = self.fetch()
+                    return self._token
+                time.sleep(self.poll_interval)
+            try:
+                self._token = self.fetch()
+            finally:
+                self.cache.delete(lock_key)
+            return self._token
+
+    def get_lock_timeout(self) -> int:
+        timeout = self.timeout
+        if isinstance(timeout, tuple):
+            timeout = sum(timeout)
+        return int(timeout or 30) + 1
+
+    def fetch(self) -> dict:
+        response = get_session(self.pool_size, self.timeout).post(
+            self.api_base_url.rstrip('/') + '/oauth/token', data={
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+            }, headers={'Accept': 'application/json'})
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if response.status_code != 200 or 'access_token' not in body:
+            logger.warning('Could not obtain a MercadoPago access token',
+                           extra={'response': body})
+            raise PaymentError(
+                body.get('message') or _('Invalid MercadoPago credentials'),
+                code=response.status_code)
+        token = {'access_token': body['access_token'],
+                 'expires_at': time.time() + int(body.get('expires_in', 0))}
+        timeout = max(1, int(token['expires_at'] - time.time()))
+        self.cache.set(self.key, token, timeout)
+        return token
+
+    def invalidate(self, access_token: str) -> None:
+        """Forget ``access_token`` after MercadoPago rejected it."""
+        if self._token and self._token['access_token'] == access_token:
+            self._token = None
+        token = self.cache.get(self.key)
+        if token and token['access_token'] == access_token:
+            self.cache.delete(self.key)
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_token_manager(client_id: str, client_secret: str,
+                      api_base_url: str = API_BASE_URL,
+                      **options) -> TokenManager:
+    """Return the process-wide token manager of an application."""
+    key = (client_id, client_secret, api_base_url)
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = TokenManager(
+                client_id, client_secret, api_base_url, **options)
+        return _managers[key]
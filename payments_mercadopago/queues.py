@@ -0,0 +1,197 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+from time import monotonic, sleep
+from typing import Callable, Optional
+
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseQueue:
+    """Backend used to run webhook jobs outside of the request cycle.
+
+    ``submit`` must return quickly. It returns ``False`` when the job could
+    not be accepted, in which case the provider processes the notification
+    synchronously so it is never lost.
+    """
+
+    def submit(self, func: Callable, *args, **kwargs) -> bool:
+        raise NotImplementedError
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        raise NotImplementedError
+
+    def shutdown(self, wait: bool = True,
+                 timeout: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def after_fork(self) -> None:
+        """Called in a forked child, which inherits no running threads."""
+
+
+class LocalQueue(BaseQueue):
+    """Bounded in-process queue served by a fixed pool of daemon threads.
+
+    A failing job is run again up to ``retries`` times, waiting
+    ``retry_backoff`` seconds doubled on every attempt. MercadoPago does
+    not deliver an acknowledged notification again, so jobs failing after
+    that are only logged.
+    """
+
+    def __init__(self, workers: int = 4, maxsize: int = 1000,
+                 retries: int = 2, retry_backoff: float = 1) -> None:
+        self.workers = workers
+        self.maxsize = maxsize
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue(maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def after_fork(self) -> None:
+        # The jobs of the parent stay with the parent
+        self._queue = queue.Queue(self.maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start_workers(self) -> None:
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads or self._closed:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, daemon=True,
+                    name='mercadopago-webhook-%d' % number)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func: Callable, *args, **kwargs) -> bool:
+        if self._closed:
+            return False
+        self._start_workers()
+        try:
+            self._queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            logger.warning('MercadoPago webhook queue is full (%d jobs)',
+                           self.maxsize)
+            return False
+        return True
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._run(*job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, func: Callable, args: tuple, kwargs: dict) -> None:
+        for attempt in range(self.retries + 1):
+            try:
+                func(*args, **kwargs)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception('MercadoPago webhook job failed')
+                    return
+                logger.warning('MercadoPago webhook job failed, retrying',
+                               exc_info=True)
+            finally:
+                close_old_connections()
+            sleep(self.retry_backoff * 2 ** attempt)
+
+    def pending(self) -> int:
+        return self._queue.unfinished_tasks
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Block until every submitted job finished.
+
+        Returns ``False`` if ``timeout`` expired with jobs still pending.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                if deadline is None:
+                    self._queue.all_tasks_done.wait()
+                    continue
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def shutdown(self, wait: bool = True,
+                 timeout: Optional[float] = None) -> None:
+        """Stop accepting jobs and stop the workers.
+
+        With ``wait`` pending jobs are drained first, otherwise they are
+        discarded.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+        if wait:
+            if not self.drain(timeout):
+                logger.warning('MercadoPago webhook queue shut down with %d '
+                               'pending jobs', self.pending())
+        discarded = 0
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._queue.task_done()
+            discarded += 1
+        if discarded:
+            logger.warning('Discarded %d MercadoPago webhook jobs', discarded)
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(backend: str, **options) -> BaseQueue:
+    """Return the process-wide queue for ``backend`` and ``options``."""
+    key = (backend, tuple(sorted(options.items())))
+    with _queues_lock:
+        if key not in _queues:
+            _queues[key] = import_string(backend)(**options)
+        return _queues[key]
+
+
+def shutdown_queues(wait: bool = True, timeout: Optional[float] = 10) -> None:
+    with _queues_lock:
+        queues = list(_queues.values())
+        _queues.clear()
+    for webhook_queue in queues:
+        webhook_queue.shutdown(wait=wait, timeout=timeout)
+
+
+def _reset_after_fork() -> None:
+    global _queues_lock
+    _queues_lock = threading.Lock()
+    for webhook_queue in _queues.values():
+        webhook_queue.after_fork()
+
+
+atexit.register(shutdown_queues)
+if hasattr(os, 'register_at_fork'):
+    # Worker threads do not survive a fork
+    os.register_at_fork(after_in_child=_reset_after_fork)
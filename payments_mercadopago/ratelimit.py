@@ -0,0 +1,158 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from django.core.cache import caches
+
+from .cache import incr
+
+
+_local = threading.local()
+
+
+@contextmanager
+def low_priority(max_wait: float = 60):
+    """Run the calls of this thread after checkout traffic.
+
+    Low priority calls leave the reserved share of every bucket untouched
+    and wait up to ``max_wait`` seconds for a token.
+    """
+    previous = getattr(_local, 'max_wait', None)
+    _local.max_wait = max_wait
+    try:
+        yield
+    finally:
+        _local.max_wait = previous
+
+
+def is_low_priority() -> bool:
+    return getattr(_local, 'max_wait', None) is not None
+
+
+class TokenBucket:
+    """Allows ``rate`` calls per second with bursts of up to ``capacity``.
+
+    Without ``cache_alias`` the bucket is exact and local to the process.
+    With it the bucket lives in that Django cache and is shared by every
+    process: it is refilled in whole windows of ``capacity / rate`` seconds
+    with an atomic ``incr``, which Redis, Memcached and locmem provide.
+    """
+    prefix = 'mercadopago:ratelimit'
+
+    def __init__(self, name: str, rate: float, capacity: float = None,
+                 cache_alias: Optional[str] = None) -> None:
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.window = self.capacity / rate
+        self.cache_alias = cache_alias
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def get_delay(self, reserve: float = 0) -> float:
+        """Take a token and return 0, or return the seconds to wait.
+
+        ``reserve`` is the share of the capacity the caller may not use.
+        """
+        if self.cache_alias:
+            return self._get_shared_delay(reserve)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (
+                now - self._updated) * self.rate)
+            self._updated = now
+            # Small buckets keep at least one token for low priority calls
+            floor = min(self.capacity * reserve, self.capacity - 1)
+            if self._tokens - 1 >= floor:
+                self._tokens -= 1
+                return 0
+            return (floor + 1 - self._tokens) / self.rate
+
+    def get_window(self) -> tuple:
+        now = time.time()
+        window = int(now // self.window)
+        return ('%s:%s:%d' % (self.prefix, self.name, window),
+                (window + 1) * self.window - now)
+
+    def _get_shared_delay(self, reserve: float) -> float:
+        cache = caches[self.cache_alias]
+        key, remaining = self.get_window()
+        count = incr(cache, key, timeout=int(self.window) + 1)
+        if count <= max(1, self.capacity * (1 - reserve)):
+            return 0
+        cache.decr(key)
+        return remaining
+
+    def exhaust(self) -> None:
+        """Empty the bucket, MercadoPago answered with a 429."""
+        if self.cache_alias:
+            key, remaining = self.get_window()
+            caches[self.cache_alias].set(key, self.capacity,
+                                         int(self.window) + 1)
+        else:
+            with self._lock:
+                self._tokens = 0
+                self._updated = time.monotonic()
+
+
+class RateLimits:
+    """Per operation token buckets shared by the providers of an account.
+
+    ``rates`` maps operation names to calls per second, operations without
+    a rate are not limited. Checkout traffic waits up to ``max_wait``
+    seconds for a token, while calls made under ``low_priority`` cannot
+    use the ``reserve`` share of each bucket.
+    """
+
+    def __init__(self, name: str, rates: dict, cache_alias: str = None,
+                 max_wait: float = 1, reserve: float = 0.2) -> None:
+        self.max_wait = max_wait
+        self.reserve = reserve
+        self.buckets = {
+            operation: TokenBucket('%s:%s' % (name, operation), rate,
+                                   cache_alias=cache_alias)
+            for operation, rate in rates.items()}
+
+    def get_delay(self, operation: str, low_priority: bool = None) -> float:
+        bucket = self.buckets.get(operation)
+        if bucket is None:
+            return 0
+        if low_priority is None:
+            low_priority = is_low_priority()
+        return bucket.get_delay(self.reserve if low_priority else 0)
+
+    def get_max_wait(self) -> float:
+        if is_low_priority():
+            return _local.max_wait
+        return self.max_wait
+
+    def wait(self, operation: str) -> bool:
+        """Block until a token is taken, ``False`` after the max wait."""
+        deadline = time.monotonic() + self.get_max_wait()
+        while True:
+            delay = self.get_delay(operation)
+            if not delay:
+                return True
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+
+    def exhaust(self, operation: str) -> None:
+        bucket = self.buckets.get(operation)
+        if bucket is not None:
+            bucket.exhaust()
+
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def get_rate_limits(name: str, rates: dict, **options) -> RateLimits:
+    """Return the process-wide rate limits called ``name``."""
+    key = (name, tuple(sorted(rates.items())))
+    with _limits_lock:
+        if key not in _limits:
+            _limits[key] = RateLimits(name, rates, **options)
+        return _limits[key]
@@ -0,0 +1,132 @@
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from django.db import close_old_connections, transaction
+
+from payments import PaymentError, PaymentStatus
+from payments.core import provider_factory
+from payments.models import BasePayment
+from payments.signals import status_changed
+
+from .bulk import RateLimiter
+from .ratelimit import low_priority
+from .transitions import is_forward
+
+
+logger = logging.getLogger(__name__)
+
+RECONCILED_FIELDS = ['status', 'transaction_id', 'captured_amount',
+                     'extra_data']
+
+
+def fetch_payment_information(provider, payment: BasePayment) -> Optional[dict]:
+    """Fetch a payment by id, or by its token when the webhook never came."""
+    if payment.transaction_id:
+        return provider.get_payment_information(
+            payment.transaction_id, cached=True)
+    return provider.search_payment_by_reference(payment.token)
+
+
+def apply_payment_information(provider, payment: BasePayment,
+                              payment_information: dict,
+                              store: bool = True) -> bool:
+    """Update ``payment`` in memory, return ``True`` if the status changed."""
+    response = payment_information.get('response', {})
+    status = provider.get_payment_status(response.get('status'))
+    if response.get('id'):
+        payment.transaction_id = str(response['id'])
+    if store:
+        provider.store_response(payment, 'payment', payment_information)
+    if status == PaymentStatus.CONFIRMED:
+        payment.captured_amount = payment.total
+    if status == payment.status:
+        return False
+    payment.status = status
+    return True
+
+
+class Reconciler:
+    """Refresh batches of payments from MercadoPago with bounded concurrency.
+
+    Lookups run in a thread pool limited to ``rate`` requests per second and
+    the changes of a whole batch are written with a single ``bulk_update``.
+    """
+
+    def __init__(self, workers: int = 8, rate: float = 10,
+                 dry_run: bool = False) -> None:
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.dry_run = dry_run
+        self.stats = Counter()
+        self.failed = set()
+
+    def lookup(self, payment: BasePayment) -> tuple:
+        self.limiter.wait()
+        try:
+            provider = provider_factory(payment.variant).for_payment(payment)
+            with low_priority():
+                return payment, provider, fetch_payment_information(
+                    provider, payment)
+        except PaymentError as error:
+            logger.warning('Could not reconcile payment %s: %s',
+                           payment.pk, error)
+            return payment, None, None
+        finally:
+            close_old_connections()
+
+    def reconcile(self, batch: list) -> list:
+        """Reconcile ``batch`` and return the payments whose status changed."""
+        changed = []
+        updated = []
+        with ThreadPoolExecutor(self.workers) as executor:
+            for payment, provider, payment_information in executor.map(
+                    self.lookup, batch):
+                self.stats['scanned'] += 1
+                if provider is None:
+                    self.stats['errors'] += 1
+                    self.failed.add(payment.pk)
+                    continue
+                if payment_information is None:
+                    self.stats['not_found'] += 1
+                    continue
+                if apply_payment_information(
+                        provider, payment, payment_information,
+                        store=not self.dry_run):
+                    self.stats['changed'] += 1
+                    changed.append(payment)
+                else:
+                    self.stats['unchanged'] += 1
+                updated.append(payment)
+        if updated and not self.dry_run:
+            changed = self.save(updated, changed)
+        return changed
+
+    def save(self, updated: list, changed: list) -> list:
+        return save_payments(updated, changed)
+
+
+def save_payments(updated: list, changed: list,
+                  fields: list = RECONCILED_FIELDS) -> list:
+    """Write ``updated`` and return the payments that really changed.
+
+    Notifications may have moved some payments while they were looked up,
+    those are left as they are.
+    """
+    model = type(updated[0])
+    with transaction.atomic():
+        current = dict(model._default_manager.select_for_update().filter(
+            pk__in=[payment.pk for payment in updated]).values_list(
+                'pk', 'status'))
+        updated = [payment for payment in updated
+                   if not is_forward(payment.status,
+                                     current.get(payment.pk))]
+        saved = {payment.pk for payment in updated}
+        changed = [payment for payment in changed
+                   if payment.pk in saved
+                   and current.get(payment.pk) != payment.status]
+        model._default_manager.bulk_update(updated, fields)
+    for payment in changed:
+        status_changed.send(sender=model, instance=payment)
+    return changed
@@ -0,0 +1,216 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from typing import IO, Iterable, Iterator, NamedTuple, Optional
+
+from django.db import close_old_connections
+from django.db.models import QuerySet
+
+from payments import PaymentError, get_payment_model
+from payments.core import provider_factory
+
+from .bulk import RateLimiter, iter_batches
+from .client import request_headers
+from .ratelimit import low_priority
+
+
+logger = logging.getLogger(__name__)
+
+
+class RefundRequest(NamedTuple):
+    token: str
+    amount: Optional[Decimal] = None
+
+
+class RefundOutcome(NamedTuple):
+    token: str
+    outcome: str
+    amount: Optional[Decimal] = None
+    error: str = ''
+
+
+def read_refund_requests(stream: IO[str]) -> Iterator[RefundRequest]:
+    """Read ``token`` and optional ``amount`` columns from a CSV stream."""
+    for row in csv.DictReader(stream):
+        token = (row.get('token') or '').strip()
+        if not token:
+            continue
+        amount = (row.get('amount') or '').strip()
+        try:
+            yield RefundRequest(token, Decimal(amount) if amount else None)
+        except InvalidOperation:
+            raise ValueError('Invalid amount %r for payment %s' % (
+                amount, token))
+
+
+def get_idempotency_key(token: str, amount: Optional[Decimal]) -> str:
+    """Same refund, same key, so a retried run cannot refund twice."""
+    payload = 'refund:%s:%s' % (token, 'full' if amount is None else amount)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class RefundLog:
+    """Append-only JSON lines journal of refund outcomes.
+
+    Payments with a final outcome are skipped when a run is resumed, failed
+    ones are attempted again.
+    """
+    final_outcomes = frozenset(['refunded', 'skipped'])
+
+    def __init__(self, path: Optional[str]) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self) -> set:
+        if not self.path or not os.path.exists(self.path):
+            return set()
+        done = set()
+        with open(self.path) as log_file:
+            for line in log_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line of a crashed run
+                    continue
+                if entry.get('outcome') in self.final_outcomes:
+                    done.add(entry['token'])
+        return done
+
+    def write(self, outcome: RefundOutcome) -> None:
+        if not self.path:
+            return
+        entry = dict(outcome._asdict(), time=time.time())
+        line = json.dumps(entry, default=str) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as log_file:
+                log_file.write(line)
+                log_file.flush()
+                os.fsync(log_file.fileno())
+
+
+class BulkRefunder:
+    """Refund many payments in a thread pool within ``rate`` per second.
+
+    Every refund is sent with an idempotency key derived from the payment
+    and the amount, and its outcome is appended to ``log`` as soon as it is
+    known, so an interrupted run can be resumed with the same log.
+    """
+
+    def __init__(self, workers: int = 4, rate: float = 5,
+                 log: RefundLog = None, dry_run: bool = False) -> None:
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.log = log or RefundLog(None)
+        self.dry_run = dry_run
+        self.stats = Counter()
+        self.refunded_amount = Decimal(0)
+        self.seconds = 0.0
+
+    def refund(self, job: tuple) -> RefundOutcome:
+        token, payment, amount = job
+        if payment is None:
+            return RefundOutcome(token, 'skipped', amount, 'Payment not found')
+        try:
+            if payment.captured_amount <= 0:
+                return RefundOutcome(payment.token, 'skipped', amount,
+                                     'Nothing left to refund')
+            if amount is not None and amount > payment.captured_amount:
+                return RefundOutcome(payment.token, 'skipped', amount,
+                                     'Amount exceeds the captured amount')
+            if self.dry_run:
+                return RefundOutcome(payment.token, 'refundable', amount)
+            self.limiter.wait()
+            captured_amount = payment.captured_amount
+            provider = provider_factory(payment.variant)
+            headers = provider.get_idempotency_headers(
+                get_idempotency_key(str(payment.token), amount))
+            with request_headers(headers), low_priority():
+                payment.refund(amount)
+            return RefundOutcome(payment.token, 'refunded',
+                                 captured_amount - payment.captured_amount)
+        except ValueError as error:
+            return RefundOutcome(payment.token, 'skipped', amount, str(error))
+        except PaymentError as error:
+            logger.warning('Could not refund payment %s: %s',
+                           payment.pk, error)
+            return RefundOutcome(payment.token, 'failed', amount, str(error))
+        finally:
+            close_old_connections()
+
+    def run(self, jobs: Iterable[tuple]) -> Iterator[RefundOutcome]:
+        """Refund ``(token, payment, amount)`` jobs, yielding their outcomes.
+
+        Only a few jobs per worker are submitted ahead, so ``jobs`` is read
+        lazily whatever its size.
+        """
+        done = self.log.load()
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(self.workers) as executor:
+                pending = deque()
+                for job in jobs:
+                    if str(job[0]) in done:
+                        continue
+                    pending.append(executor.submit(self.refund, job))
+                    if len(pending) >= 2 * self.workers:
+                        yield self.record(pending.popleft().result())
+                while pending:
+                    yield self.record(pending.popleft().result())
+        finally:
+            self.seconds += time.monotonic() - start
+
+    def record(self, outcome: RefundOutcome) -> RefundOutcome:
+        if not self.dry_run:
+            self.log.write(outcome)
+        self.stats[outcome.outcome] += 1
+        if outcome.outcome == 'refunded':
+            self.refunded_amount += outcome.amount
+        return outcome
+
+    def refund_queryset(self, queryset: QuerySet,
+                        batch_size: int = 500) -> Iterator[RefundOutcome]:
+        """Refund the whole captured amount of every payment."""
+        jobs = ((str(payment.token), payment, None)
+                for batch in iter_batches(queryset, batch_size)
+                for payment in batch)
+        return self.run(jobs)
+
+    def refund_requests(self, requests: Iterable[RefundRequest],
+                        batch_size: int = 500) -> Iterator[RefundOutcome]:
+        """Refund the payments of ``requests``, looked up by token."""
+        return self.run(self.resolve(requests, batch_size))
+
+    def resolve(self, requests: Iterable[RefundRequest],
+                batch_size: int) -> Iterator[tuple]:
+        manager = get_payment_model()._default_manager
+        batch = []
+        for refund_request in requests:
+            batch.append(refund_request)
+            if len(batch) == batch_size:
+                yield from self.resolve_batch(manager, batch)
+                batch = []
+        if batch:
+            yield from self.resolve_batch(manager, batch)
+
+    def resolve_batch(self, manager, batch: list) -> Iterator[tuple]:
+        payments = {str(payment.token): payment for payment in manager.filter(
+            token__in=[refund_request.token for refund_request in batch])}
+        for refund_request in batch:
+            yield (refund_request.token, payments.get(refund_request.token),
+                   refund_request.amount)
+
+    def summary(self) -> dict:
+        processed = sum(self.stats.values())
+        return {
+            'outcomes': dict(self.stats),
+            'refunded_amount': self.refunded_amount,
+            'seconds': self.seconds,
+            'throughput': processed / self.seconds if self.seconds else 0,
+        }
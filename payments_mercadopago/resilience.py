@@ -0,0 +1,179 @@
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+from django.core.cache import caches
+
+from .cache import incr
+from .signals import circuit_state_changed
+
+
+logger = logging.getLogger(__name__)
+
+# Reads and preference creation can be repeated without side effects
+RETRIED_OPERATIONS = frozenset([
+    'create_preference', 'get_payment', 'search_payment',
+    'get_merchant_order'])
+
+
+def is_server_error(status_code: Optional[int]) -> bool:
+    return status_code is None or status_code >= 500
+
+
+def is_retryable(status_code: Optional[int]) -> bool:
+    """``None`` stands for a connection error or a timeout."""
+    return is_server_error(status_code) or status_code == 429
+
+
+class Retry:
+    """Exponential backoff with full jitter."""
+
+    def __init__(self, retries: int = 0, backoff: float = 0.2,
+                 max_backoff: float = 2) -> None:
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def get_attempts(self, operation: str) -> int:
+        if operation in RETRIED_OPERATIONS:
+            return self.retries + 1
+        return 1
+
+    def get_delay(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Fails fast after ``failure_threshold`` consecutive server failures.
+
+    Once open it rejects calls for ``recovery_timeout`` seconds, then lets a
+    single trial call through: its success closes the circuit and its failure
+    opens it again. With ``cache_alias`` the state lives in that Django cache
+    and is shared by every process using it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5,
+                 recovery_timeout: float = 30,
+                 cache_alias: Optional[str] = None) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.cache_alias = cache_alias
+        self._lock = threading.Lock()
+        self._state = {}
+        self._expires = {}
+
+    def get_key(self, field: str) -> str:
+        return 'mercadopago:circuit:%s:%s' % (self.name, field)
+
+    def _get(self, field: str):
+        if self.cache_alias:
+            return caches[self.cache_alias].get(self.get_key(field))
+        with self._lock:
+            self._expire(field)
+            return self._state.get(field)
+
+    def _expire(self, field: str) -> None:
+        expires = self._expires.get(field)
+        if expires is not None and expires <= time.monotonic():
+            self._state.pop(field, None)
+            del self._expires[field]
+
+    def _add(self, field: str, value, timeout: float) -> bool:
+        if self.cache_alias:
+            return caches[self.cache_alias].add(
+                self.get_key(field), value, timeout)
+        with self._lock:
+            self._expire(field)
+            if field in self._state:
+                return False
+            self._state[field] = value
+            self._expires[field] = time.monotonic() + timeout
+            return True
+
+    def _incr(self, field: str) -> int:
+        if self.cache_alias:
+            return incr(caches[self.cache_alias], self.get_key(field))
+        with self._lock:
+            self._state[field] = self._state.get(field, 0) + 1
+            return self._state[field]
+
+    def _set(self, field: str, value) -> None:
+        if self.cache_alias:
+            caches[self.cache_alias].set(self.get_key(field), value, None)
+        else:
+            with self._lock:
+                self._state[field] = value
+
+    def _delete(self, *fields) -> None:
+        if self.cache_alias:
+            caches[self.cache_alias].delete_many(
+                [self.get_key(field) for field in fields])
+        else:
+            with self._lock:
+                for field in fields:
+                    self._state.pop(field, None)
+                    self._expires.pop(field, None)
+
+    @property
+    def state(self) -> str:
+        opened_until = self._get('opened_until')
+        if opened_until is None:
+            return self.CLOSED
+        if time.time() < opened_until:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        if self._add('trial', 1, self.recovery_timeout):
+            self.changed(self.HALF_OPEN)
+            return True
+        return False
+
+    def release(self) -> None:
+        """Give back the trial of a call that ended without an outcome."""
+        if self._get('opened_until') is not None:
+            self._delete('trial')
+
+    def record_success(self) -> None:
+        if self._get('opened_until') is not None:
+            self._delete('opened_until', 'trial', 'failures')
+            self.changed(self.CLOSED)
+        elif self._get('failures'):
+            self._delete('failures')
+
+    def record_failure(self) -> None:
+        half_open = self._get('opened_until') is not None
+        if half_open or self._incr('failures') >= self.failure_threshold:
+            self._set('opened_until', time.time() + self.recovery_timeout)
+            self._delete('trial', 'failures')
+            self.changed(self.OPEN)
+
+    def changed(self, state: str) -> None:
+        log = logger.info if state == self.CLOSED else logger.warning
+        log('MercadoPago circuit %s is %s', self.name, state)
+        circuit_state_changed.send(sender=type(self), name=self.name,
+                                   state=state)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str, **options) -> CircuitBreaker:
+    """Return the process-wide circuit breaker called ``name``."""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **options)
+        return _breakers[name]
@@ -0,0 +1,270 @@
+"""Offline reconciliation with MercadoPago settlement and release reports."""
+import csv
+import itertools
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from typing import IO, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from django.db import close_old_connections
+
+from payments import PaymentStatus, get_payment_model
+
+from .reconcile import save_payments
+from .transitions import PENDING_STATUSES
+
+
+SETTLED_FIELDS = ['status', 'transaction_id', 'captured_amount']
+
+# Settlement reports name the kind TRANSACTION_TYPE, release reports
+# DESCRIPTION, and their amounts TRANSACTION_AMOUNT and GROSS_AMOUNT
+KIND_COLUMNS = ('TRANSACTION_TYPE', 'DESCRIPTION')
+AMOUNT_COLUMNS = ('TRANSACTION_AMOUNT', 'GROSS_AMOUNT', 'AMOUNT')
+
+PAYMENT_KINDS = frozenset(['settlement', 'payment'])
+REFUND_KINDS = frozenset(['refund'])
+CHARGEBACK_KINDS = frozenset(['chargeback'])
+
+MISMATCH_COLUMNS = ('line', 'external_reference', 'source_id', 'kind',
+                    'amount', 'reason', 'status', 'captured_amount')
+
+
+class SettlementRow(NamedTuple):
+    line: int
+    reference: str
+    source_id: str
+    kind: str
+    amount: Decimal
+
+
+class Mismatch(NamedTuple):
+    row: SettlementRow
+    reason: str
+    status: str = ''
+    captured_amount: Optional[Decimal] = None
+
+
+def read_settlement_rows(stream: IO[str]) -> Iterator[SettlementRow]:
+    """Read the rows of a report that refer to an ``external_reference``.
+
+    The delimiter, comma or semicolon, is taken from the header line and
+    column names are matched case insensitively.
+    """
+    header = stream.readline()
+    if not header:
+        return
+    delimiter = ';' if header.count(';') > header.count(',') else ','
+    reader = csv.reader(itertools.chain([header], stream),
+                        delimiter=delimiter)
+    columns = [column.strip().upper() for column in next(reader)]
+    for line, values in enumerate(reader, 2):
+        row = dict(zip(columns, values))
+        reference = (row.get('EXTERNAL_REFERENCE') or '').strip()
+        if not reference:
+            # Payouts, fees and other account movements
+            continue
+        kind = next((row[column] for column in KIND_COLUMNS
+                     if row.get(column)), '')
+        amount = next((row[column] for column in AMOUNT_COLUMNS
+                       if row.get(column)), '0')
+        try:
+            amount = Decimal(amount.strip())
+        except InvalidOperation:
+            raise ValueError('Invalid amount %r on line %d' % (amount, line))
+        yield SettlementRow(line, reference,
+                            (row.get('SOURCE_ID') or '').strip(),
+                            kind.strip().lower(), amount)
+
+
+class MismatchReport:
+    """CSV file listing the rows that could not be applied."""
+
+    def __init__(self, stream: Optional[IO[str]]) -> None:
+        self.writer = None
+        if stream is not None:
+            self.writer = csv.writer(stream)
+            self.writer.writerow(MISMATCH_COLUMNS)
+
+    def write(self, mismatch: Mismatch) -> None:
+        if self.writer is None:
+            return
+        row = mismatch.row
+        self.writer.writerow((
+            row.line, row.reference, row.source_id, row.kind, row.amount,
+            mismatch.reason, mismatch.status,
+            '' if mismatch.captured_amount is None
+            else mismatch.captured_amount))
+
+
+def apply_settlement_row(payment, row: SettlementRow) -> Optional[str]:
+    """Update ``payment`` in memory from ``row``.
+
+    Returns the reason of a mismatch, or ``None`` when the payment agrees
+    with the report or was brought in line with it.
+    """
+    if row.kind in PAYMENT_KINDS:
+        if row.amount != payment.total:
+            return 'amount'
+        if payment.status in PENDING_STATUSES:
+            payment.status = PaymentStatus.CONFIRMED
+            payment.captured_amount = row.amount
+            payment.transaction_id = payment.transaction_id or row.source_id
+        elif payment.status == PaymentStatus.CONFIRMED:
+            if not payment.captured_amount:
+                payment.captured_amount = row.amount
+        elif payment.status != PaymentStatus.REFUNDED:
+            return 'status'
+        return None
+    if row.kind in REFUND_KINDS:
+        amount = abs(row.amount)
+        if payment.status == PaymentStatus.REFUNDED:
+            return None
+        if payment.status != PaymentStatus.CONFIRMED:
+            return 'status'
+        if amount >= payment.total:
+            payment.status = PaymentStatus.REFUNDED
+            payment.captured_amount = Decimal(0)
+        elif payment.captured_amount > payment.total - amount:
+            # A partial refund this site did not record
+            return 'refund'
+        return None
+    if row.kind in CHARGEBACK_KINDS:
+        return 'chargeback'
+    return None
+
+
+class SettlementImporter:
+    """Check payments against report rows, ``chunk_size`` rows at a time.
+
+    Every chunk loads its payments with one ``token__in`` query, writes the
+    corrections with one ``bulk_update`` and returns the rows that need a
+    human look. Rows are split by ``external_reference`` into ``workers``
+    lanes that run in parallel, while the chunks of a lane run in order, so
+    the rows of a payment are always applied one after the other. Only a
+    few chunks are kept ahead of the reader, so reports of any size use
+    bounded memory; a dry run also keeps the last ``max_unsaved`` payments
+    it changed, so later chunks see them.
+    """
+
+    def __init__(self, variants: List[str], workers: int = 1,
+                 dry_run: bool = False, max_unsaved: int = 10000) -> None:
+        self.variants = variants
+        self.workers = workers
+        self.dry_run = dry_run
+        self.max_unsaved = max_unsaved
+        self.stats = Counter()
+        self.seconds = 0.0
+        self._unsaved = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_lane(self, reference: str) -> int:
+        return zlib.crc32(reference.encode('utf-8')) % self.workers
+
+    def get_payments(self, references: set) -> dict:
+        manager = get_payment_model()._default_manager
+        return {str(payment.token): payment for payment in manager.filter(
+            token__in=references, variant__in=self.variants)}
+
+    def get_unsaved(self, references: set) -> dict:
+        """The payments a dry run changed in previous chunks."""
+        with self._lock:
+            return {reference: self._unsaved[reference]
+                    for reference in references if reference in self._unsaved}
+
+    def keep_unsaved(self, payments: Iterable) -> None:
+        with self._lock:
+            for payment in payments:
+                reference = str(payment.token)
+                self._unsaved[reference] = payment
+                self._unsaved.move_to_end(reference)
+            while len(self._unsaved) > self.max_unsaved:
+                # Rows of a payment are usually close in a report
+                self._unsaved.popitem(last=False)
+
+    def process(self, chunk: List[SettlementRow]) -> Tuple[list, list, Counter]:
+        """Return the changed payments, the mismatches and the counts."""
+        try:
+            references = {row.reference for row in chunk}
+            payments = self.get_payments(references)
+            if self.dry_run:
+                payments.update(self.get_unsaved(references))
+            return self.match(chunk, payments)
+        finally:
+            close_old_connections()
+
+    def match(self, chunk: List[SettlementRow],
+              payments: dict) -> Tuple[list, list, Counter]:
+        stats = Counter()
+        mismatches = []
+        updated = {}
+        changed = {}
+        for row in chunk:
+            stats['rows'] += 1
+            payment = payments.get(row.reference)
+            if payment is None:
+                stats['not_found'] += 1
+                mismatches.append(Mismatch(row, 'not_found'))
+                continue
+            before = (payment.status, payment.captured_amount,
+                      payment.transaction_id)
+            status = payment.status
+            reason = apply_settlement_row(payment, row)
+            if reason:
+                stats[reason] += 1
+                mismatches.append(Mismatch(
+                    row, reason, payment.status, payment.captured_amount))
+                continue
+            if before == (payment.status, payment.captured_amount,
+                          payment.transaction_id):
+                stats['matched'] += 1
+                continue
+            stats['applied'] += 1
+            updated[payment.pk] = payment
+            if payment.status != status:
+                changed[payment.pk] = payment
+        changed = list(changed.values())
+        if updated and self.dry_run:
+            self.keep_unsaved(updated.values())
+        elif updated:
+            changed = save_payments(list(updated.values()), changed,
+                                    SETTLED_FIELDS)
+        return changed, mismatches, stats
+
+    def run(self, rows: Iterable[SettlementRow], chunk_size: int = 1000,
+            report: MismatchReport = None) -> Iterator:
+        """Yield the payments whose status changed, chunk after chunk."""
+        report = report or MismatchReport(None)
+        start = time.monotonic()
+        # One thread per lane runs its chunks in submission order
+        lanes = [ThreadPoolExecutor(1) for number in range(self.workers)]
+        try:
+            chunks = [[] for number in range(self.workers)]
+            pending = deque()
+            for row in rows:
+                lane = self.get_lane(row.reference)
+                chunks[lane].append(row)
+                if len(chunks[lane]) < chunk_size:
+                    continue
+                pending.append(lanes[lane].submit(self.process, chunks[lane]))
+                chunks[lane] = []
+                if len(pending) >= 2 * self.workers:
+                    yield from self.record(pending.popleft().result(), report)
+            for lane, chunk in enumerate(chunks):
+                if chunk:
+                    pending.append(lanes[lane].submit(self.process, chunk))
+            while pending:
+                yield from self.record(pending.popleft().result(), report)
+        finally:
+            for executor in lanes:
+                executor.shutdown()
+            self.seconds += time.monotonic() - start
+
+    def record(self, result: tuple, report: MismatchReport) -> list:
+        changed, mismatches, stats = result
+        self.stats.update(stats)
+        for mismatch in mismatches:
+            report.write(mismatch)
+        return changed
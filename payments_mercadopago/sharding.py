@@ -0,0 +1,181 @@
+"""Spread the payments of one variant over several MercadoPago accounts."""
+import hashlib
+import json
+import logging
+from typing import TYPE_CHECKING, List, Optional
+
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpRequest, HttpResponse
+
+from payments import PaymentError
+
+if TYPE_CHECKING:
+    from payments.models import BasePayment
+
+from . import MercadoPagoProvider
+from .resilience import CircuitBreaker
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_unavailable(error: PaymentError) -> bool:
+    """Whether another account may succeed where this one failed."""
+    return error.code == 429 or (error.code or 0) >= 500
+
+
+class ShardedMercadoPagoProvider(MercadoPagoProvider):
+    """Route every payment to one of several MercadoPago accounts.
+
+    ``accounts`` is a list of dicts with the credentials of each account,
+    ``access_token`` or ``client_id`` and ``client_secret``, an optional
+    ``name`` and any option that differs from the shared ``kwargs``. A new
+    payment goes to the account its token hashes to, or to the next healthy
+    one when that account fails; the account is stored in ``extra_data`` so
+    notifications, refunds and cancellations use it afterwards.
+
+    Every account has its own circuit breaker, enabled with a threshold of
+    5 failures unless ``circuit_breaker_threshold`` says otherwise, and its
+    own rate limits.
+    """
+
+    def __init__(self, accounts: List[dict], **kwargs) -> None:
+        if not accounts:
+            raise ImproperlyConfigured(
+                'ShardedMercadoPagoProvider requires at least one account.')
+        kwargs.setdefault('circuit_breaker_threshold', 5)
+        self.shards = {}
+        for index, account in enumerate(accounts):
+            account = dict(account)
+            name = str(account.pop('name', index))
+            if name in self.shards:
+                raise ImproperlyConfigured(
+                    'Duplicated MercadoPago account name %r.' % name)
+            shard = MercadoPagoProvider(**dict(kwargs, **account))
+            shard.shard = name
+            self.shards[name] = shard
+        self.shard_names = list(self.shards)
+        secured = [bool(shard.webhook_secret)
+                   for shard in self.shards.values()]
+        if any(secured) and not all(secured):
+            # An unsigned account would accept any notification
+            raise ImproperlyConfigured(
+                'Set a webhook_secret for every MercadoPago account or for '
+                'none of them.')
+        first_account = dict(accounts[0])
+        first_account.pop('name', None)
+        super(ShardedMercadoPagoProvider, self).__init__(
+            **dict(kwargs, **first_account))
+
+    def get_recorded_shard(self, payment: 'BasePayment') -> Optional[str]:
+        try:
+            extra_data = json.loads(payment.extra_data or '{}')
+        except ValueError:
+            return None
+        if isinstance(extra_data, dict):
+            return extra_data.get('shard')
+        return None
+
+    def get_candidates(self, payment: 'BasePayment') -> List[MercadoPagoProvider]:
+        """The accounts in the order ``payment`` tries them."""
+        digest = hashlib.sha256(str(payment.token).encode('utf-8')).hexdigest()
+        start = int(digest, 16) % len(self.shard_names)
+        names = self.shard_names[start:] + self.shard_names[:start]
+        recorded = self.get_recorded_shard(payment)
+        if recorded in self.shards:
+            names.remove(recorded)
+            names.insert(0, recorded)
+        return [self.shards[name] for name in names]
+
+    def for_payment(self, payment: 'BasePayment') -> MercadoPagoProvider:
+        return self.get_candidates(payment)[0]
+
+    def is_healthy(self, shard: MercadoPagoProvider) -> bool:
+        return (shard.circuit_breaker is None
+                or shard.circuit_breaker.state != CircuitBreaker.OPEN)
+
+    def get_health(self) -> dict:
+        """Map every account name to the state of its circuit breaker."""
+        return {name: shard.circuit_breaker.state if shard.circuit_breaker
+                else CircuitBreaker.CLOSED
+                for name, shard in self.shards.items()}
+
+    def get_form(self, payment: 'BasePayment', data=None):
+        candidates = self.get_candidates(payment)
+        if payment.transaction_id or self.direct_payments:
+            # Paid through its account already, or card tokens created
+            # with the public key of the account
+            candidates = candidates[:1]
+        healthy = [shard for shard in candidates if self.is_healthy(shard)]
+        candidates = healthy or candidates[:1]
+        for shard in candidates[:-1]:
+            try:
+                return shard.get_form(payment, data)
+            except PaymentError as error:
+                if not is_unavailable(error):
+                    raise
+                logger.warning('MercadoPago account %s failed, trying the '
+                               'next one: %s', shard.shard, error,
+                               extra={'payment': payment.token})
+        return candidates[-1].get_form(payment, data)
+
+    def process_data(self, payment: 'BasePayment', request: HttpRequest) -> HttpResponse:
+        return self.for_payment(payment).process_data(payment, request)
+
+    def process_notification(self, payment: 'BasePayment', collection_id: int,
+                             payment_information: dict = None) -> None:
+        self.for_payment(payment).process_notification(
+            payment, collection_id, payment_information)
+
+    def process_merchant_order(self, payment: 'BasePayment', order_id: int,
+                               order_information: dict = None) -> None:
+        self.for_payment(payment).process_merchant_order(
+            payment, order_id, order_information)
+
+    def update_payment(self, payment: 'BasePayment', collection_id: int,
+                       payment_information: dict) -> None:
+        self.for_payment(payment).update_payment(
+            payment, collection_id, payment_information)
+
+    def store_response(self, payment: 'BasePayment', event: str, response: dict) -> None:
+        self.for_payment(payment).store_response(payment, event, response)
+
+    def refund(self, payment: 'BasePayment', amount=None,
+               idempotency_key: str = None):
+        return self.for_payment(payment).refund(
+            payment, amount, idempotency_key)
+
+    def cancel(self, payment: 'BasePayment') -> None:
+        self.for_payment(payment).cancel(payment)
+
+    def verify_signature(self, request: HttpRequest, resource_id: str) -> bool:
+        secured = [shard for shard in self.shards.values()
+                   if shard.webhook_secret]
+        if not secured:
+            return True
+        return any(shard.verify_signature(request, resource_id)
+                   for shard in secured)
+
+    def find(self, method: str, resource_id, **kwargs) -> dict:
+        """Ask every account for a resource whose account is unknown."""
+        error = None
+        for shard in self.shards.values():
+            try:
+                return getattr(shard, method)(resource_id, **kwargs)
+            except PaymentError as exception:
+                error = exception
+        raise error
+
+    def get_payment_information(self, payment_id: int, cached: bool = False) -> dict:
+        return self.find('get_payment_information', payment_id,
+                         cached=cached)
+
+    def get_merchant_order_information(self, order_id: int) -> dict:
+        return self.find('get_merchant_order_information', order_id)
+
+    def search_payment_by_reference(self, external_reference: str) -> Optional[dict]:
+        for shard in self.shards.values():
+            result = shard.search_payment_by_reference(external_reference)
+            if result is not None:
+                return result
+        return None
@@ -0,0 +1,14 @@
+from django.dispatch import Signal
+
+# Sent before every instrumented operation, either an outbound MercadoPago
+# call (outbound=True) or a provider entry point like get_form.
+# Arguments: operation, outbound
+call_started = Signal()
+
+# Sent after every instrumented operation, even when it failed.
+# Arguments: operation, outbound, duration, status_code, error
+call_finished = Signal()
+
+# Sent when a circuit breaker opens, closes or lets a trial call through.
+# Arguments: name, state
+circuit_state_changed = Signal()
@@ -0,0 +1,152 @@
+"""Push payment status changes to the pages waiting for them.
+
+Status changes are published to a broker when ``status_changed`` is sent,
+once the transaction that sent it commits. Waiters of the same process are
+woken right away; with a cache the status is also stored there, and waiters
+of other processes read it from the cache instead of querying the payment
+table.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Iterator, Optional
+
+from django.core.cache import caches
+from django.db import router, transaction
+
+from payments.core import provider_factory
+
+from .transitions import PENDING_STATUSES, is_forward
+
+
+class StatusBroker:
+    """Publish the statuses of payments and wait for them by token.
+
+    The last ``max_size`` statuses are kept in the process so a change
+    published just before a waiter subscribes is not missed.
+    """
+    prefix = 'mercadopago:stream'
+
+    def __init__(self, cache_alias: str = None, ttl: int = 3600,
+                 poll_interval: float = 0.5, max_size: int = 10000) -> None:
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._statuses = OrderedDict()
+        self._subscribers = {}
+
+    def get_key(self, token: str) -> str:
+        return '%s:%s' % (self.prefix, token)
+
+    def publish(self, token: str, status: str) -> None:
+        token = str(token)
+        if self.cache_alias:
+            caches[self.cache_alias].set(self.get_key(token), status, self.ttl)
+        with self._lock:
+            self._statuses[token] = status
+            self._statuses.move_to_end(token)
+            while len(self._statuses) > self.max_size:
+                self._statuses.popitem(last=False)
+            for event in self._subscribers.get(token, ()):
+                event.set()
+
+    def get(self, token: str) -> Optional[str]:
+        with self._lock:
+            status = self._statuses.get(token)
+        if self.cache_alias:
+            # Another process may have published a newer status
+            cached = caches[self.cache_alias].get(self.get_key(token))
+            if cached is not None and (
+                    status is None or is_forward(status, cached)):
+                status = cached
+        return status
+
+    def wait(self, token: str, status: str, timeout: float) -> Optional[str]:
+        """Return the first status after ``status``, ``None`` on timeout."""
+        token = str(token)
+        event = threading.Event()
+        with self._lock:
+            self._subscribers.setdefault(token, []).append(event)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                event.clear()
+                current = self.get(token)
+                if current is not None and is_forward(status, current):
+                    return current
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                if self.cache_alias:
+                    # Changes of other processes only reach the cache
+                    remaining = min(remaining, self.poll_interval)
+                event.wait(remaining)
+        finally:
+            with self._lock:
+                subscribers = self._subscribers[token]
+                subscribers.remove(event)
+                if not subscribers:
+                    del self._subscribers[token]
+
+
+def format_event(status: str) -> str:
+    return 'event: status\ndata: %s\n\n' % json.dumps({'status': status})
+
+
+def stream_statuses(broker: StatusBroker, token: str, status: str,
+                    duration: float = 300,
+                    heartbeat: float = 15) -> Iterator[str]:
+    """Server-Sent Events with every status until a final one.
+
+    The stream ends after ``duration`` seconds, browsers reconnect by
+    themselves.
+    """
+    yield format_event(status)
+    deadline = time.monotonic() + duration
+    while status in PENDING_STATUSES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        new_status = broker.wait(token, status, min(heartbeat, remaining))
+        if new_status is None:
+            yield ': keep-alive\n\n'
+            continue
+        status = new_status
+        yield format_event(status)
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_status_broker(cache_alias: str = None, **options) -> StatusBroker:
+    """Return the process-wide broker of ``cache_alias``."""
+    with _brokers_lock:
+        if cache_alias not in _brokers:
+            _brokers[cache_alias] = StatusBroker(cache_alias, **options)
+        return _brokers[cache_alias]
+
+
+def publish_status(sender, instance, **kwargs) -> None:
+    """``status_changed`` receiver publishing the new status.
+
+    Inside a transaction the status is published on commit, so a change
+    rolled back is never pushed.
+    """
+    try:
+        provider = provider_factory(instance.variant)
+    except ValueError:
+        return
+    broker = getattr(provider, 'status_broker', None)
+    if broker is None:
+        return
+    publish = partial(broker.publish, instance.token, instance.status)
+    database = router.db_for_write(type(instance))
+    if transaction.get_connection(database).in_atomic_block:
+        transaction.on_commit(publish, using=database)
+    else:
+        publish()
@@ -1,14 +1,59 @@
 from __future__ import unicode_literals
+import asyncio
+import hashlib
+import hmac
+import io
 import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
 from decimal import Decimal
-from unittest import TestCase
-from mock import patch, MagicMock, Mock
+from functools import partial
+from unittest import TestCase, skipIf
+from mock import ANY, patch, MagicMock, Mock
 
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from requests.exceptions import ConnectTimeout
 from django.http import HttpResponse
+from django.test import RequestFactory, TestCase as DatabaseTestCase
 from django.utils import timezone
 
 from . import MercadoPagoProvider
+try:
+    from .aio import AsyncMercadoPagoProvider, httpx
+except ImportError:
+    # Django without asgiref
+    AsyncMercadoPagoProvider = httpx = None
+from .apps import PaymentsMercadoPagoConfig
+from . import client as mercadopago_client
+from .cache import incr
+from .client import clear_clients, get_client
+from .expiry import PaymentSweeper
+from .items import aggregate_items
+from .models import MercadoPagoResponse
+from .oauth import TokenManager
+from .queues import LocalQueue, shutdown_queues
+from .ratelimit import RateLimits, TokenBucket, low_priority
+from .reconcile import Reconciler
+from .refunds import (
+    BulkRefunder, RefundLog, RefundOutcome, RefundRequest, read_refund_requests)
+from .resilience import CircuitBreaker
+from .settlements import (
+    MismatchReport, SettlementImporter, read_settlement_rows)
+from .sharding import ShardedMercadoPagoProvider
+from .signals import call_finished, circuit_state_changed
+from .streams import StatusBroker, publish_status
+from .testing import FakeMercadoPago
+from .transitions import EXPIRED_MESSAGE, is_forward, transition
+from .views import parse_notification, payment_status, webhook
 from payments import PurchasedItem, RedirectNeeded, PaymentError, PaymentStatus
+from payments.signals import status_changed
+from testapp.models import Payment as PaymentModel
 
 CLIENT_ID = 'Mercado Pago Test User'
 PAYMENT_TOKEN = '5a4dae68-2715-4b1e-8bb2-2c2dbe9255f6'
@@ -19,6 +64,15 @@ INIT_POINT_URL = 'http://mercadopago.com/redirecttopayment'
 VARIANT = 'wallet'
 CURRENCY = 'MXN'
 
+def run_async(coroutine):
+    """``asyncio.run`` for Python 3.6."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
 class Payment(Mock):
     id = 1
     description = 'payment'
@@ -206,3 +260,1966 @@ class TestMercadoPagoProvider(TestCase):
         }
         with self.assertRaises(PaymentError) as exc:
             self.provider.create_payment(self.payment)
+
+
+class TestAsyncWebhooks(TestCase):
+
+    def setUp(self):
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True,
+            async_webhooks=True,
+            webhook_queue_options={'workers': 2, 'maxsize': 10})
+
+    def tearDown(self):
+        shutdown_queues()
+
+    @patch('mercadopago.MP.get_payment')
+    def test_process_data_acknowledges_before_processing(
+            self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'approved'
+            }
+        }
+        request = MagicMock()
+        request.GET = {'data.id': '123456', 'type': 'payment'}
+        response = self.provider.process_data(self.payment, request)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.provider.webhook_queue.drain(timeout=5))
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.transaction_id, '123456')
+
+    @patch('mercadopago.MP.get_payment')
+    def test_process_data_falls_back_to_sync_when_queue_rejects(
+            self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'approved'
+            }
+        }
+        self.provider.webhook_queue = Mock()
+        self.provider.webhook_queue.submit.return_value = False
+        request = MagicMock()
+        request.GET = {'data.id': '123456', 'type': 'payment'}
+        self.provider.process_data(self.payment, request)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+
+    def test_local_queue_shutdown_discards_without_wait(self):
+        local_queue = LocalQueue(workers=1, maxsize=5)
+        release = threading.Event()
+        calls = []
+        local_queue.submit(release.wait)
+        local_queue.submit(calls.append, 1)
+        local_queue.shutdown(wait=False, timeout=0.1)
+        release.set()
+        self.assertFalse(local_queue.submit(calls.append, 2))
+        self.assertEqual(calls, [])
+
+    def test_local_queue_retries_failed_jobs(self):
+        local_queue = LocalQueue(workers=1, retries=2, retry_backoff=0)
+        self.addCleanup(local_queue.shutdown)
+        job = Mock(side_effect=[PaymentError('unavailable'), None])
+        local_queue.submit(job, 1)
+        self.assertTrue(local_queue.drain(timeout=5))
+        self.assertEqual(job.call_count, 2)
+
+    def test_local_queue_restarts_workers_after_fork(self):
+        local_queue = LocalQueue(workers=1)
+        self.addCleanup(local_queue.shutdown)
+        local_queue.submit(len, [])
+        self.assertTrue(local_queue.drain(timeout=5))
+        # A forked child inherits the list of threads, not the threads
+        local_queue._threads = [Mock(is_alive=Mock(return_value=False))]
+        local_queue.after_fork()
+        calls = []
+        local_queue.submit(calls.append, 1)
+        self.assertTrue(local_queue.drain(timeout=5))
+        self.assertEqual(calls, [1])
+
+
+class TestNotificationCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True,
+            notification_cache_ttl=60)
+        self.request = MagicMock()
+        self.request.GET = {'data.id': '123456', 'type': 'payment'}
+
+    def test_incr_recreates_an_evicted_counter(self):
+        self.assertEqual(incr(cache, 'counter', timeout=60), 1)
+        self.assertEqual(incr(cache, 'counter', 2, timeout=60), 3)
+        evicting = MagicMock()
+        evicting.incr.side_effect = ValueError('evicted')
+        self.assertEqual(incr(evicting, 'counter', 2, timeout=60), 2)
+        evicting.set.assert_called_once_with('counter', 2, 60)
+
+    @patch('mercadopago.MP.get_payment')
+    def test_repeated_notification_skips_outbound_call(
+            self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'approved'
+            }
+        }
+        self.provider.process_data(self.payment, self.request)
+        self.provider.process_data(self.payment, self.request)
+        self.assertEqual(mocked_get_payment.call_count, 1)
+        self.assertEqual(self.provider.notification_cache.stats(),
+                         {'hits': 1, 'misses': 1})
+
+    @patch('mercadopago.MP.get_payment')
+    def test_approval_after_pending_notification_is_processed(
+            self, mocked_get_payment):
+        mocked_get_payment.side_effect = [
+            {'status': 200, 'response': {'status': 'in_process'}},
+            {'status': 200, 'response': {'status': 'approved'}}]
+        self.provider.process_data(self.payment, self.request)
+        self.assertEqual(self.payment.status, PaymentStatus.WAITING)
+        self.provider.process_data(self.payment, self.request)
+        self.assertEqual(mocked_get_payment.call_count, 2)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+
+    @patch('mercadopago.MP.get_payment')
+    def test_status_change_makes_notification_new(self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'pending'
+            }
+        }
+        self.provider.process_data(self.payment, self.request)
+        self.payment.status = PaymentStatus.INPUT
+        self.provider.process_data(self.payment, self.request)
+        self.assertEqual(mocked_get_payment.call_count, 2)
+
+    @patch('mercadopago.MP.get_payment')
+    def test_failed_notification_is_released(self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 500,
+            'response': {
+                'message': 'internal error'
+            }
+        }
+        with self.assertRaises(PaymentError):
+            self.provider.process_data(self.payment, self.request)
+        with self.assertRaises(PaymentError):
+            self.provider.process_data(self.payment, self.request)
+        self.assertEqual(mocked_get_payment.call_count, 2)
+
+
+class TestClientRegistry(TestCase):
+
+    def tearDown(self):
+        clear_clients()
+
+    def test_providers_share_client_per_credentials(self):
+        first = MercadoPagoProvider(access_token=ACCESS_TOKEN,
+                                    sandbox_mode=True)
+        second = MercadoPagoProvider(access_token=ACCESS_TOKEN,
+                                     sandbox_mode=True)
+        other = MercadoPagoProvider(access_token=ACCESS_TOKEN,
+                                    sandbox_mode=False)
+        self.assertIs(first.mp, second.mp)
+        self.assertIsNot(first.mp, other.mp)
+
+    def test_client_reuses_session_with_default_timeout(self):
+        client = get_client(ACCESS_TOKEN, pool_size=3, timeout=5)
+        rest_client = client._MP__rest_client
+        session = rest_client.get_session()
+        self.assertIs(session, rest_client.get_session())
+        adapter = session.get_adapter('https://api.mercadopago.com')
+        self.assertEqual(adapter.timeout, 5)
+        self.assertEqual(adapter._pool_maxsize, 3)
+
+    def test_refreshed_token_replaces_the_client_of_the_account(self):
+        first = get_client('APP_USR-1', account='client')
+        second = get_client('APP_USR-2', account='client')
+        self.assertIsNot(first, second)
+        self.assertIs(second, get_client('APP_USR-2', account='client'))
+        self.assertIs(first._MP__rest_client.get_session(),
+                      second._MP__rest_client.get_session())
+        self.assertEqual(len(mercadopago_client._clients), 1)
+
+
+class TestPreferenceCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True,
+            preference_cache_ttl=600)
+
+    @patch('mercadopago.MP.create_preference')
+    def test_unchanged_payment_reuses_preference(
+            self, mocked_create_preference):
+        mocked_create_preference.return_value = {
+            'status': 201,
+            'response': {
+                'id': 'preference-id',
+                'sandbox_init_point': SANDBOX_INIT_POINT_URL,
+                'init_point': INIT_POINT_URL
+            }
+        }
+        for attempt in range(2):
+            with self.assertRaises(RedirectNeeded) as exc:
+                self.provider.get_form(payment=self.payment)
+            self.assertEqual(exc.exception.args[0], SANDBOX_INIT_POINT_URL)
+        self.assertEqual(mocked_create_preference.call_count, 1)
+
+    @patch('mercadopago.MP.create_preference')
+    def test_changed_payment_creates_new_preference(
+            self, mocked_create_preference):
+        mocked_create_preference.return_value = {
+            'status': 201,
+            'response': {
+                'sandbox_init_point': SANDBOX_INIT_POINT_URL,
+                'init_point': INIT_POINT_URL
+            }
+        }
+        self.provider.create_payment(self.payment)
+        self.payment.delivery = Decimal(20)
+        self.provider.create_payment(self.payment)
+        self.assertEqual(mocked_create_preference.call_count, 2)
+
+    @patch('mercadopago.MP.create_preference')
+    def test_expiring_preference_is_reused(self, mocked_create_preference):
+        mocked_create_preference.return_value = {
+            'status': 201,
+            'response': {
+                'sandbox_init_point': SANDBOX_INIT_POINT_URL,
+                'init_point': INIT_POINT_URL
+            }
+        }
+        self.provider.preference_expiration = 3600
+        self.provider.create_payment(self.payment)
+        preference = mocked_create_preference.call_args[0][0]
+        self.assertTrue(preference['expires'])
+        self.assertLess(preference['expiration_date_from'],
+                        preference['expiration_date_to'])
+        time.sleep(0.002)
+        self.provider.create_payment(self.payment)
+        self.assertEqual(mocked_create_preference.call_count, 1)
+
+
+class TestReconcile(TestCase):
+
+    def setUp(self):
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True)
+
+    @patch('mercadopago.MP.search_payment')
+    def test_search_payment_by_reference_prefers_approved(
+            self, mocked_search_payment):
+        mocked_search_payment.return_value = {
+            'status': 200,
+            'response': {
+                'results': [
+                    {'id': 2, 'status': 'rejected'},
+                    {'id': 1, 'status': 'approved'}
+                ]
+            }
+        }
+        result = self.provider.search_payment_by_reference(PAYMENT_TOKEN)
+        self.assertEqual(result['response']['id'], 1)
+        self.assertEqual(
+            mocked_search_payment.call_args[0][0]['external_reference'],
+            PAYMENT_TOKEN)
+
+    @patch('mercadopago.MP.search_payment')
+    def test_reconciler_confirms_payment_found_by_reference(
+            self, mocked_search_payment):
+        mocked_search_payment.return_value = {
+            'status': 200,
+            'response': {
+                'results': [{'id': 42, 'status': 'approved'}]
+            }
+        }
+        reconciler = Reconciler(workers=2, rate=0, dry_run=True)
+        with patch('payments_mercadopago.reconcile.provider_factory',
+                   return_value=self.provider):
+            changed = reconciler.reconcile([self.payment])
+        self.assertEqual(changed, [self.payment])
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.transaction_id, '42')
+        self.assertEqual(self.payment.captured_amount, self.payment.total)
+        self.assertEqual(reconciler.stats['changed'], 1)
+
+    @patch('mercadopago.MP.search_payment')
+    def test_reconciler_counts_payments_not_found(
+            self, mocked_search_payment):
+        mocked_search_payment.return_value = {
+            'status': 200,
+            'response': {
+                'results': []
+            }
+        }
+        reconciler = Reconciler(workers=2, rate=0, dry_run=True)
+        with patch('payments_mercadopago.reconcile.provider_factory',
+                   return_value=self.provider):
+            changed = reconciler.reconcile([self.payment])
+        self.assertEqual(changed, [])
+        self.assertEqual(reconciler.stats['not_found'], 1)
+        self.assertEqual(self.payment.status, PaymentStatus.WAITING)
+
+
+class TestReconcileCommand(DatabaseTestCase):
+
+    def setUp(self):
+        self.payments = [
+            PaymentModel.objects.create(
+                variant=VARIANT, token='token-%d' % number,
+                currency=CURRENCY, total=Decimal(100),
+                status=PaymentStatus.WAITING)
+            for number in range(3)]
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'checkpoint.json')
+        self.provider = MercadoPagoProvider(access_token=ACCESS_TOKEN)
+
+    def reconcile(self, failing=()):
+        looked_up = []
+
+        def fetch(provider, payment):
+            looked_up.append(payment.pk)
+            if payment.pk in failing:
+                raise PaymentError('MercadoPago is down')
+            return None
+
+        with patch('payments_mercadopago.reconcile.provider_factory',
+                   return_value=self.provider), \
+                patch('payments_mercadopago.reconcile.'
+                      'fetch_payment_information', side_effect=fetch):
+            call_command('reconcile_mercadopago', '--variant', VARIANT,
+                         '--batch-size', '2', '--rate', '0',
+                         '--checkpoint', self.path, stdout=io.StringIO())
+        return sorted(looked_up)
+
+    def test_checkpoint_stops_before_failed_lookups(self):
+        pks = [payment.pk for payment in self.payments]
+        self.assertEqual(self.reconcile(failing={pks[1]}), pks)
+        with open(self.path) as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file), {'last_pk': pks[0]})
+        self.assertEqual(self.reconcile(), pks[1:])
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.reconcile(), pks)
+
+
+@skipIf(httpx is None, 'httpx is not installed')
+class TestAsyncMercadoPagoProvider(TestCase):
+
+    def setUp(self):
+        self.payment = Payment()
+        self.provider = AsyncMercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True)
+        self.requests = []
+
+    @patch('payments_mercadopago.aio.reverse', return_value='/process/')
+    @patch('payments_mercadopago.reverse', return_value='/webhook/')
+    def test_notification_url_honours_dedicated_webhook(
+            self, mocked_reverse, mocked_async_reverse):
+        self.assertEqual(self.provider.create_notification_url(self.payment),
+                         'https://example.org/process/')
+        provider = AsyncMercadoPagoProvider(
+            access_token=ACCESS_TOKEN, dedicated_webhook=True)
+        self.assertEqual(provider.create_notification_url(self.payment),
+                         'https://example.org/webhook/')
+        self.assertEqual(mocked_reverse.call_args[0][0],
+                         'mercadopago_webhook')
+
+    def mock_api(self, status, body):
+        def handler(request):
+            self.requests.append(request)
+            return httpx.Response(status, json=body)
+        client = httpx.AsyncClient(base_url='https://api.mercadopago.com',
+                                   transport=httpx.MockTransport(handler))
+        return patch.object(self.provider, 'get_http_client',
+                            return_value=client)
+
+    def test_aprocess_data_handles_payment_info(self):
+        request = MagicMock()
+        request.GET = {'data.id': '123456', 'type': 'payment'}
+        with self.mock_api(200, {'status': 'approved'}):
+            response = run_async(
+                self.provider.aprocess_data(self.payment, request))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.captured_amount, self.payment.total)
+        self.assertEqual(self.requests[0].url.path, '/v1/payments/123456')
+        self.assertEqual(self.requests[0].headers['Authorization'],
+                         'Bearer %s' % ACCESS_TOKEN)
+
+    def test_aget_form_redirects_to_init_point(self):
+        body = {'sandbox_init_point': SANDBOX_INIT_POINT_URL,
+                'init_point': INIT_POINT_URL}
+        with self.mock_api(201, body), \
+                patch.object(self.provider, 'create_notification_url',
+                             return_value='http://example.com/notify'):
+            with self.assertRaises(RedirectNeeded) as exc:
+                run_async(self.provider.aget_form(self.payment))
+        self.assertEqual(exc.exception.args[0], SANDBOX_INIT_POINT_URL)
+        self.assertEqual(self.payment.status, PaymentStatus.WAITING)
+        self.assertEqual(self.requests[0].method, 'POST')
+
+    def test_acancel_raises_payment_error_on_failure(self):
+        self.payment.transaction_id = '123456'
+        with self.mock_api(400, {'message': 'invalid status'}):
+            with self.assertRaises(PaymentError):
+                run_async(self.provider.acancel(self.payment))
+
+    def test_circuit_and_rate_limits_run_off_the_event_loop(self):
+        provider = AsyncMercadoPagoProvider(
+            access_token='TEST_ASYNC_OFF_LOOP', circuit_breaker_threshold=5,
+            rate_limits={'get_payment': 100})
+        threads = []
+        record = lambda *args, **kwargs: threads.append(
+            threading.current_thread())
+        client = httpx.AsyncClient(
+            base_url='https://api.mercadopago.com',
+            transport=httpx.MockTransport(
+                lambda request: httpx.Response(200, json={})))
+
+        async def get_payment():
+            threads.append(threading.current_thread())
+            await provider.aget_payment_information('1')
+
+        with patch.object(provider, 'get_http_client', return_value=client), \
+                patch.object(provider, 'check_circuit', side_effect=record), \
+                patch.object(provider.rate_limits, 'get_delay',
+                             side_effect=lambda *args: record() or 0), \
+                patch.object(provider, 'record_outcome', side_effect=record):
+            run_async(get_payment())
+        loop_thread = threads.pop(0)
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(loop_thread, threads)
+
+    def test_transport_errors_are_unavailable(self):
+        def handler(request):
+            raise httpx.ConnectError('refused', request=request)
+        client = httpx.AsyncClient(base_url='https://api.mercadopago.com',
+                                   transport=httpx.MockTransport(handler))
+        with patch.object(self.provider, 'get_http_client',
+                          return_value=client):
+            with self.assertRaises(PaymentError) as exc:
+                run_async(self.provider.aget_payment_information('1'))
+        self.assertEqual(exc.exception.code, 502)
+
+
+class TestCompactExtraData(TestCase):
+
+    def setUp(self):
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True,
+            extra_data_mode='compact', archive_responses=True)
+
+    @patch('payments_mercadopago.models.MercadoPagoResponse.save')
+    @patch('mercadopago.MP.get_payment')
+    def test_compact_mode_keeps_projection_and_archives_response(
+            self, mocked_get_payment, mocked_save):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'id': 123456,
+                'status': 'approved',
+                'status_detail': 'accredited',
+                'transaction_amount': 100,
+                'transaction_details': {'total_paid_amount': 100},
+                'payer': {'email': 'false@email.com'},
+                'card': {'first_six_digits': '450995'}
+            }
+        }
+        self.provider.store_payment_information(
+            self.payment, '123456',
+            self.provider.get_payment_information('123456'))
+        self.assertEqual(json.loads(self.payment.extra_data), {
+            'status': 200,
+            'response': {
+                'id': 123456,
+                'status': 'approved',
+                'status_detail': 'accredited',
+                'transaction_amount': 100,
+                'total_paid_amount': 100
+            }
+        })
+        self.assertEqual(mocked_save.call_count, 1)
+
+    def test_archived_response_round_trips_compressed(self):
+        response = {'status': 200, 'response': {'id': 1}}
+        archived = MercadoPagoResponse.build(PAYMENT_TOKEN, 'payment',
+                                             response)
+        self.assertTrue(archived.compressed)
+        self.assertEqual(archived.get_response(), response)
+
+
+class TestSlimCommand(DatabaseTestCase):
+
+    def setUp(self):
+        self.extra_data = json.dumps({
+            'status': 200,
+            'response': {'id': 1, 'status': 'approved',
+                         'payer': {'email': 'false@email.com'}}})
+        self.payments = [
+            PaymentModel.objects.create(
+                variant=VARIANT, token='token-%d' % number,
+                currency=CURRENCY, total=Decimal(100),
+                extra_data=self.extra_data)
+            for number in range(3)]
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'checkpoint.json')
+        self.provider = MercadoPagoProvider(access_token=ACCESS_TOKEN)
+
+    def slim(self, raced=None):
+        get_compact_response = self.provider.get_compact_response
+
+        def compact(response):
+            if raced is not None:
+                # A notification stores a new response meanwhile
+                PaymentModel.objects.filter(pk=raced).update(
+                    extra_data=self.extra_data + ' ')
+            return get_compact_response(response)
+
+        with patch('payments_mercadopago.management.commands.'
+                   'slim_mercadopago_extra_data.provider_factory',
+                   return_value=self.provider), \
+                patch.object(self.provider, 'get_compact_response',
+                             side_effect=compact):
+            call_command('slim_mercadopago_extra_data', '--variant', VARIANT,
+                         '--batch-size', '2', '--checkpoint', self.path,
+                         stdout=io.StringIO())
+
+    def test_checkpoint_stops_before_skipped_payments(self):
+        pks = [payment.pk for payment in self.payments]
+        self.slim(raced=pks[1])
+        with open(self.path) as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file), {'last_pk': pks[0]})
+        self.slim()
+        self.assertFalse(os.path.exists(self.path))
+        for payment in PaymentModel.objects.all():
+            self.assertNotIn('payer', payment.extra_data)
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True,
+            metrics_backend='payments_mercadopago.metrics.InMemoryMetrics')
+        self.provider.metrics.reset()
+
+    @patch('mercadopago.MP.get_payment')
+    def test_process_data_records_outbound_and_flow_metrics(
+            self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 404,
+            'response': {
+                'message': 'Payment not found'
+            }
+        }
+        request = MagicMock()
+        request.GET = {'data.id': '123456', 'type': 'payment'}
+        finished = []
+        receiver = lambda **kwargs: finished.append(kwargs)
+        call_finished.connect(receiver)
+        try:
+            with self.assertRaises(PaymentError):
+                self.provider.process_data(self.payment, request)
+        finally:
+            call_finished.disconnect(receiver)
+        snapshot = self.provider.metrics.snapshot()
+        self.assertEqual(snapshot['get_payment']['outcomes'], {'404': 1})
+        self.assertEqual(snapshot['get_payment']['in_flight'], 0)
+        self.assertEqual(snapshot['process_data']['outcomes'],
+                         {'PaymentError': 1})
+        self.assertEqual(snapshot['get_payment']['buckets']['+Inf'], 1)
+        self.assertEqual([(call['operation'], call['outbound'])
+                          for call in finished],
+                         [('get_payment', True), ('process_data', False)])
+
+    @patch('mercadopago.MP.create_preference')
+    def test_get_form_redirect_counts_as_success(
+            self, mocked_create_preference):
+        mocked_create_preference.return_value = {
+            'status': 201,
+            'response': {
+                'sandbox_init_point': SANDBOX_INIT_POINT_URL,
+                'init_point': INIT_POINT_URL
+            }
+        }
+        with self.assertRaises(RedirectNeeded):
+            self.provider.get_form(payment=self.payment)
+        snapshot = self.provider.metrics.snapshot()
+        self.assertEqual(snapshot['get_form']['outcomes'], {'ok': 1})
+        self.assertEqual(snapshot['create_preference']['outcomes'],
+                         {'201': 1})
+
+
+class TestFakeMercadoPago(TestCase):
+
+    def setUp(self):
+        self.server = FakeMercadoPago().start()
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True,
+            api_base_url=self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+        clear_clients()
+
+    def test_provider_round_trips_through_http(self):
+        with self.assertRaises(RedirectNeeded) as exc:
+            self.provider.get_form(payment=self.payment)
+        self.assertTrue(exc.exception.args[0].startswith(self.server.url))
+        request = MagicMock()
+        request.GET = {'data.id': '123456', 'type': 'payment'}
+        self.provider.process_data(self.payment, request)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.server.requests,
+                         {'create_preference': 1, 'get_payment': 1})
+
+    def test_http_transport_round_trips_without_sdk(self):
+        provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True,
+            api_base_url=self.server.url,
+            transport='payments_mercadopago.transports.HTTPTransport')
+        with patch('mercadopago.MP') as sdk:
+            with self.assertRaises(RedirectNeeded):
+                provider.get_form(payment=self.payment)
+            result = provider.get_payment_information('123456')
+            self.payment.transaction_id = '123456'
+            self.payment.captured_amount = Decimal(100)
+            refunded = provider.refund(self.payment, Decimal('25.50'))
+            provider.cancel(self.payment)
+        sdk.assert_not_called()
+        self.assertEqual(result['response']['status'], 'approved')
+        self.assertEqual(refunded, Decimal('25.50'))
+        self.assertEqual(json.loads(self.payment.extra_data)['response'],
+                         {'id': 123456, 'status': 'cancelled'})
+        self.assertEqual(self.server.requests, {
+            'create_preference': 1, 'get_payment': 1, 'refund_payment': 1,
+            'cancel_payment': 1})
+
+
+class TestResilience(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True, retries=2,
+            retry_backoff=0, operation_timeouts={'get_payment': 1.5})
+
+    @patch('mercadopago.MP.get_payment')
+    def test_reads_are_retried_on_server_errors(self, mocked_get_payment):
+        mocked_get_payment.side_effect = [
+            {'status': 503, 'response': {'message': 'unavailable'}},
+            {'status': 200, 'response': {'status': 'approved'}}
+        ]
+        result = self.provider.get_payment_information('123456')
+        self.assertEqual(result['response']['status'], 'approved')
+        self.assertEqual(mocked_get_payment.call_count, 2)
+
+    @patch('mercadopago.MP.get_payment')
+    def test_connection_errors_become_payment_errors(
+            self, mocked_get_payment):
+        mocked_get_payment.side_effect = ConnectTimeout('timed out')
+        with self.assertRaises(PaymentError):
+            self.provider.get_payment_information('123456')
+        self.assertEqual(mocked_get_payment.call_count, 3)
+
+    @patch('mercadopago.MP.refund_payment')
+    def test_refunds_are_not_retried(self, mocked_refund_payment):
+        mocked_refund_payment.return_value = {
+            'status': 500, 'response': {'message': 'internal error'}}
+        with self.assertRaises(PaymentError):
+            self.provider.refund(self.payment)
+        self.assertEqual(mocked_refund_payment.call_count, 1)
+
+    def test_operation_timeout_is_applied_to_the_request(self):
+        adapter = self.provider.mp._MP__rest_client.get_session().get_adapter(
+            'https://api.mercadopago.com')
+        timeouts = []
+
+        def get_payment(payment_id):
+            with patch('requests.adapters.HTTPAdapter.send',
+                       side_effect=lambda request, **kwargs: timeouts.append(
+                           kwargs['timeout'])):
+                adapter.send(Mock())
+            return {'status': 200, 'response': {}}
+
+        with patch('mercadopago.MP.get_payment', side_effect=get_payment):
+            self.provider.get_payment_information('123456')
+        self.assertEqual(timeouts, [1.5])
+
+    def test_circuit_breaker_opens_and_recovers(self):
+        states = []
+        receiver = lambda **kwargs: states.append(kwargs['state'])
+        circuit_state_changed.connect(receiver)
+        breaker = CircuitBreaker('test', failure_threshold=2,
+                                 recovery_timeout=0.05, cache_alias='default')
+        try:
+            breaker.record_failure()
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+            self.assertFalse(breaker.allow())
+            time.sleep(0.06)
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            breaker.record_success()
+            self.assertTrue(breaker.allow())
+        finally:
+            circuit_state_changed.disconnect(receiver)
+        self.assertEqual(states, ['open', 'half_open', 'closed'])
+
+    @patch('mercadopago.MP.get_payment')
+    def test_open_circuit_fails_fast(self, mocked_get_payment):
+        provider = MercadoPagoProvider(
+            access_token='TEST_OPEN_CIRCUIT', circuit_breaker_threshold=1)
+        mocked_get_payment.return_value = {
+            'status': 500, 'response': {'message': 'internal error'}}
+        with self.assertRaises(PaymentError):
+            provider.get_payment_information('123456')
+        with self.assertRaises(PaymentError) as exc:
+            provider.get_payment_information('123456')
+        self.assertEqual(exc.exception.code, 503)
+        self.assertEqual(mocked_get_payment.call_count, 1)
+
+    def test_lost_local_trial_expires(self):
+        breaker = CircuitBreaker('test-local', failure_threshold=1,
+                                 recovery_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+
+    @patch('mercadopago.MP.get_payment')
+    def test_trial_without_outcome_is_released(self, mocked_get_payment):
+        provider = MercadoPagoProvider(
+            access_token='TEST_RELEASED_TRIAL', circuit_breaker_threshold=1,
+            circuit_breaker_timeout=0.05)
+        mocked_get_payment.return_value = {
+            'status': 500, 'response': {'message': 'internal error'}}
+        with self.assertRaises(PaymentError):
+            provider.get_payment_information('123456')
+        time.sleep(0.06)
+        mocked_get_payment.side_effect = ValueError('unexpected')
+        with self.assertRaises(ValueError):
+            provider.get_payment_information('123456')
+        self.assertTrue(provider.circuit_breaker.allow())
+
+
+class TestWebhookView(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True)
+        self.payment_model = MagicMock()
+        self.payment_model._default_manager.filter.return_value\
+            .first.return_value = self.payment
+        patcher = patch.multiple(
+            'payments_mercadopago.views',
+            provider_factory=Mock(return_value=self.provider),
+            get_payment_model=Mock(return_value=self.payment_model))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_notification_formats(self):
+        legacy = self.factory.post('/?topic=payment&id=123')
+        body = self.factory.post(
+            '/', data=json.dumps({'type': 'payment', 'data': {'id': 456}}),
+            content_type='application/json')
+        ipn_body = self.factory.post(
+            '/', data=json.dumps({
+                'topic': 'merchant_order',
+                'resource': 'https://api.mercadolibre.com/merchant_orders/7'}),
+            content_type='application/json')
+        self.assertEqual(parse_notification(legacy), ('payment', '123'))
+        self.assertEqual(parse_notification(body), ('payment', '456'))
+        self.assertEqual(parse_notification(ipn_body),
+                         ('merchant_order', '7'))
+        self.assertIsNone(parse_notification(self.factory.post(
+            '/', data='{not json', content_type='application/json')))
+
+    def test_unsupported_topics_and_malformed_requests_skip_database(self):
+        response = webhook(self.factory.post('/?topic=plan&id=1'), VARIANT)
+        self.assertEqual(response.status_code, 200)
+        response = webhook(self.factory.post('/?type=payment'), VARIANT)
+        self.assertEqual(response.status_code, 400)
+        self.payment_model._default_manager.filter.assert_not_called()
+
+    def test_invalid_signature_is_rejected(self):
+        self.provider.webhook_secret = 'secret'
+        request = self.factory.post(
+            '/?type=payment&data.id=123', HTTP_X_SIGNATURE='ts=1,v1=bad',
+            HTTP_X_REQUEST_ID='request')
+        self.assertEqual(webhook(request, VARIANT).status_code, 401)
+        self.payment_model._default_manager.filter.assert_not_called()
+
+    def test_valid_signature_is_accepted(self):
+        self.provider.webhook_secret = 'secret'
+        signature = hmac.new(b'secret', b'id:123;request-id:request;ts:1;',
+                             hashlib.sha256).hexdigest()
+        request = self.factory.post(
+            '/?type=payment&data.id=123',
+            HTTP_X_SIGNATURE='ts=1,v1=%s' % signature,
+            HTTP_X_REQUEST_ID='request')
+        self.assertTrue(self.provider.verify_signature(request, '123'))
+
+    @patch('mercadopago.MP.get_payment')
+    def test_static_webhook_finds_payment_by_external_reference(
+            self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'approved',
+                'external_reference': PAYMENT_TOKEN
+            }
+        }
+        request = self.factory.post(
+            '/', data=json.dumps({'type': 'payment', 'data': {'id': '123'}}),
+            content_type='application/json')
+        response = webhook(request, VARIANT)
+        self.assertEqual(response.status_code, 200)
+        self.payment_model._default_manager.filter.assert_called_once_with(
+            token=PAYMENT_TOKEN, variant=VARIANT)
+        self.assertEqual(mocked_get_payment.call_count, 1)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.transaction_id, '123')
+
+    @patch('mercadopago.MP.get')
+    def test_static_webhook_settles_merchant_order(self, mocked_get):
+        mocked_get.return_value = {
+            'status': 200,
+            'response': {
+                'id': 7,
+                'external_reference': PAYMENT_TOKEN,
+                'total_amount': 100,
+                'payments': [{'id': 123, 'status': 'approved',
+                              'transaction_amount': 100}]
+            }
+        }
+        response = webhook(self.factory.post(
+            '/?topic=merchant_order&id=7'), VARIANT)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mocked_get.call_count, 1)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.transaction_id, 123)
+
+
+class TestStatusCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True, status_cache_ttl=10)
+        self.status_cache = self.provider.status_cache
+        self.status_cache.poll_interval = 0.01
+        self.request = MagicMock()
+        self.request.GET = {'data.id': '123456', 'type': 'payment'}
+
+    @patch('mercadopago.MP.get_payment')
+    def test_notification_result_is_read_by_confirmation(
+            self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'approved'
+            }
+        }
+        self.provider.process_data(Payment(), self.request)
+        result = self.provider.get_payment_information('123456', cached=True)
+        self.assertEqual(result, mocked_get_payment.return_value)
+        self.assertEqual(mocked_get_payment.call_count, 1)
+        self.provider.process_data(Payment(), self.request)
+        self.assertEqual(mocked_get_payment.call_count, 2)
+
+    def test_concurrent_fetches_are_collapsed(self):
+        calls = []
+
+        def loader():
+            calls.append(1)
+            time.sleep(0.1)
+            return {'status': 200, 'response': {'status': 'approved'}}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.status_cache.fetch('123456', loader, since=time.time())))
+            for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 8)
+
+    def test_waits_for_fetch_of_another_process(self):
+        started = time.time()
+        cache.add('mercadopago:status:123456:lock', 1, 10)
+        response = {'status': 200, 'response': {'status': 'approved'}}
+        timer = threading.Timer(
+            0.05, self.status_cache.set, ('123456', response))
+        timer.start()
+        loader = Mock()
+        self.assertEqual(
+            self.status_cache.fetch('123456', loader, since=started),
+            response)
+        timer.join()
+        loader.assert_not_called()
+
+    @patch('mercadopago.MP.get_payment')
+    def test_failed_fetch_is_not_cached(self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 500,
+            'response': {
+                'message': 'internal error'
+            }
+        }
+        with self.assertRaises(PaymentError):
+            self.provider.get_payment_information('123456', cached=True)
+        self.assertIsNone(self.status_cache.get('123456'))
+        self.assertIsNone(cache.get('mercadopago:status:123456:lock'))
+
+
+class TestConfirmOnReturn(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True,
+            confirm_on_return=True)
+        self.request = MagicMock()
+        self.request.GET = {
+            'collection_id': '123456', 'collection_status': 'approved',
+            'payment_id': '123456', 'status': 'approved',
+            'external_reference': PAYMENT_TOKEN, 'preference_id': 'pref'}
+
+    def test_back_urls_point_to_process_url(self):
+        back_urls = self.provider.create_preference_data(
+            self.payment)['back_urls']
+        self.assertEqual(set(back_urls.values()), {
+            'https://example.org/process/%s/' % PAYMENT_TOKEN})
+
+    @patch('mercadopago.MP.get_payment')
+    def test_approved_return_confirms_payment(self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'approved',
+                'external_reference': PAYMENT_TOKEN
+            }
+        }
+        response = self.provider.process_data(self.payment, self.request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], 'http://success.com')
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.captured_amount, self.payment.total)
+        self.assertEqual(mocked_get_payment.call_count, 1)
+
+    @patch('mercadopago.MP.get_payment')
+    def test_return_of_another_payment_is_ignored(self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'approved',
+                'external_reference': 'another-token'
+            }
+        }
+        response = self.provider.process_data(self.payment, self.request)
+        self.assertEqual(response['Location'], 'http://cancel.com')
+        self.assertEqual(self.payment.status, PaymentStatus.WAITING)
+
+    @patch('mercadopago.MP.get_payment')
+    def test_abandoned_checkout_skips_outbound_call(self, mocked_get_payment):
+        self.request.GET.update(collection_id='null', payment_id='null',
+                                status='null')
+        response = self.provider.process_data(self.payment, self.request)
+        self.assertEqual(response['Location'], 'http://cancel.com')
+        mocked_get_payment.assert_not_called()
+
+    @patch('mercadopago.MP.get_payment')
+    def test_confirmed_payment_is_not_changed_again(self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'approved',
+                'external_reference': PAYMENT_TOKEN
+            }
+        }
+        self.payment.status = PaymentStatus.CONFIRMED
+        with patch.object(Payment, 'change_status') as change_status:
+            self.provider.process_data(self.payment, self.request)
+        change_status.assert_not_called()
+
+
+class TestTransitions(TestCase):
+
+    def setUp(self):
+        self.payment = Payment()
+        self.payment.pk = 1
+        self.manager = MagicMock()
+        self.queryset = self.manager.filter.return_value.filter.return_value
+        self.queryset.update.return_value = 1
+        patcher = patch.object(type(self.payment), '_default_manager',
+                               self.manager, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fields = {'transaction_id': '123456', 'extra_data': '{}'}
+
+    def test_forward_transition_is_one_conditional_update(self):
+        with patch('payments_mercadopago.transitions.status_changed') as signal:
+            changed = transition(
+                self.payment, PaymentStatus.CONFIRMED, self.fields)
+        self.assertTrue(changed)
+        condition = self.manager.filter.return_value.filter.call_args[0][0]
+        status__in = dict(child for child in condition.children
+                          if isinstance(child, tuple))['status__in']
+        self.assertIn(PaymentStatus.WAITING, status__in)
+        self.assertNotIn(PaymentStatus.CONFIRMED, status__in)
+        self.queryset.update.assert_called_once_with(
+            status=PaymentStatus.CONFIRMED, message=ANY, modified=ANY,
+            **self.fields)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(signal.send.call_count, 1)
+
+    def test_stale_status_writes_nothing(self):
+        self.payment.status = PaymentStatus.CONFIRMED
+        changed = transition(self.payment, PaymentStatus.WAITING, self.fields)
+        self.assertFalse(changed)
+        self.queryset.update.assert_not_called()
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+
+    def test_transition_lost_to_another_worker_sends_no_signal(self):
+        self.queryset.update.return_value = 0
+        with patch('payments_mercadopago.transitions.status_changed') as signal:
+            changed = transition(
+                self.payment, PaymentStatus.CONFIRMED, self.fields)
+        self.assertFalse(changed)
+        signal.send.assert_not_called()
+        self.assertEqual(self.payment.status, PaymentStatus.WAITING)
+
+    def test_ranks_are_monotonic(self):
+        self.assertTrue(is_forward(PaymentStatus.WAITING,
+                                   PaymentStatus.CONFIRMED))
+        self.assertFalse(is_forward(PaymentStatus.CONFIRMED,
+                                    PaymentStatus.WAITING))
+        self.assertFalse(is_forward(PaymentStatus.REFUNDED,
+                                    PaymentStatus.CONFIRMED))
+
+    def test_confirmation_replaces_expired_checkout(self):
+        self.payment.status = PaymentStatus.CANCELLED
+        self.payment.message = EXPIRED_MESSAGE
+        with patch('payments_mercadopago.transitions.status_changed'):
+            changed = transition(
+                self.payment, PaymentStatus.CONFIRMED, self.fields)
+        self.assertTrue(changed)
+        self.queryset.update.assert_called_once_with(
+            status=PaymentStatus.CONFIRMED, message=ANY, modified=ANY,
+            **self.fields)
+        self.assertEqual(self.payment.message, '')
+
+    def test_cancelled_payment_is_not_confirmed(self):
+        self.payment.status = PaymentStatus.CANCELLED
+        changed = transition(
+            self.payment, PaymentStatus.CONFIRMED, self.fields)
+        self.assertFalse(changed)
+        self.queryset.update.assert_not_called()
+
+
+class TestDatabaseTransitions(DatabaseTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(clear_clients)
+        self.payment = PaymentModel.objects.create(
+            variant=VARIANT, token=PAYMENT_TOKEN, currency=CURRENCY,
+            total=Decimal(100), status=PaymentStatus.WAITING)
+        self.fields = {'transaction_id': '123456', 'extra_data': '{}'}
+
+    def confirm_elsewhere(self):
+        other = PaymentModel.objects.get(pk=self.payment.pk)
+        self.assertTrue(transition(other, PaymentStatus.CONFIRMED, self.fields))
+
+    def test_lost_transition_reloads_the_status(self):
+        self.confirm_elsewhere()
+        changed = transition(
+            self.payment, PaymentStatus.CONFIRMED, self.fields)
+        self.assertFalse(changed)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.transaction_id, '123456')
+
+    @patch('mercadopago.MP.get_payment')
+    def test_return_after_webhook_confirmation_succeeds(
+            self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'approved',
+                'external_reference': PAYMENT_TOKEN
+            }
+        }
+        provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True,
+            confirm_on_return=True)
+        request = MagicMock()
+        request.GET = {
+            'payment_id': '123456', 'status': 'approved',
+            'external_reference': PAYMENT_TOKEN}
+        # The webhook confirms the row while the return is in flight
+        self.confirm_elsewhere()
+        response = provider.process_data(self.payment, request)
+        self.assertEqual(response['Location'], 'http://success.com')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+
+    def test_saved_payments_go_through_set_payment_status(self):
+        provider = MercadoPagoProvider(access_token=ACCESS_TOKEN)
+        with patch.object(provider, 'set_payment_status',
+                          wraps=provider.set_payment_status) as hook:
+            provider.update_payment(self.payment, '123456', {
+                'status': 200, 'response': {'status': 'approved'}})
+        hook.assert_called_once_with(self.payment, 'approved')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.captured_amount, Decimal(100))
+        self.assertEqual(self.payment.transaction_id, '123456')
+
+    @patch('mercadopago.MP.get_payment')
+    def test_process_payment_data_received_is_deprecated(
+            self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200, 'response': {'status': 'approved'}}
+        provider = MercadoPagoProvider(access_token=ACCESS_TOKEN)
+        with self.assertWarns(DeprecationWarning):
+            provider.process_payment_data_received(self.payment, '123456')
+        self.assertEqual(self.payment.transaction_id, '123456')
+
+
+class TestDatabaseSweeper(DatabaseTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(clear_clients)
+        self.payment = PaymentModel.objects.create(
+            variant=VARIANT, token=PAYMENT_TOKEN, currency=CURRENCY,
+            total=Decimal(100), delivery=Decimal(0), tax=Decimal(0),
+            status=PaymentStatus.WAITING)
+        self.cutoff = timezone.now()
+        PaymentModel.objects.update(
+            modified=self.cutoff - timedelta(hours=1))
+
+    def sweep(self):
+        return list(PaymentSweeper().sweep(
+            PaymentModel.objects.all(), self.cutoff))
+
+    @patch('mercadopago.MP.create_preference')
+    def test_new_checkout_restarts_the_expiry(self, mocked_create_preference):
+        mocked_create_preference.return_value = {
+            'status': 201, 'response': {'sandbox_init_point': INIT_POINT_URL,
+                                        'init_point': INIT_POINT_URL}}
+        provider = MercadoPagoProvider(access_token=ACCESS_TOKEN)
+        with self.assertRaises(RedirectNeeded):
+            provider.get_form(self.payment)
+        self.assertEqual(self.sweep(), [])
+
+    def test_transition_restarts_the_expiry(self):
+        transition(self.payment, PaymentStatus.WAITING, {'message': ''})
+        self.assertEqual(self.sweep(), [])
+
+    def test_abandoned_checkout_is_expired(self):
+        self.assertEqual(self.sweep(), [self.payment])
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, PaymentStatus.CANCELLED)
+        self.assertEqual(self.payment.message, EXPIRED_MESSAGE)
+
+    def test_late_payment_confirms_expired_checkout(self):
+        stale = PaymentModel.objects.get(pk=self.payment.pk)
+        self.sweep()
+        changed = transition(stale, PaymentStatus.CONFIRMED,
+                             {'transaction_id': '123456'})
+        # The stale copy still reads waiting, the row was expired
+        self.assertTrue(changed)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.message, '')
+
+
+class TestRefunds(TestCase):
+
+    def setUp(self):
+        self.payment = Payment()
+        self.payment.transaction_id = '123456'
+        self.payment.captured_amount = Decimal(100)
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True)
+
+    @patch('mercadopago.MP.post')
+    def test_partial_refund_posts_amount(self, mocked_post):
+        mocked_post.return_value = {
+            'status': 201,
+            'response': {
+                'amount': 40
+            }
+        }
+        amount = self.provider.refund(self.payment, Decimal('40'))
+        self.assertEqual(amount, Decimal('40'))
+        mocked_post.assert_called_once_with(
+            '/v1/payments/123456/refunds', {'amount': 40.0})
+        self.assertEqual(self.payment.status, PaymentStatus.WAITING)
+
+    def test_idempotency_key_is_sent_as_header(self):
+        with FakeMercadoPago() as server:
+            provider = MercadoPagoProvider(
+                access_token=ACCESS_TOKEN, api_base_url=server.url)
+            with patch('requests.adapters.HTTPAdapter.send',
+                       autospec=True) as send:
+                send.side_effect = Exception('sent')
+                with self.assertRaises(Exception):
+                    provider.refund(self.payment, idempotency_key='key')
+            request = send.call_args[0][1]
+            self.assertEqual(request.headers['X-Idempotency-Key'], 'key')
+
+    def test_read_refund_requests(self):
+        stream = io.StringIO('token,amount\nfirst,10.50\nsecond,\n,1\n')
+        self.assertEqual(list(read_refund_requests(stream)), [
+            RefundRequest('first', Decimal('10.50')),
+            RefundRequest('second', None)])
+
+    def test_bulk_refund_resumes_from_log(self):
+        refunded = []
+
+        def refund(payment, amount=None):
+            refunded.append(payment.token)
+            payment.captured_amount -= amount or payment.captured_amount
+
+        payments = []
+        for number in range(3):
+            payment = Payment(token='token-%d' % number)
+            payment.captured_amount = Decimal(100)
+            payment.refund = Mock(side_effect=partial(refund, payment))
+            payments.append(payment)
+        with tempfile.TemporaryDirectory() as directory:
+            log = RefundLog(os.path.join(directory, 'refunds.log'))
+            log.write(RefundOutcome('token-0', 'refunded', Decimal(100)))
+            refunder = BulkRefunder(workers=2, rate=0, log=log)
+            jobs = [(payment.token, payment, Decimal(30))
+                    for payment in payments]
+            jobs.append(('missing', None, None))
+            with patch('payments_mercadopago.refunds.provider_factory',
+                       return_value=self.provider):
+                outcomes = list(refunder.run(jobs))
+            self.assertEqual(log.load(), {'token-0', 'token-1', 'token-2',
+                                          'missing'})
+        self.assertEqual(refunded, ['token-1', 'token-2'])
+        self.assertEqual([outcome.outcome for outcome in outcomes],
+                         ['refunded', 'refunded', 'skipped'])
+        self.assertEqual(refunder.summary()['refunded_amount'], Decimal(60))
+        self.assertEqual(refunder.stats, {'refunded': 2, 'skipped': 1})
+
+
+class TestRateLimits(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_local_bucket_allows_bursts_up_to_capacity(self):
+        bucket = TokenBucket('local', rate=2)
+        self.assertEqual(bucket.get_delay(), 0)
+        self.assertEqual(bucket.get_delay(), 0)
+        self.assertGreater(bucket.get_delay(), 0)
+
+    def test_low_priority_leaves_reserve_to_checkout(self):
+        limits = RateLimits('priority', {'get_payment': 10}, reserve=0.5)
+        with low_priority():
+            delays = [limits.get_delay('get_payment') for number in range(6)]
+        self.assertEqual(delays[:5], [0] * 5)
+        self.assertGreater(delays[5], 0)
+        self.assertEqual(limits.get_delay('get_payment'), 0)
+
+    def test_shared_bucket_counts_every_process(self):
+        first = TokenBucket('shared', rate=2, cache_alias='default')
+        second = TokenBucket('shared', rate=2, cache_alias='default')
+        with patch('time.time', return_value=1000.0):
+            self.assertEqual(first.get_delay(), 0)
+            self.assertEqual(second.get_delay(), 0)
+            self.assertEqual(first.get_delay(), 1.0)
+        with patch('time.time', return_value=1001.0):
+            self.assertEqual(second.get_delay(), 0)
+
+    @patch('mercadopago.MP.get_payment')
+    def test_provider_raises_429_when_no_token_is_left(
+            self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {
+                'status': 'approved'
+            }
+        }
+        provider = MercadoPagoProvider(
+            access_token='RATE_LIMITED', rate_limits={'get_payment': 1},
+            rate_limit_wait=0)
+        provider.get_payment_information('123456')
+        with self.assertRaises(PaymentError) as context:
+            provider.get_payment_information('123456')
+        self.assertEqual(context.exception.code, 429)
+        self.assertEqual(mocked_get_payment.call_count, 1)
+
+    @patch('mercadopago.MP.get_payment')
+    def test_mercadopago_429_empties_bucket(self, mocked_get_payment):
+        mocked_get_payment.return_value = {
+            'status': 429,
+            'response': {
+                'message': 'too many requests'
+            }
+        }
+        provider = MercadoPagoProvider(
+            access_token='THROTTLED', rate_limits={'get_payment': 100},
+            rate_limit_wait=0)
+        with self.assertRaises(PaymentError) as context:
+            provider.get_payment_information('123456')
+        self.assertEqual(context.exception.code, 429)
+        self.assertGreater(provider.rate_limits.get_delay('get_payment'), 0)
+
+
+class TestClientCredentials(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = FakeMercadoPago().start()
+        self.manager = TokenManager('client', 'secret', self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+        clear_clients()
+
+    def test_token_is_fetched_once_for_every_provider(self):
+        options = {'client_id': 'shared', 'client_secret': 'secret',
+                   'api_base_url': self.server.url,
+                   'transport': 'payments_mercadopago.transports.HTTPTransport'}
+        first = MercadoPagoProvider(**options)
+        second = MercadoPagoProvider(**options)
+        first.get_payment_information('1')
+        second.get_payment_information('2')
+        self.assertEqual(first.get_access_token(), 'APP_USR-shared-1')
+        self.assertEqual(self.server.requests,
+                         {'create_token': 1, 'get_payment': 2})
+
+    def test_token_is_shared_through_the_cache(self):
+        self.manager.get_token()
+        other_process = TokenManager('client', 'secret', self.server.url)
+        self.assertEqual(other_process.get_token(), 'APP_USR-client-1')
+        self.assertEqual(self.server.requests['create_token'], 1)
+
+    def test_token_is_refreshed_before_expiry(self):
+        self.server.token_expires_in = 200
+        self.assertEqual(self.manager.get_token(), 'APP_USR-client-1')
+        self.assertEqual(self.manager.get_token(), 'APP_USR-client-2')
+
+    def test_concurrent_refreshes_are_collapsed(self):
+        self.server.latency = 0.05
+        threads = [threading.Thread(target=self.manager.get_token)
+                   for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.requests['create_token'], 1)
+
+    def test_expiring_token_is_used_while_another_process_refreshes(self):
+        self.server.token_expires_in = 200
+        self.manager.get_token()
+        cache.add('%s:lock' % self.manager.key, 1, 10)
+        self.assertEqual(self.manager.get_token(), 'APP_USR-client-1')
+        self.assertEqual(self.server.requests['create_token'], 1)
+
+    def test_credentials_are_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            MercadoPagoProvider(client_id='client')
+
+
+class TestMerchantOrders(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, sandbox_mode=True, status_cache_ttl=10)
+        self.request = MagicMock()
+        self.request.GET = {'topic': 'merchant_order', 'id': '777'}
+        self.order = {
+            'status': 200,
+            'response': {
+                'id': 777,
+                'external_reference': PAYMENT_TOKEN,
+                'total_amount': 100,
+                'payments': [
+                    {'id': 1, 'status': 'approved', 'transaction_amount': 60},
+                    {'id': 2, 'status': 'rejected', 'transaction_amount': 40},
+                    {'id': 3, 'status': 'approved', 'transaction_amount': 40},
+                ],
+            }
+        }
+
+    @patch('mercadopago.MP.get_payment')
+    @patch('mercadopago.MP.get')
+    def test_paid_order_confirms_payment(self, mocked_get, mocked_get_payment):
+        mocked_get.return_value = self.order
+        payment = Payment()
+        self.provider.process_data(payment, self.request)
+        mocked_get.assert_called_once_with('/merchant_orders/777')
+        self.assertEqual(payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(payment.captured_amount, payment.total)
+        self.assertEqual(payment.transaction_id, 3)
+        for collection_id in (1, 3):
+            request = MagicMock()
+            request.GET = {'data.id': str(collection_id), 'type': 'payment'}
+            self.provider.process_data(payment, request)
+        mocked_get_payment.assert_not_called()
+        self.assertEqual(payment.status, PaymentStatus.CONFIRMED)
+
+    @patch('mercadopago.MP.get_payment')
+    @patch('mercadopago.MP.get')
+    def test_partially_paid_order_keeps_waiting(self, mocked_get,
+                                                mocked_get_payment):
+        self.order['response']['payments'].pop()
+        mocked_get.return_value = self.order
+        mocked_get_payment.return_value = {
+            'status': 200, 'response': {'status': 'approved'}}
+        payment = Payment()
+        self.provider.process_data(payment, self.request)
+        self.assertEqual(payment.status, PaymentStatus.WAITING)
+        request = MagicMock()
+        request.GET = {'data.id': '1', 'type': 'payment'}
+        self.provider.process_data(payment, request)
+        self.assertEqual(mocked_get_payment.call_count, 1)
+        self.assertEqual(mocked_get.call_count, 2)
+        self.assertEqual(payment.status, PaymentStatus.WAITING)
+        self.assertEqual(payment.captured_amount, Decimal(0))
+
+    @patch('mercadopago.MP.get_payment')
+    @patch('mercadopago.MP.get')
+    def test_approved_part_is_settled_from_its_order(self, mocked_get,
+                                                     mocked_get_payment):
+        self.order['response']['payments'].pop()
+        mocked_get.return_value = self.order
+        mocked_get_payment.return_value = {
+            'status': 200,
+            'response': {'id': 1, 'status': 'approved',
+                         'transaction_amount': 60, 'order': {'id': 777}}}
+        payment = Payment()
+        request = MagicMock()
+        request.GET = {'data.id': '1', 'type': 'payment'}
+        self.provider.process_data(payment, request)
+        mocked_get.assert_called_once_with('/merchant_orders/777')
+        self.assertEqual(payment.status, PaymentStatus.WAITING)
+        self.assertEqual(payment.captured_amount, Decimal(0))
+
+    @patch('mercadopago.MP.get')
+    def test_order_of_another_payment_is_ignored(self, mocked_get):
+        self.order['response']['external_reference'] = 'other'
+        mocked_get.return_value = self.order
+        payment = Payment()
+        self.provider.process_data(payment, self.request)
+        self.assertEqual(payment.status, PaymentStatus.WAITING)
+
+    def test_http_transport(self):
+        with FakeMercadoPago() as server:
+            provider = MercadoPagoProvider(
+                access_token=ACCESS_TOKEN, api_base_url=server.url,
+                transport='payments_mercadopago.transports.HTTPTransport')
+            result = provider.get_merchant_order_information('777')
+        self.assertEqual(provider.get_paid_amount(result['response']),
+                         Decimal(100))
+        self.assertEqual(server.requests['get_merchant_order'], 1)
+
+
+class TestSettlementReports(TestCase):
+
+    report = (
+        'DATE;SOURCE_ID;EXTERNAL_REFERENCE;DESCRIPTION;GROSS_AMOUNT\n'
+        '2024-01-01;1;paid;payment;100.00\n'
+        '2024-01-01;2;;payout;-500.00\n'
+        '2024-01-02;3;wrong-amount;payment;90.00\n'
+        '2024-01-02;4;refunded;refund;-100.00\n'
+        '2024-01-03;5;disputed;chargeback;-100.00\n'
+        '2024-01-03;6;unknown;payment;100.00\n'
+        '2024-01-04;7;confirmed;payment;100.00\n')
+
+    def setUp(self):
+        self.payments = {}
+        for number, token in enumerate(
+                ['paid', 'wrong-amount', 'refunded', 'disputed', 'confirmed']):
+            payment = Payment(token=token, pk=number)
+            if token != 'paid':
+                payment.status = PaymentStatus.CONFIRMED
+                payment.captured_amount = Decimal(100)
+            self.payments[token] = payment
+
+    def test_read_settlement_rows(self):
+        rows = list(read_settlement_rows(io.StringIO(self.report)))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0].line, 2)
+        self.assertEqual(rows[0].reference, 'paid')
+        self.assertEqual(rows[0].source_id, '1')
+        self.assertEqual(rows[0].kind, 'payment')
+        self.assertEqual(rows[2].amount, Decimal('-100.00'))
+
+    def test_import_applies_and_reports_mismatches(self):
+        importer = SettlementImporter([VARIANT], workers=2, dry_run=True)
+        requested = []
+
+        def get_payments(references):
+            requested.append(references)
+            return {reference: self.payments[reference]
+                    for reference in references if reference in self.payments}
+
+        output = io.StringIO()
+        with patch.object(importer, 'get_payments', side_effect=get_payments):
+            changed = list(importer.run(
+                read_settlement_rows(io.StringIO(self.report)), 2,
+                MismatchReport(output)))
+        self.assertEqual(
+            sorted(reference for references in requested
+                   for reference in references),
+            ['confirmed', 'disputed', 'paid', 'refunded', 'unknown',
+             'wrong-amount'])
+        self.assertTrue(all(len(references) <= 2
+                            for references in requested))
+        self.assertCountEqual(changed, [self.payments['paid'],
+                                        self.payments['refunded']])
+        self.assertEqual(self.payments['paid'].status,
+                         PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payments['paid'].transaction_id, '1')
+        self.assertEqual(self.payments['refunded'].status,
+                         PaymentStatus.REFUNDED)
+        self.assertEqual(self.payments['refunded'].captured_amount, 0)
+        self.assertEqual(importer.stats, {
+            'rows': 6, 'applied': 2, 'matched': 1, 'amount': 1,
+            'chargeback': 1, 'not_found': 1})
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0].split(',')[5], 'reason')
+        self.assertCountEqual([line.split(',')[5] for line in lines[1:]],
+                              ['amount', 'chargeback', 'not_found'])
+
+    def test_rows_of_a_payment_are_applied_in_order(self):
+        report = (
+            'SOURCE_ID,EXTERNAL_REFERENCE,TRANSACTION_TYPE,TRANSACTION_AMOUNT\n'
+            + ''.join('%d,other-%d,payment,100.00\n' % (number, number)
+                      for number in range(8))
+            + '8,paid,settlement,100.00\n'
+            + ''.join('%d,other-%d,payment,100.00\n' % (number, number)
+                      for number in range(9, 17))
+            + '17,paid,refund,-100.00\n')
+        importer = SettlementImporter([VARIANT], workers=4, dry_run=True)
+
+        def get_payments(references):
+            # Every chunk reads the stored payment again
+            return {reference: Payment(token=reference, pk=reference)
+                    for reference in references}
+
+        with patch.object(importer, 'get_payments', side_effect=get_payments):
+            changed = list(importer.run(
+                read_settlement_rows(io.StringIO(report)), 1))
+        refunds = [payment for payment in changed if payment.token == 'paid']
+        self.assertEqual(refunds[-1].status, PaymentStatus.REFUNDED)
+        self.assertNotIn('status', importer.stats)
+
+    def test_dry_run_keeps_the_last_changed_payments(self):
+        importer = SettlementImporter([VARIANT], dry_run=True, max_unsaved=2)
+        payments = [Payment(token='token-%d' % number, pk=number)
+                    for number in range(3)]
+        importer.keep_unsaved(payments[:2])
+        importer.keep_unsaved(payments[:1])
+        importer.keep_unsaved(payments[2:])
+        self.assertEqual(list(importer._unsaved), ['token-0', 'token-2'])
+
+
+class TestShardedProvider(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.provider = ShardedMercadoPagoProvider(
+            accounts=[{'name': 'first', 'access_token': 'SHARD_FIRST'},
+                      {'name': 'second', 'access_token': 'SHARD_SECOND'}],
+            sandbox_mode=True)
+
+    def test_payments_are_routed_by_token(self):
+        names = [self.provider.for_payment(Payment(token='token-%d' % number))
+                 .shard for number in range(20)]
+        self.assertEqual(set(names), {'first', 'second'})
+        other = ShardedMercadoPagoProvider(
+            accounts=[{'name': 'first', 'access_token': 'SHARD_FIRST'},
+                      {'name': 'second', 'access_token': 'SHARD_SECOND'}])
+        self.assertEqual(names, [
+            other.for_payment(Payment(token='token-%d' % number)).shard
+            for number in range(20)])
+
+    @patch('mercadopago.MP.refund_payment')
+    @patch('mercadopago.MP.create_preference')
+    def test_failover_is_recorded_for_later_calls(
+            self, mocked_create_preference, mocked_refund_payment):
+        payment = Payment()
+        home = self.provider.for_payment(payment)
+        mocked_create_preference.side_effect = [
+            {'status': 500, 'response': {'message': 'unavailable'}},
+            {'status': 201, 'response': {
+                'id': 'preference', 'sandbox_init_point': INIT_POINT_URL}}]
+        with self.assertRaises(RedirectNeeded):
+            self.provider.get_form(payment)
+        shard = self.provider.for_payment(payment)
+        self.assertNotEqual(shard, home)
+        self.assertEqual(json.loads(payment.extra_data)['shard'], shard.shard)
+        payment.captured_amount = payment.total
+        payment.transaction_id = '123'
+        mocked_refund_payment.return_value = {
+            'status': 201, 'response': {'status': 'approved'}}
+        with patch.object(shard, 'refund', wraps=shard.refund) as refund:
+            self.provider.refund(payment)
+        refund.assert_called_once_with(payment, None, None)
+        self.assertEqual(json.loads(payment.extra_data)['shard'], shard.shard)
+
+    def test_every_account_needs_a_webhook_secret(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ShardedMercadoPagoProvider(accounts=[
+                {'access_token': 'SHARD_FIRST', 'webhook_secret': 'secret'},
+                {'access_token': 'SHARD_SECOND'}])
+
+    def test_signature_of_any_account_is_accepted(self):
+        provider = ShardedMercadoPagoProvider(accounts=[
+            {'access_token': 'SHARD_FIRST', 'webhook_secret': 'first'},
+            {'access_token': 'SHARD_SECOND', 'webhook_secret': 'second'}])
+        signature = hmac.new(b'second', b'id:123;request-id:request;ts:1;',
+                             hashlib.sha256).hexdigest()
+        request = RequestFactory().post(
+            '/', HTTP_X_SIGNATURE='ts=1,v1=%s' % signature,
+            HTTP_X_REQUEST_ID='request')
+        self.assertTrue(provider.verify_signature(request, '123'))
+        request = RequestFactory().post(
+            '/', HTTP_X_SIGNATURE='ts=1,v1=forged',
+            HTTP_X_REQUEST_ID='request')
+        self.assertFalse(provider.verify_signature(request, '123'))
+
+    @patch('mercadopago.MP.create_preference')
+    def test_client_errors_do_not_fail_over(self, mocked_create_preference):
+        mocked_create_preference.return_value = {
+            'status': 400, 'response': {'message': 'invalid items'}}
+        with self.assertRaises(PaymentError):
+            self.provider.get_form(Payment())
+        self.assertEqual(mocked_create_preference.call_count, 1)
+
+
+class TestStatusStream(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.payment = Payment()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, status_stream=True)
+        self.broker = self.provider.status_broker = StatusBroker()
+        self.payment_model = MagicMock()
+        self.payment_model._default_manager.filter.return_value.only\
+            .return_value.first.return_value = self.payment
+        patcher = patch.multiple(
+            'payments_mercadopago.views',
+            provider_factory=Mock(return_value=self.provider),
+            get_payment_model=Mock(return_value=self.payment_model))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def publish_later(self, status, delay=0.05):
+        timer = threading.Timer(delay, publish_status, kwargs={
+            'sender': Payment, 'instance': Mock(
+                token=PAYMENT_TOKEN, variant=VARIANT, status=status)})
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_status_changes_are_published(self):
+        self.assertIsInstance(apps.get_app_config('payments_mercadopago'),
+                              PaymentsMercadoPagoConfig)
+        self.assertIn('payments_mercadopago.streams',
+                      [key[0] for key, *_ in status_changed.receivers])
+
+    def test_long_poll_returns_the_published_status(self):
+        self.publish_later(PaymentStatus.CONFIRMED)
+        with patch('payments_mercadopago.streams.provider_factory',
+                   return_value=self.provider):
+            started = time.monotonic()
+            response = payment_status(self.factory.get(
+                '/?status=waiting&timeout=5'), PAYMENT_TOKEN)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(json.loads(response.content),
+                         {'status': PaymentStatus.CONFIRMED})
+        self.payment_model._default_manager.filter.assert_called_once_with(
+            token=PAYMENT_TOKEN)
+
+    def test_long_poll_times_out_with_the_current_status(self):
+        self.broker.publish(PAYMENT_TOKEN, PaymentStatus.INPUT)
+        response = payment_status(self.factory.get(
+            '/?status=waiting&timeout=0'), PAYMENT_TOKEN)
+        self.assertEqual(json.loads(response.content),
+                         {'status': PaymentStatus.WAITING})
+
+    def test_event_stream_ends_on_final_status(self):
+        self.publish_later(PaymentStatus.CONFIRMED)
+        with patch('payments_mercadopago.streams.provider_factory',
+                   return_value=self.provider):
+            response = payment_status(self.factory.get(
+                '/', HTTP_ACCEPT='text/event-stream'), PAYMENT_TOKEN)
+            events = [part.decode('utf-8')
+                      for part in response.streaming_content]
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(events, [
+            'event: status\ndata: {"status": "waiting"}\n\n',
+            'event: status\ndata: {"status": "confirmed"}\n\n'])
+
+    def test_cache_carries_statuses_between_processes(self):
+        publisher = StatusBroker('default')
+        waiter = StatusBroker('default', poll_interval=0.01)
+        timer = threading.Timer(0.05, publisher.publish,
+                                (PAYMENT_TOKEN, PaymentStatus.REJECTED))
+        timer.start()
+        self.assertEqual(
+            waiter.wait(PAYMENT_TOKEN, PaymentStatus.WAITING, 5),
+            PaymentStatus.REJECTED)
+        timer.join()
+
+    def test_cache_overrides_an_older_local_status(self):
+        waiter = StatusBroker('default', poll_interval=0.01)
+        waiter.publish(PAYMENT_TOKEN, PaymentStatus.WAITING)
+        StatusBroker('default').publish(PAYMENT_TOKEN,
+                                        PaymentStatus.CONFIRMED)
+        self.assertEqual(
+            waiter.wait(PAYMENT_TOKEN, PaymentStatus.WAITING, 0.1),
+            PaymentStatus.CONFIRMED)
+
+    def test_status_is_published_on_commit(self):
+        instance = Mock(token=PAYMENT_TOKEN, variant=VARIANT,
+                        status=PaymentStatus.CONFIRMED)
+        connection = Mock(in_atomic_block=True)
+        with patch('payments_mercadopago.streams.provider_factory',
+                   return_value=self.provider), \
+                patch('payments_mercadopago.streams.transaction') as atomic:
+            atomic.get_connection.return_value = connection
+            publish_status(Payment, instance)
+        self.assertIsNone(self.broker.get(PAYMENT_TOKEN))
+        publish = atomic.on_commit.call_args[0][0]
+        publish()
+        self.assertEqual(self.broker.get(PAYMENT_TOKEN),
+                         PaymentStatus.CONFIRMED)
+
+
+class TestDirectPayments(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, direct_payments=True,
+            public_key='TEST-public-key')
+        self.payment = Payment()
+        self.card = {'token': 'card-token', 'payment_method_id': 'visa',
+                     'installments': '1'}
+        self.headers = []
+
+    def answer(self, status):
+        def post(uri, data):
+            self.headers.append(dict(mercadopago_client._local.headers))
+            return {'status': 201,
+                    'response': {'id': 99, 'status': status,
+                                 'status_detail': 'cc_rejected_other_reason'}}
+        return post
+
+    def test_form_is_shown_without_calling_mercadopago(self):
+        with patch('mercadopago.MP.post') as mocked_post:
+            form = self.provider.get_form(self.payment)
+        mocked_post.assert_not_called()
+        self.assertEqual(form.public_key, 'TEST-public-key')
+        self.assertIn('token', form.fields)
+
+    @patch('mercadopago.MP.post')
+    def test_approved_payment_is_confirmed_in_one_call(self, mocked_post):
+        mocked_post.side_effect = self.answer('approved')
+        with self.assertRaises(RedirectNeeded) as redirect:
+            self.provider.get_form(self.payment, data=self.card)
+        self.assertEqual(redirect.exception.args[0], 'http://success.com')
+        uri, data = mocked_post.call_args[0]
+        self.assertEqual(uri, '/v1/payments')
+        self.assertEqual(data['token'], 'card-token')
+        self.assertEqual(data['transaction_amount'], 100.0)
+        self.assertEqual(data['external_reference'], PAYMENT_TOKEN)
+        self.assertEqual(len(self.headers[0]['X-Idempotency-Key']), 64)
+        self.assertEqual(self.payment.status, PaymentStatus.CONFIRMED)
+        self.assertEqual(self.payment.transaction_id, 99)
+        self.assertEqual(self.payment.captured_amount, self.payment.total)
+
+    @patch('mercadopago.MP.post')
+    def test_rejected_card_shows_the_form_again(self, mocked_post):
+        mocked_post.side_effect = self.answer('rejected')
+        form = self.provider.get_form(self.payment, data=self.card)
+        self.assertIn('cc_rejected_other_reason', form.non_field_errors()[0])
+        self.assertEqual(self.payment.status, PaymentStatus.WAITING)
+
+    def test_public_key_is_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            MercadoPagoProvider(access_token=ACCESS_TOKEN,
+                                direct_payments=True)
+
+
+class TestItemAggregation(TestCase):
+
+    def setUp(self):
+        self.payment = Payment()
+        self.lines = [
+            PurchasedItem(name='item %d' % (number % 7), quantity=Decimal(2),
+                          price=Decimal('10.005') + number % 7,
+                          currency='MXN', sku='sku-%d' % (number % 7))
+            for number in range(100)]
+        self.payment.get_purchased_items = lambda: iter(self.lines)
+
+    def get_total(self, items):
+        return sum(Decimal(str(item['unit_price'])) * item['quantity']
+                   for item in items)
+
+    def test_identical_skus_are_grouped(self):
+        items = aggregate_items(self.lines)
+        self.assertEqual(len(items), 7)
+        self.assertEqual(items[0]['id'], 'sku-0')
+        self.assertEqual(items[0]['quantity'], 30)
+        self.assertEqual(items[0]['unit_price'], 10.01)
+        self.assertEqual(self.get_total(items), Decimal('2592.00'))
+
+    def test_lines_past_the_limit_are_summarized(self):
+        items = aggregate_items(self.lines, max_items=4)
+        self.assertEqual(len(items), 4)
+        self.assertEqual([item['id'] for item in items[:3]],
+                         ['sku-0', 'sku-1', 'sku-2'])
+        self.assertEqual(items[3]['id'], 'summary')
+        self.assertEqual(items[3]['quantity'], 1)
+        self.assertEqual(self.get_total(items), Decimal('2592.00'))
+
+    def test_fractional_quantities_keep_the_line_total(self):
+        items = aggregate_items([PurchasedItem(
+            name='cable', quantity=Decimal('1.5'), price=Decimal('3.33'),
+            currency='MXN', sku='cable')])
+        self.assertEqual(items[0]['quantity'], 1)
+        self.assertEqual(items[0]['unit_price'], 5.0)
+
+    def test_preference_respects_max_items(self):
+        provider = MercadoPagoProvider(
+            access_token=ACCESS_TOKEN, aggregate_items=True, max_items=5)
+        items = provider.create_preference_data(self.payment)['items']
+        self.assertEqual(len(items), 5)
+        self.assertEqual(items[0]['id'], 'shipping')
+        self.assertEqual(self.get_total(items[1:]), Decimal('2592.00'))
+
+    def test_default_builder_keeps_fractional_line_totals(self):
+        self.lines = [PurchasedItem(
+            name='cable', quantity=Decimal('2.5'), price=Decimal('3.33'),
+            currency='MXN', sku='cable')]
+        provider = MercadoPagoProvider(access_token=ACCESS_TOKEN)
+        items = provider.create_preference_data(self.payment)['items']
+        self.assertEqual(items[1]['quantity'], 1)
+        self.assertEqual(items[1]['unit_price'], 8.33)
+
+    def test_default_builder_sends_every_line(self):
+        provider = MercadoPagoProvider(access_token=ACCESS_TOKEN)
+        items = provider.create_preference_data(self.payment)['items']
+        self.assertEqual(len(items), 101)
+
+    def test_max_items_leaves_room_for_a_summary(self):
+        with self.assertRaises(ImproperlyConfigured):
+            MercadoPagoProvider(access_token=ACCESS_TOKEN,
+                                aggregate_items=True, max_items=1)
+
+    def test_max_items_requires_aggregation(self):
+        with self.assertRaises(ImproperlyConfigured):
+            MercadoPagoProvider(access_token=ACCESS_TOKEN, max_items=100)
+
+
+class TestPaymentSweeper(TestCase):
+
+    def setUp(self):
+        self.payments = [Payment(), Payment()]
+        for pk, payment in enumerate(self.payments, 1):
+            payment.pk = pk
+        self.queryset = MagicMock()
+        self.queryset.model = Payment
+        self.swept = self.queryset.filter.return_value
+        self.swept.model = Payment
+        self.locked = self.swept.filter.return_value.select_for_update
+        self.locked.return_value.values_list.return_value = [1]
+        self.manager = MagicMock()
+        patchers = [
+            patch.object(Payment, '_default_manager', self.manager,
+                         create=True),
+            patch('payments_mercadopago.expiry.iter_batches',
+                  return_value=[self.payments]),
+            patch('payments_mercadopago.expiry.transaction'),
+            patch('payments_mercadopago.expiry.router'),
+            patch('payments_mercadopago.expiry.connections')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_locked_payments_are_skipped(self):
+        sweeper = PaymentSweeper()
+        with patch('payments_mercadopago.expiry.status_changed') as signal:
+            expired = list(sweeper.sweep(self.queryset, timezone.now()))
+        self.assertEqual(expired, self.payments[:1])
+        self.assertEqual(self.payments[0].status, PaymentStatus.CANCELLED)
+        self.assertEqual(self.payments[0].message, EXPIRED_MESSAGE)
+        self.assertEqual(self.payments[1].status, PaymentStatus.WAITING)
+        self.manager.filter.assert_called_once_with(pk__in={1})
+        update = self.manager.filter.return_value.update
+        self.assertEqual(update.call_args[1]['status'],
+                         PaymentStatus.CANCELLED)
+        self.assertEqual(signal.send.call_count, 1)
+        self.assertEqual(dict(sweeper.stats),
+                         {'scanned': 2, 'expired': 1, 'skipped': 1})
+
+    def test_dry_run_writes_nothing(self):
+        sweeper = PaymentSweeper(dry_run=True)
+        expired = list(sweeper.sweep(self.queryset, timezone.now()))
+        self.assertEqual(expired, self.payments)
+        self.locked.assert_not_called()
+        self.manager.filter.assert_not_called()
+        self.assertEqual(self.payments[0].status, PaymentStatus.WAITING)
+
+    def test_command_uses_the_preference_expiration(self):
+        command = ('payments_mercadopago.management.commands.'
+                   'expire_mercadopago_payments.')
+        providers = {
+            'wallet': MercadoPagoProvider(access_token=ACCESS_TOKEN,
+                                          preference_expiration=600),
+            'legacy': MercadoPagoProvider(access_token=ACCESS_TOKEN)}
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with patch(command + 'get_mercadopago_variants',
+                   return_value=['wallet', 'legacy']), \
+                patch(command + 'provider_factory', side_effect=providers.get), \
+                patch(command + 'get_payment_model'), \
+                patch.object(PaymentSweeper, 'sweep',
+                             return_value=iter([])) as sweep:
+            before = timezone.now()
+            call_command('expire_mercadopago_payments', '--grace', '60',
+                         stdout=stdout, stderr=stderr)
+        self.assertEqual(sweep.call_count, 1)
+        cutoff = sweep.call_args[0][1]
+        self.assertAlmostEqual((before - cutoff).total_seconds(), 660,
+                               delta=5)
+        self.assertIn('Skipping legacy', stderr.getvalue())
+        self.assertIn('nothing to expire', stdout.getvalue())
@@ -0,0 +1,237 @@
+"""Local stand-in for the MercadoPago API, for tests and benchmarks.
+
+    with FakeMercadoPago(latency=0.05, error_rate=0.01) as server:
+        provider = MercadoPagoProvider(access_token='TEST',
+                                       api_base_url=server.url)
+
+Run it standalone with ``python -m payments_mercadopago.testing --port 8765``.
+"""
+import argparse
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """``http.server.ThreadingHTTPServer``, which needs Python 3.7."""
+    daemon_threads = True
+
+
+class FakeMercadoPagoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body in one segment, small writes otherwise stall
+    # on delayed acknowledgements
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    routes = (
+        ('POST', re.compile(r'^/oauth/token$'), 'create_token'),
+        ('POST', re.compile(r'^/checkout/preferences$'), 'create_preference'),
+        ('GET', re.compile(r'^/v1/payments/search$'), 'search_payment'),
+        ('POST', re.compile(r'^/v1/payments$'), 'create_payment'),
+        ('GET', re.compile(r'^/v1/payments/(?P<id>\d+)$'), 'get_payment'),
+        ('POST', re.compile(r'^/v1/payments/(?P<id>\d+)/refunds$'),
+         'refund_payment'),
+        ('PUT', re.compile(r'^/v1/payments/(?P<id>\d+)$'), 'cancel_payment'),
+        ('GET', re.compile(r'^/merchant_orders/(?P<id>\d+)$'),
+         'get_merchant_order'),
+    )
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        for route_method, pattern, operation in self.routes:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.respond(404, {'message': 'resource not found'})
+        server = self.server
+        server.count(operation)
+        delay = server.get_latency()
+        if delay:
+            time.sleep(delay)
+        if server.should_fail():
+            return self.respond(500, {'message': 'internal_error'})
+        if self.headers.get('Content-Type', '').startswith(
+                'application/x-www-form-urlencoded'):
+            data = {key: values[0] for key, values in parse_qs(
+                body.decode('utf-8')).items()}
+        else:
+            data = json.loads(body.decode('utf-8')) if body else {}
+        status, response = getattr(server, operation)(
+            data=data, query=parse_qs(url.query), **match.groupdict())
+        self.respond(status, response)
+
+    def respond(self, status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeMercadoPago(ThreadingHTTPServer):
+    """Imitates the OAuth, preference, payment, refund and cancel endpoints.
+
+    Every request sleeps ``latency`` seconds, plus or minus ``jitter``, and
+    fails with a 500 with probability ``error_rate``. Payments are reported
+    with ``payment_status`` and access tokens last ``token_expires_in``
+    seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0, jitter: float = 0,
+                 error_rate: float = 0, payment_status: str = 'approved',
+                 seed: int = None) -> None:
+        super(FakeMercadoPago, self).__init__(
+            (host, port), FakeMercadoPagoHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.payment_status = payment_status
+        self.token_expires_in = 21600
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def count(self, operation: str) -> None:
+        with self._lock:
+            self.requests[operation] += 1
+
+    def get_latency(self) -> float:
+        if not self.jitter:
+            return self.latency
+        with self._lock:
+            offset = self.random.uniform(-self.jitter, self.jitter)
+        return max(0, self.latency + offset)
+
+    def should_fail(self) -> bool:
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def create_token(self, data, query):
+        if not data.get('client_id') or not data.get('client_secret'):
+            return 400, {'message': 'invalid client credentials'}
+        with self._lock:
+            number = self.requests['create_token']
+        return 200, {'access_token': 'APP_USR-%s-%d' % (
+                         data['client_id'], number),
+                     'token_type': 'bearer',
+                     'expires_in': self.token_expires_in}
+
+    def create_preference(self, data, query):
+        preference_id = 'pref-%s' % data.get('external_reference', '')
+        return 201, {
+            'id': preference_id,
+            'external_reference': data.get('external_reference'),
+            'items': data.get('items', []),
+            'init_point': '%s/checkout?pref_id=%s' % (self.url, preference_id),
+            'sandbox_init_point': '%s/sandbox/checkout?pref_id=%s' % (
+                self.url, preference_id),
+        }
+
+    def create_payment(self, data, query):
+        with self._lock:
+            number = self.requests['create_payment']
+        return 201, {'id': number, 'status': self.payment_status,
+                     'status_detail': 'accredited',
+                     'external_reference': data.get('external_reference'),
+                     'transaction_amount': data.get('transaction_amount')}
+
+    def get_payment(self, data, query, id):
+        return 200, {'id': int(id), 'status': self.payment_status,
+                     'status_detail': 'accredited',
+                     'transaction_amount': 100}
+
+    def search_payment(self, data, query):
+        reference = query.get('external_reference', [''])[0]
+        return 200, {'results': [{'id': 1, 'status': self.payment_status,
+                                  'external_reference': reference}],
+                     'paging': {'total': 1}}
+
+    def get_merchant_order(self, data, query, id):
+        paid = 100 if self.payment_status == 'approved' else 0
+        return 200, {'id': int(id), 'status': 'closed' if paid else 'opened',
+                     'order_status': 'paid' if paid else 'payment_required',
+                     'total_amount': 100, 'paid_amount': paid,
+                     'payments': [{'id': int(id), 'status': self.payment_status,
+                                   'transaction_amount': 100}]}
+
+    def refund_payment(self, data, query, id):
+        return 201, {'id': 1, 'payment_id': int(id),
+                     'amount': data.get('amount', 100), 'status': 'approved'}
+
+    def cancel_payment(self, data, query, id):
+        return 200, {'id': int(id), 'status': data.get('status')}
+
+    def start(self) -> 'FakeMercadoPago':
+        # A short poll interval keeps stop() quick
+        self._thread = threading.Thread(
+            target=self.serve_forever, kwargs={'poll_interval': 0.05},
+            daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self) -> 'FakeMercadoPago':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--payment-status', default='approved')
+    options = parser.parse_args()
+    server = FakeMercadoPago(options.host, options.port, options.latency,
+                             options.jitter, options.error_rate,
+                             options.payment_status)
+    print('Fake MercadoPago listening on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Monotonic payment status transitions written with one conditional UPDATE.
+
+A notification may be processed after a newer one, so a status only replaces
+a status of a lower rank. The check is part of the UPDATE itself: concurrent
+workers never hold a row lock across a request to MercadoPago and exactly one
+of them sends ``status_changed`` for a given transition. A checkout closed by
+the expiry sweeper is the exception: a buyer who pays afterwards is still
+confirmed.
+"""
+from typing import TYPE_CHECKING
+
+from django.db.models import Case, F, Model, Q, TextField, Value, When
+from django.utils import timezone
+
+from payments import PaymentStatus
+from payments.signals import status_changed
+
+if TYPE_CHECKING:
+    from payments.models import BasePayment
+
+
+STATUS_RANKS = {
+    PaymentStatus.INPUT: 0,
+    PaymentStatus.WAITING: 1,
+    PaymentStatus.PREAUTH: 2,
+    PaymentStatus.CONFIRMED: 3,
+    PaymentStatus.REJECTED: 4,
+    PaymentStatus.CANCELLED: 4,
+    PaymentStatus.ERROR: 4,
+    PaymentStatus.REFUNDED: 5,
+}
+
+# Statuses MercadoPago may still move forward
+PENDING_STATUSES = frozenset([
+    PaymentStatus.INPUT, PaymentStatus.WAITING, PaymentStatus.PREAUTH])
+
+# Message of the payments closed by the expiry sweeper
+EXPIRED_MESSAGE = 'Checkout expired'
+EXPIRED_STATUSES = (
+    PaymentStatus.CANCELLED, PaymentStatus.REJECTED, PaymentStatus.ERROR)
+
+
+def get_rank(status: str) -> int:
+    return STATUS_RANKS.get(status, 0)
+
+
+def is_forward(current: str, status: str) -> bool:
+    return get_rank(status) > get_rank(current)
+
+
+def get_previous_statuses(status: str) -> list:
+    rank = get_rank(status)
+    return [previous for previous, previous_rank in STATUS_RANKS.items()
+            if previous_rank < rank]
+
+
+def is_expired(payment: 'BasePayment') -> bool:
+    """Whether the expiry sweeper closed ``payment``."""
+    return (payment.status in EXPIRED_STATUSES
+            and payment.message == EXPIRED_MESSAGE)
+
+
+def can_transition(payment: 'BasePayment') -> bool:
+    """Only saved model instances can be updated in the database."""
+    return isinstance(payment, Model) and payment.pk is not None
+
+
+def touch(payment: 'BasePayment') -> None:
+    """Bump ``modified``, which ``save(update_fields=...)`` leaves alone."""
+    if can_transition(payment):
+        payment.modified = timezone.now()
+        type(payment)._default_manager.filter(pk=payment.pk).update(
+            modified=payment.modified)
+
+
+def refresh_status(payment: 'BasePayment') -> None:
+    """Reload the fields of ``payment`` that a transition depends on."""
+    payment.refresh_from_db(fields=['status', 'message', 'transaction_id'])
+
+
+def transition(payment: 'BasePayment', status: str, fields: dict) -> bool:
+    """Save ``fields`` and move ``payment`` to ``status`` in one query.
+
+    Returns ``True`` if this call changed the status. A status equal to the
+    stored one only saves ``fields``; a status of a lower rank is stale and
+    writes nothing. A confirmation also replaces an expired checkout. When
+    another worker changed the row first, ``payment`` is reloaded with the
+    stored status.
+    """
+    queryset = type(payment)._default_manager.filter(pk=payment.pk)
+    # The expiry sweeper only closes payments left unchanged for long
+    fields = dict(fields, modified=timezone.now())
+    if status == payment.status:
+        if not queryset.filter(status=status).update(**fields):
+            refresh_status(payment)
+        return False
+    reopened = status == PaymentStatus.CONFIRMED and is_expired(payment)
+    if not (reopened or is_forward(payment.status, status)):
+        return False
+    condition = Q(status__in=get_previous_statuses(status))
+    values = {}
+    if status == PaymentStatus.CONFIRMED:
+        # Paid after the sweeper closed the checkout, which this copy of the
+        # payment may not know yet. The message is set before the status,
+        # MySQL evaluates assignments in order.
+        expired = Q(status__in=EXPIRED_STATUSES, message=EXPIRED_MESSAGE)
+        condition |= expired
+        values['message'] = Case(When(expired, then=Value('')),
+                                 default=F('message'),
+                                 output_field=TextField())
+    values['status'] = status
+    values.update(fields)
+    updated = queryset.filter(condition).update(**values)
+    if not updated:
+        # Another worker moved the payment first
+        refresh_status(payment)
+        return False
+    payment.status = status
+    if reopened:
+        payment.message = ''
+    for field, value in fields.items():
+        setattr(payment, field, value)
+    status_changed.send(sender=type(payment), instance=payment)
+    return True
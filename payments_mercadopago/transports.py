@@ -0,0 +1,145 @@
+"""How the provider talks to MercadoPago.
+
+Transports expose the operations the provider uses and return the SDK
+response format, ``{'status': <HTTP status>, 'response': <JSON body>}``.
+"""
+import json
+from decimal import Decimal
+from typing import Callable, Optional, Union
+
+from .client import API_BASE_URL, Timeout, get_client, get_session
+
+
+class BaseTransport:
+    """``access_token`` is a token or a callable returning the current one."""
+
+    def __init__(self, access_token: Union[str, Callable[[], str]],
+                 sandbox_mode: bool = False,
+                 pool_size: int = 10, timeout: Timeout = None,
+                 api_base_url: str = API_BASE_URL) -> None:
+        self.access_token = access_token
+        self.sandbox_mode = sandbox_mode
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.api_base_url = api_base_url
+
+    def get_access_token(self) -> str:
+        if callable(self.access_token):
+            return self.access_token()
+        return self.access_token
+
+    def get_account(self) -> Optional[str]:
+        """What identifies the account while its token is refreshed."""
+        if callable(self.access_token):
+            return getattr(self.access_token, 'key', None)
+        return None
+
+    def create_preference(self, preference: dict) -> dict:
+        raise NotImplementedError
+
+    def get_payment(self, payment_id) -> dict:
+        raise NotImplementedError
+
+    def create_payment(self, payment: dict) -> dict:
+        raise NotImplementedError
+
+    def search_payment(self, filters: dict, offset: int = 0,
+                       limit: int = 0) -> dict:
+        raise NotImplementedError
+
+    def get_merchant_order(self, order_id) -> dict:
+        raise NotImplementedError
+
+    def refund_payment(self, payment_id, amount: Optional[Decimal] = None) -> dict:
+        """Refund the whole payment, or ``amount`` of it."""
+        raise NotImplementedError
+
+    def cancel_payment(self, payment_id) -> dict:
+        raise NotImplementedError
+
+
+class SDKTransport(BaseTransport):
+    """Goes through the official ``mercadopago`` SDK, imported on first use."""
+
+    @property
+    def mp(self):
+        return get_client(self.get_access_token(), self.sandbox_mode,
+                          self.pool_size, self.timeout, self.api_base_url,
+                          self.get_account())
+
+    def create_preference(self, preference: dict) -> dict:
+        return self.mp.create_preference(preference)
+
+    def get_payment(self, payment_id) -> dict:
+        return self.mp.get_payment(payment_id)
+
+    def create_payment(self, payment: dict) -> dict:
+        return self.mp.post('/v1/payments', payment)
+
+    def search_payment(self, filters: dict, offset: int = 0,
+                       limit: int = 0) -> dict:
+        return self.mp.search_payment(filters, offset, limit)
+
+    def get_merchant_order(self, order_id) -> dict:
+        return self.mp.get('/merchant_orders/%s' % order_id)
+
+    def refund_payment(self, payment_id, amount: Optional[Decimal] = None) -> dict:
+        if amount is None:
+            return self.mp.refund_payment(payment_id)
+        # The SDK only refunds whole payments
+        return self.mp.post('/v1/payments/%s/refunds' % payment_id,
+                            {'amount': float(amount)})
+
+    def cancel_payment(self, payment_id) -> dict:
+        return self.mp.cancel_payment(payment_id)
+
+
+class HTTPTransport(BaseTransport):
+    """Calls the REST API directly on a shared keep-alive session.
+
+    It skips the SDK and its per call overhead and authenticates with an
+    ``Authorization`` header instead of a query parameter.
+    """
+
+    def request(self, method: str, path: str, data: dict = None,
+                params: dict = None) -> dict:
+        headers = {'Authorization': 'Bearer %s' % self.get_access_token(),
+                   'Accept': 'application/json'}
+        body = None
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(data, default=float)
+        response = get_session(self.pool_size, self.timeout).request(
+            method, self.api_base_url.rstrip('/') + path, data=body,
+            params=params, headers=headers)
+        try:
+            content = response.json()
+        except ValueError:
+            content = {}
+        return {'status': response.status_code, 'response': content}
+
+    def create_preference(self, preference: dict) -> dict:
+        return self.request('POST', '/checkout/preferences', preference)
+
+    def get_payment(self, payment_id) -> dict:
+        return self.request('GET', '/v1/payments/%s' % payment_id)
+
+    def create_payment(self, payment: dict) -> dict:
+        return self.request('POST', '/v1/payments', payment)
+
+    def search_payment(self, filters: dict, offset: int = 0,
+                       limit: int = 0) -> dict:
+        return self.request('GET', '/v1/payments/search', params=dict(
+            filters, offset=offset, limit=limit))
+
+    def get_merchant_order(self, order_id) -> dict:
+        return self.request('GET', '/merchant_orders/%s' % order_id)
+
+    def refund_payment(self, payment_id, amount: Optional[Decimal] = None) -> dict:
+        data = {} if amount is None else {'amount': float(amount)}
+        return self.request(
+            'POST', '/v1/payments/%s/refunds' % payment_id, data)
+
+    def cancel_payment(self, payment_id) -> dict:
+        return self.request('PUT', '/v1/payments/%s' % payment_id,
+                            {'status': 'cancelled'})
@@ -0,0 +1,22 @@
+import django
+from django.urls import path
+
+from . import views
+
+
+urlpatterns = [
+    path('webhook/<str:variant>/', views.webhook,
+         name='mercadopago_static_webhook'),
+    path('webhook/<str:variant>/<uuid:token>/', views.webhook,
+         name='mercadopago_webhook'),
+    path('status/<uuid:token>/', views.payment_status,
+         name='mercadopago_payment_status'),
+]
+
+if django.VERSION >= (3, 1):
+    # Async views, and asgiref for aio, need Django 3.1
+    from . import aio
+
+    urlpatterns.append(
+        path('process/<uuid:token>/', aio.process_data,
+             name='mercadopago_async_process_payment'))
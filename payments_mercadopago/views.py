@@ -0,0 +1,160 @@
+import json
+import logging
+from typing import NamedTuple, Optional
+
+from django.http import (
+    HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse)
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods
+
+from payments import PaymentError, get_payment_model
+from payments.core import provider_factory
+
+from . import MERCHANT_ORDER_TOPICS, MercadoPagoProvider
+from .streams import stream_statuses
+
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_TOPICS = frozenset(('payment',) + MERCHANT_ORDER_TOPICS)
+
+MAX_BODY_SIZE = 16 * 1024
+
+MAX_POLL_TIMEOUT = 60
+
+
+class Notification(NamedTuple):
+    topic: str
+    resource_id: str
+
+
+def parse_notification(request: HttpRequest) -> Optional[Notification]:
+    """Read a notification from the query string or the JSON body.
+
+    Understands webhooks (``type`` and ``data.id``), legacy IPN (``topic``
+    and ``id``) and JSON bodies with ``type``/``data.id`` or
+    ``topic``/``resource``. Returns ``None`` for malformed requests.
+    """
+    topic = request.GET.get('type') or request.GET.get('topic')
+    resource_id = request.GET.get('data.id') or request.GET.get('id')
+    if not (topic and resource_id) and request.body:
+        if len(request.body) > MAX_BODY_SIZE:
+            return None
+        try:
+            body = json.loads(request.body.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            return None
+        if not isinstance(body, dict):
+            return None
+        topic = topic or body.get('type') or body.get('topic')
+        data = body.get('data')
+        if isinstance(data, dict) and data.get('id'):
+            resource_id = str(data['id'])
+        elif body.get('resource'):
+            # IPN bodies send the resource URL, the id is its last segment
+            resource_id = str(body['resource']).rstrip('/').rsplit('/', 1)[-1]
+    if not topic or not resource_id or not str(resource_id).isalnum():
+        return None
+    return Notification(str(topic), str(resource_id))
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+def webhook(request: HttpRequest, variant: str,
+            token: Optional[str] = None) -> HttpResponse:
+    """Process a MercadoPago notification touching the database last.
+
+    Malformed requests, unsigned requests and topics the provider does not
+    handle are answered before any query. Without a ``token`` in the URL the
+    payment is found through the ``external_reference`` MercadoPago returns.
+    """
+    try:
+        provider = provider_factory(variant)
+    except ValueError:
+        return HttpResponse(status=404)
+    if not isinstance(provider, MercadoPagoProvider):
+        return HttpResponse(status=404)
+    notification = parse_notification(request)
+    if notification is None:
+        return HttpResponse(status=400)
+    if notification.topic not in SUPPORTED_TOPICS:
+        return HttpResponse(status=200)
+    if not provider.verify_signature(request, notification.resource_id):
+        logger.warning('Invalid MercadoPago webhook signature',
+                       extra={'variant': variant})
+        return HttpResponse(status=401)
+    is_merchant_order = notification.topic in MERCHANT_ORDER_TOPICS
+    payment_information = None
+    if token is None:
+        try:
+            if is_merchant_order:
+                payment_information = \
+                    provider.get_merchant_order_information(
+                        notification.resource_id)
+            else:
+                payment_information = provider.get_payment_information(
+                    notification.resource_id)
+        except PaymentError:
+            return HttpResponse(status=502)
+        token = provider.get_value_from_response(
+            payment_information, 'external_reference')
+        if not token:
+            return HttpResponse(status=200)
+    Payment = get_payment_model()
+    payment = Payment._default_manager.filter(
+        token=str(token), variant=variant).first()
+    if payment is None:
+        # Not created by this site, nothing MercadoPago should retry
+        return HttpResponse(status=200 if payment_information else 404)
+    try:
+        if is_merchant_order:
+            provider.process_merchant_order(
+                payment, notification.resource_id, payment_information)
+        else:
+            provider.process_notification(
+                payment, notification.resource_id, payment_information)
+    except PaymentError:
+        return HttpResponse(status=502)
+    return HttpResponse(status=200)
+
+
+@require_GET
+def payment_status(request: HttpRequest, token) -> HttpResponse:
+    """Tell the return page when the status of a payment changes.
+
+    With ``Accept: text/event-stream`` the statuses are sent as Server-Sent
+    Events. Otherwise the status is returned as JSON, and when it equals the
+    ``status`` parameter the response waits up to ``timeout`` seconds for
+    a change. The payment is read once, later changes come from the broker.
+    """
+    payment = get_payment_model()._default_manager.filter(
+        token=str(token)).only('token', 'variant', 'status').first()
+    if payment is None:
+        return HttpResponse(status=404)
+    try:
+        provider = provider_factory(payment.variant)
+    except ValueError:
+        return HttpResponse(status=404)
+    broker = getattr(provider, 'status_broker', None)
+    if broker is None:
+        return HttpResponse(status=404)
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        response = StreamingHttpResponse(
+            stream_statuses(broker, str(payment.token), payment.status),
+            content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the events
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    status = payment.status
+    if request.GET.get('status') == status:
+        try:
+            timeout = min(int(request.GET.get('timeout', 25)),
+                          MAX_POLL_TIMEOUT)
+        except ValueError:
+            return HttpResponse(status=400)
+        status = broker.wait(str(payment.token), status,
+                             max(timeout, 0)) or status
+    response = JsonResponse({'status': status})
+    response['Cache-Control'] = 'no-cache'
+    return response
@@ -46,7 +46,7 @@ class PyTest(TestCommand):
 setup(
     author="Eduardo Zepeda",
     author_email='eduardozepeda@coffeebytes.dev',
-    python_requires='>=3.5',
+    python_requires='>=3.6',
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
@@ -60,6 +60,9 @@ setup(
     ],
     description="A mercadopago payment gateway backend for django-payments.",
     install_requires=REQUIREMENTS,
+    extras_require={
+        'async': ['httpx'],
+    },
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -8,6 +8,13 @@ TEMPLATES = [{
 
 SECRET_KEY = 'MY-SECRET-KEY'
 PAYMENT_HOST = 'example.org'
+PAYMENT_MODEL = 'testapp.Payment'
 
-INSTALLED_APPS = ['payments', 'django.contrib.sites']
+INSTALLED_APPS = ['payments', 'payments_mercadopago', 'django.contrib.sites',
+                  'testapp']
 ROOT_URLCONF = 'payments.urls'
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:'}}
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
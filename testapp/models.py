@@ -0,0 +1,14 @@
+from payments import PurchasedItem
+from payments.models import BasePayment
+
+
+class Payment(BasePayment):
+
+    def get_failure_url(self) -> str:
+        return 'http://cancel.com'
+
+    def get_success_url(self) -> str:
+        return 'http://success.com'
+
+    def get_purchased_items(self) -> PurchasedItem:
+        return []